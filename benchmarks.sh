@@ -0,0 +1,13 @@
+#!/bin/bash
+
+echo "============================================================"
+echo "== benchmarks =="
+python benchmarks/suite.py --compare benchmarks/baseline.json $@
+
+echo "============================================================"
+echo "== startup =="
+python benchmarks/bench_startup.py
+
+echo "============================================================"
+echo "== thread scaling =="
+python benchmarks/bench_threads.py
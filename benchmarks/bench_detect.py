@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Compares When(detect=...) against the original try-every-format loop for
+# a string of each of the built-in formats, then again with extra custom
+# formats registered to show detection cost doesn't grow with them.
+import os, sys, timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When
+
+SAMPLES = {
+    'date': '1972-01-31',
+    'time': '13:55',
+    'time_sec': '13:55:07',
+    'datetime': '1972-01-31 13:55',
+    'datetime_sec': '1972-01-31 13:55:07',
+    'datetime_utc': '1972-01-31T13:55Z',
+    'datetime_sec_utc': '1972-01-31T13:55:07Z',
+    'iso_micro': '1972-01-31T13:55:07.123456Z',
+}
+
+# =============================================================================
+
+def legacy_detect(value):
+    for f in When.parse_formats.values():
+        try:
+            return datetime.strptime(value, f)
+        except ValueError:
+            pass
+
+    raise ValueError()
+
+
+def compare(number):
+    print('%-18s %12s %12s %8s' % ('format', 'loop us', 'detect us',
+        'speedup'))
+    for name, value in SAMPLES.items():
+        old = min(timeit.repeat(lambda: legacy_detect(value), number=number,
+            repeat=3)) / number * 1e6
+        new = min(timeit.repeat(lambda: When(detect=value), number=number,
+            repeat=3)) / number * 1e6
+        print('%-18s %12.2f %12.2f %7.1fx' % (name, old, new, old / new))
+
+
+def main(number=20000, extra=50):
+    compare(number)
+
+    print('\nwith %d extra registered formats' % extra)
+    names = ['extra%d' % i for i in range(extra)]
+    for i, name in enumerate(names):
+        When.register_format(name, 'x' * (i + 1) + '%Y/%m/%d')
+
+    try:
+        compare(number // 4)
+    finally:
+        for name in names:
+            When.unregister_format(name)
+
+
+if __name__ == '__main__':
+    main()
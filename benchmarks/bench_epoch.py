@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Compares the local time epoch conversions, which go through the C
+# library's mktime and localtime, against the time zone explicit ones done
+# with a ZoneTable.
+import os, sys, timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When, WhenArray, ZoneTable
+
+ZONES = [None, 'UTC', 'America/Toronto']
+
+# =============================================================================
+
+def main(number=20000, batch=100000):
+    for tz in ZONES:
+        # build the table outside of the timings
+        if tz is not None:
+            ZoneTable.get(tz)
+
+    d = datetime(1972, 1, 31, 13, 55, 7)
+    print('%-18s %12s %12s' % ('tz', 'epoch us', 'When(epoch) us'))
+    for tz in ZONES:
+        # epoch is memoized, so each call converts a new When
+        to_epoch = min(timeit.repeat(lambda: When(datetime=d, tz=tz).epoch,
+            number=number, repeat=3)) / number * 1e6
+        from_epoch = min(timeit.repeat(lambda: When(epoch=65732107, tz=tz),
+            number=number, repeat=3)) / number * 1e6
+        print('%-18s %12.2f %12.2f' % (tz or 'local', to_epoch, from_epoch))
+
+    whens = WhenArray.from_datetimes(d + timedelta(minutes=i) for i in
+        range(batch))
+    print('\n%-18s %12s' % ('tz', 'epochs() ns/value'))
+    for tz in ZONES:
+        elapsed = min(timeit.repeat(lambda: whens.epochs(tz), number=1,
+            repeat=3))
+        print('%-18s %12.1f' % (tz or 'local', elapsed / batch * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# Compares When.string.<name> against the original strftime based
+# formatting for each of the built-in formats.
+import os, sys, timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When
+
+# =============================================================================
+
+def legacy_format(when, name):
+    formatter = When.parse_formats[name]
+    if name == 'iso_micro':
+        formatter = When.parse_formats['datetime_sec_utc']
+
+    result = when.datetime.strftime(formatter)
+
+    if name == 'iso_micro':
+        result = result[:-1] + '.%dZ' % int(when.datetime.strftime('%f'))
+
+    return result
+
+
+def main(number=50000):
+    when = When(datetime=datetime(1972, 1, 31, 13, 55, 7, 123456))
+    print('%-18s %12s %12s %8s' % ('format', 'strftime us', 'string us',
+        'speedup'))
+    for name in When.parse_formats:
+        old = min(timeit.repeat(lambda: legacy_format(when, name),
+            number=number, repeat=3)) / number * 1e6
+        new = min(timeit.repeat(lambda: getattr(when.string, name),
+            number=number, repeat=3)) / number * 1e6
+        print('%-18s %12.2f %12.2f %7.1fx' % (name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
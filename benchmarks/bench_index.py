@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Compares answering window queries with a WhenIndex against scanning a list
+# of datetimes, and loading a saved index against building it again.
+import os, random, sys, tempfile, timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import WhenIndex
+
+# =============================================================================
+
+def main(count=1000000, number=100):
+    rand = random.Random(42)
+    epochs = [rand.randint(0, 10 ** 9) for _ in range(count)]
+    dates = [datetime(1970, 1, 1) + timedelta(seconds=e) for e in epochs]
+
+    build = min(timeit.repeat(lambda: WhenIndex.from_epochs(epochs,
+        tz='UTC', bucket='hour').count(None, None), number=1, repeat=3))
+    index = WhenIndex.from_epochs(epochs, tz='UTC', bucket='hour')
+    start, end = datetime(2000, 1, 1), datetime(2000, 1, 2)
+
+    scan = min(timeit.repeat(lambda: sum(1 for d in dates
+        if start <= d < end), number=1, repeat=3))
+    query = min(timeit.repeat(lambda: index.count(start, end),
+        number=number, repeat=3)) / number
+    rollup = min(timeit.repeat(lambda: index.rollup('day', start,
+        datetime(2000, 2, 1)), number=number, repeat=3)) / number
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'index.bin')
+        index.save(path)
+        load = min(timeit.repeat(lambda: WhenIndex.load(path).count(start,
+            end), number=number, repeat=3)) / number
+
+    print('%d values' % count)
+    print('%-18s %12s' % ('operation', 'ms'))
+    print('%-18s %12.2f' % ('build', build * 1e3))
+    print('%-18s %12.2f' % ('load', load * 1e3))
+    print('%-18s %12.2f' % ('scan window', scan * 1e3))
+    print('%-18s %12.4f' % ('count window', query * 1e3))
+    print('%-18s %12.4f' % ('rollup month', rollup * 1e3))
+
+
+if __name__ == '__main__':
+    main()
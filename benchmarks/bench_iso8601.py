@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# Compares When(parse_iso8601=...) and When(detect=...) against parsing the
+# same ISO 8601 variants with datetime.strptime, for the variants strptime
+# has a pattern for.
+import os, sys, timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When
+
+# name: (sample, strptime pattern or None if strptime can't parse it)
+SAMPLES = {
+    'utc': ('1972-01-31T13:55:07Z', '%Y-%m-%dT%H:%M:%S%z'),
+    'offset': ('1972-01-31T13:55:07-05:00', '%Y-%m-%dT%H:%M:%S%z'),
+    'micro_offset': ('1972-01-31T13:55:07.123456-05:00',
+        '%Y-%m-%dT%H:%M:%S.%f%z'),
+    'space_milli': ('1972-01-31 13:55:07.123+05:30',
+        '%Y-%m-%d %H:%M:%S.%f%z'),
+    'compact_offset': ('1972-01-31T13:55:07.123-0330',
+        '%Y-%m-%dT%H:%M:%S.%f%z'),
+    'comma': ('1972-01-31T13:55:07,123456Z', '%Y-%m-%dT%H:%M:%S,%f%z'),
+    'nanos': ('1972-01-31T13:55:07.123456789Z', None),
+    'no_seconds': ('1972-01-31T13:55+01:00', '%Y-%m-%dT%H:%M%z'),
+}
+
+# =============================================================================
+
+def main(number=20000):
+    print('%-16s %12s %12s %12s %8s' % ('variant', 'strptime us',
+        'iso8601 us', 'detect us', 'speedup'))
+    for name, (value, pattern) in SAMPLES.items():
+        new = min(timeit.repeat(lambda: When(parse_iso8601=value),
+            number=number, repeat=3)) / number * 1e6
+        detect = min(timeit.repeat(lambda: When(detect=value),
+            number=number, repeat=3)) / number * 1e6
+        if pattern is None:
+            print('%-16s %12s %12.2f %12.2f %8s' % (name, 'n/a', new,
+                detect, 'n/a'))
+            continue
+
+        old = min(timeit.repeat(lambda: datetime.strptime(value, pattern),
+            number=number, repeat=3)) / number * 1e6
+        print('%-16s %12.2f %12.2f %12.2f %7.1fx' % (name, old, new,
+            detect, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Compares the memory used by many When objects against the same values held
+# as CompactWhen objects.
+import os, sys, tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When, CompactWhen
+
+# =============================================================================
+
+def measure(build, count):
+    tracemalloc.start()
+    items = build(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size
+
+
+def build_when(count):
+    start = datetime(1972, 1, 31, 13, 55)
+    step = timedelta(seconds=1, microseconds=7)
+    return [When(datetime=start + step * i) for i in range(count)]
+
+
+def build_compact(count):
+    start = datetime(1972, 1, 31, 13, 55)
+    step = timedelta(seconds=1, microseconds=7)
+    return [CompactWhen.from_datetime(start + step * i) for i in range(count)]
+
+
+def main(count=200000):
+    old = measure(build_when, count)
+    new = measure(build_compact, count)
+    print('%d values (including the list holding them)' % count)
+    print('%-12s %10.1f bytes/value' % ('When', old / count))
+    print('%-12s %10.1f bytes/value' % ('CompactWhen', new / count))
+    print('%-12s %10.1fx' % ('reduction', old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# Compares When(parse_<name>=...) against calling datetime.strptime directly
+# for each of the built-in formats.
+import os, sys, timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When
+from bench_detect import SAMPLES
+
+# =============================================================================
+
+def main(number=20000):
+    print('%-18s %12s %12s %8s' % ('format', 'strptime us', 'parse us',
+        'speedup'))
+    for name, value in SAMPLES.items():
+        if name.startswith('time'):
+            # parse_time* keywords don't use strptime
+            continue
+
+        f = When.parse_formats[name]
+        kwargs = {'parse_' + name: value}
+        old = min(timeit.repeat(lambda: datetime.strptime(value, f),
+            number=number, repeat=3)) / number * 1e6
+        new = min(timeit.repeat(lambda: When(**kwargs), number=number,
+            repeat=3)) / number * 1e6
+        print('%-18s %12.2f %12.2f %7.1fx' % (name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
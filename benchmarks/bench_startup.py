@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Measures what a cold start pays: importing when, the first detect and
+# parse_* calls after importing it, warmup() and the first detect after
+# warmup(). Each measurement is made in a fresh interpreter and the median
+# of the runs is kept. Bytecode is written once up front so the timings
+# don't include compiling when.py.
+#
+#   ./bench_startup.py              # 20 runs
+#   ./bench_startup.py --runs 50
+import argparse, os, statistics, subprocess, sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (labels, script) pairs, each script prints its timings in seconds, one per
+# line, in the order of its labels
+SCRIPTS = [
+    (['import when'], '''
+start = perf_counter()
+import when
+print(perf_counter() - start)
+'''),
+    (['first detect', 'second detect'], '''
+import when
+start = perf_counter()
+when.When(detect='1972-01-31T13:55:07.123456Z')
+print(perf_counter() - start)
+start = perf_counter()
+when.When(detect='1972-01-31 13:55')
+print(perf_counter() - start)
+'''),
+    (['first parse canonical', 'first parse lenient'], '''
+import when
+start = perf_counter()
+when.When(parse_datetime_sec='1972-01-31 13:55:07').epoch
+print(perf_counter() - start)
+start = perf_counter()
+when.When(parse_datetime_sec='1972-1-31 13:55:07').epoch
+print(perf_counter() - start)
+'''),
+    (['warmup()', 'lenient after warmup'], '''
+import when
+start = perf_counter()
+when.warmup()
+print(perf_counter() - start)
+start = perf_counter()
+when.When(detect='1972-1-31 13:55:07')
+print(perf_counter() - start)
+'''),
+]
+
+# =============================================================================
+
+def measure(script, runs):
+    # returns a list of the median of each timing the script prints
+    code = 'from time import perf_counter\n' + script
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code],
+            env=env, cwd=ROOT)
+        samples.append([float(line) for line in output.split()])
+
+    return [statistics.median(timings) for timings in zip(*samples)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measures import time and time to first parse')
+    parser.add_argument('--runs', type=int, default=20,
+        help='fresh interpreters per measurement, default 20')
+    args = parser.parse_args(argv)
+
+    # write the bytecode so the first timed import doesn't compile it
+    measure('import when', 1)
+
+    print('%-24s %12s' % ('measurement', 'ms'))
+    for labels, script in SCRIPTS:
+        for label, result in zip(labels, measure(script, args.runs)):
+            print('%-24s %12.3f' % (label, result * 1e3))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
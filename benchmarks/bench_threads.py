@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Measures how parsing throughput scales from 1 to N threads, for
+# datetime.strptime and for When's parse_* keyword, detection and
+# parse_many. Every thread parses the same number of strings, so perfect
+# scaling is a throughput N times that of one thread. With the GIL nothing
+# scales past 1x, the comparison to look at there is strptime's lock
+# contention; on a free-threaded build When's paths should keep scaling.
+#
+#   ./bench_threads.py               # 1, 2, 4 and 8 threads
+#   ./bench_threads.py --threads 16 --count 50000
+import argparse, os, sys, threading, time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When
+
+VALUE = '1972-01-31T13:55:07.123456Z'
+LENIENT = '1972-1-31 13:55:07'
+
+CASES = [
+    ('strptime', lambda values: [datetime.strptime(v,
+        '%Y-%m-%dT%H:%M:%S.%fZ') for v in values]),
+    ('parse_iso_micro', lambda values: [When(parse_iso_micro=v)
+        for v in values]),
+    ('detect', lambda values: [When(detect=v) for v in values]),
+    ('detect_lenient', lambda values: [When(detect=LENIENT)
+        for _ in values]),
+    ('parse_many', lambda values: When.parse_many(values, 'iso_micro')),
+]
+
+# =============================================================================
+
+def throughput(function, threads, count):
+    # parses per second with each of the threads calling function on count
+    # strings at the same time
+    values = [VALUE] * count
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        function(values)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+
+    return threads * count / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measures parsing throughput from 1 to N threads')
+    parser.add_argument('--threads', type=int, default=8,
+        help='largest thread count, doubling from 1, default 8')
+    parser.add_argument('--count', type=int, default=20000,
+        help='strings parsed by each thread, default 20000')
+    args = parser.parse_args(argv)
+
+    counts = [1]
+    while counts[-1] * 2 <= args.threads:
+        counts.append(counts[-1] * 2)
+
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('python %s, GIL %s' % (sys.version.split()[0],
+        'enabled' if gil else 'disabled'))
+    print('%-18s %8s %14s %8s' % ('case', 'threads', 'parses/s',
+        'scaling'))
+    for name, function in CASES:
+        single = None
+        for threads in counts:
+            result = throughput(function, threads, args.count)
+            single = single or result
+            print('%-18s %8d %14.0f %7.2fx' % (name, threads, result,
+                result / single))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Benchmark suite covering the parse_* keywords, detection of each format
+# from the best and worst position in parse_formats, every string.* format
+# and the epoch conversions. Results are saved as JSON and can be compared
+# against a stored baseline, exiting with 1 if any case is slower than the
+# baseline by more than the threshold.
+#
+#   ./suite.py                          # print the timings
+#   ./suite.py --save baseline.json     # record a new baseline
+#   ./suite.py --compare baseline.json  # check against it
+import argparse, json, os, platform, sys, timeit
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from when import When, ParseStats, ZoneTable, __version__
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+SAMPLES = {
+    'date': '1972-01-31',
+    'time': '13:55',
+    'time_sec': '13:55:07',
+    'datetime': '1972-01-31 13:55',
+    'datetime_sec': '1972-01-31 13:55:07',
+    'datetime_utc': '1972-01-31T13:55Z',
+    'datetime_sec_utc': '1972-01-31T13:55:07Z',
+    'iso_micro': '1972-01-31T13:55:07.123456Z',
+    'iso_offset': '1972-01-31T13:55:07-05:00',
+    'iso_micro_offset': '1972-01-31T13:55:07.123456-05:00',
+}
+
+# =============================================================================
+
+def ordered(name, first):
+    # a When subclass whose parse_formats has the named format first, or
+    # last, for timing detection from either end
+    formats = OrderedDict(When.parse_formats)
+    formats.move_to_end(name, last=not first)
+    return type('When', (When, ), {'parse_formats': dict(formats)})
+
+
+def cases():
+    # returns an ordered dict of case name to a function to time
+    result = OrderedDict()
+    for name, value in SAMPLES.items():
+        kwargs = {'parse_' + name: value}
+        result['parse_' + name] = lambda kwargs=kwargs: When(**kwargs)
+
+    for name, value in SAMPLES.items():
+        for position, first in [('best', True), ('worst', False)]:
+            cls = ordered(name, first)
+            result['detect_%s_%s' % (name, position)] = \
+                lambda cls=cls, value=value: cls(detect=value)
+
+    # RFC 3339 variants outside the built-in formats
+    nanos = '1972-01-31T13:55:07,123456789-05:00'
+    result['parse_iso8601'] = lambda: When(parse_iso8601=nanos)
+    result['detect_iso8601'] = lambda: When(detect=nanos)
+
+    # parsing straight from a buffer
+    record = b'id=7 at ' + SAMPLES['iso_micro'].encode('ascii') + b' ok'
+    result['detect_bytes'] = lambda: When(detect=record[8:35])
+    result['from_buffer'] = lambda: When.from_buffer(record, 8, 27)
+    result['from_buffer_memoryview'] = lambda view=memoryview(record): \
+        When.from_buffer(view, 8, 27, 'iso_micro')
+
+    # cost of instrumentation when it is on
+    counted = type('When', (When, ), {'parse_stats': ParseStats()})
+    result['detect_iso_micro_stats'] = lambda: counted(
+        detect=SAMPLES['iso_micro'])
+
+    d = datetime(1972, 1, 31, 13, 55, 7, 123456)
+    when = When(datetime=d)
+    for name in SAMPLES:
+        result['string_' + name] = lambda name=name: getattr(when.string,
+            name)
+
+    encoded = when.to_bytes()
+    result['to_bytes'] = lambda: When(datetime=d).to_bytes()
+    result['from_bytes'] = lambda: When.from_bytes(encoded)
+
+    # a day of minutes
+    day = d + timedelta(days=1)
+    result['series_when'] = lambda: list(When.series(d, day, 'minute'))
+    result['series_string'] = lambda: list(When.series(d, day, 'minute',
+        output='string'))
+    result['series_array'] = lambda: When.series(d, day, 'minute',
+        output='array')
+
+    # epoch is memoized, so each call converts a new When
+    ZoneTable.get('America/Toronto')
+    result['epoch'] = lambda: When(datetime=d).epoch
+    result['milli_epoch'] = lambda: When(datetime=d).milli_epoch
+    result['epoch_tz'] = lambda: When(datetime=d,
+        tz='America/Toronto').epoch
+    result['milli_epoch_tz'] = lambda: When(datetime=d,
+        tz='America/Toronto').milli_epoch
+    result['from_epoch'] = lambda: When(epoch=65732107)
+    result['from_milli_epoch'] = lambda: When(milli_epoch=65732107123)
+    result['from_epoch_tz'] = lambda: When(epoch=65732107,
+        tz='America/Toronto')
+
+    return result
+
+
+def run(number, repeat, match=None):
+    # returns an ordered dict of case name to the best time per call in
+    # nanoseconds
+    results = OrderedDict()
+    for name, function in cases().items():
+        if match and match not in name:
+            continue
+
+        best = min(timeit.repeat(function, number=number, repeat=repeat))
+        results[name] = best / number * 1e9
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    # returns a list of (name, baseline, result, ratio) for the cases that
+    # are slower than the baseline by more than threshold
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = result / baseline[name]
+        if ratio > 1 + threshold:
+            slower.append((name, baseline[name], result, ratio))
+
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks When parsing, formatting and epochs')
+    parser.add_argument('--number', type=int, default=10000,
+        help='calls per timing, default 10000')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='timings per case, the best is kept, default 5')
+    parser.add_argument('-k', dest='match',
+        help='only run the cases whose name contains this')
+    parser.add_argument('--save', metavar='FILE',
+        help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', nargs='?',
+        const=BASELINE, help='compare against a saved baseline, defaults '
+        'to benchmarks/baseline.json')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='fraction slower than the baseline that fails, default 0.25')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run(args.number, args.repeat, args.match)
+    print('%-32s %12s %12s %8s' % ('case', 'ns/call', 'baseline', 'ratio'))
+    for name, result in results.items():
+        if name in baseline:
+            print('%-32s %12.1f %12.1f %7.2fx' % (name, result,
+                baseline[name], result / baseline[name]))
+        else:
+            print('%-32s %12.1f' % (name, result))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'version': __version__,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=4)
+            f.write('\n')
+
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+        print('\n%d cases are more than %d%% slower than the baseline:' % (
+            len(slower), args.threshold * 100))
+        for name, old, new, ratio in slower:
+            print('%-32s %12.1f %12.1f %7.2fx' % (name, new, old, ratio))
+
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
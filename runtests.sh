@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# --bench also runs the benchmark suite against the stored baseline
+if [ "$1" = "--bench" ]; then
+    bench=1
+    shift
+fi
+
 find . -name "*.pyc" -exec rm {} \;
 coverage run -p --source=unittests,when ./load_tests.py $@
 if [ "$?" = "0" ]; then
@@ -10,4 +16,8 @@ if [ "$?" = "0" ]; then
     echo -e "\nrun \"coverage html\" for full report"
     echo -e "\n"
     ./pyflakes.sh
+    if [ -n "$bench" ]; then
+        echo -e "\n"
+        ./benchmarks.sh
+    fi
 fi
@@ -32,6 +32,14 @@ SETUP_ARGS = dict(
     test_suite='load_tests.get_suite',
     py_modules = ['when',],
     install_requires=[],
+    entry_points={
+        'console_scripts': [
+            'when-normalize = when:main',
+        ],
+    },
+    extras_require={
+        'numpy': ['numpy'],
+    },
     tests_require=[
         'waelstow==0.10.2',
     ],
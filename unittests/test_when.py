@@ -1,7 +1,20 @@
-from datetime import datetime, date, time
-from unittest import TestCase
+import asyncio, calendar, io, os, pickle, random, subprocess, sys, tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, date, time, timedelta, timezone
+from itertools import islice
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
-from when import When
+from when import (When, TimeOnlyError, ParseCache, ParseStats, CompactWhen,
+    WhenArray, WhenIndex, ZoneTable, normalize_lines, normalize_file,
+    parse_stream, main, warmup, _parser, _SPAN, _TABLE_START)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # =============================================================================
 
@@ -111,3 +124,1962 @@ class TestWhen(TestCase):
         self.assertEqual(self.only_time, when.time)
         self.assertEqual(self.epoch, when.epoch)
         self.assertEqual(self.mepoch, when.milli_epoch)
+
+    def test_formatters(self):
+        # compiled formatters must match strftime
+        def legacy(d, name):
+            if name == 'iso_micro':
+                result = d.strftime(When.parse_formats['datetime_sec_utc'])
+                return result[:-1] + '.%dZ' % int(d.strftime('%f'))
+
+            return d.strftime(When.parse_formats[name])
+
+        rand = random.Random(42)
+        for _ in range(200):
+            d = datetime(rand.randint(1000, 9999), rand.randint(1, 12),
+                rand.randint(1, 28), rand.randint(0, 23), rand.randint(0, 59),
+                rand.randint(0, 59), rand.choice([0, 5, 500000, 123456]))
+            when = When(datetime=d)
+            for name, pattern in When.parse_formats.items():
+                if '%z' in pattern:
+                    # naive values have no offset, see TestTimeZones
+                    continue
+
+                self.assertEqual(legacy(d, name), getattr(when.string, name))
+
+        # custom formats, with and without directives that get compiled
+        when = When(datetime=self.full_date)
+        formats = {
+            'slashes': ('%d/%m/%Y', '31/01/1972'),
+            'percent': ('%H%%%M', '13%55'),
+            'weekday': ('%a %H:%M', 'Mon 13:55'),
+            'literal': ('now', 'now'),
+        }
+        for name, (pattern, expected) in formats.items():
+            When.parse_formats[name] = pattern
+
+        try:
+            for name, (pattern, expected) in formats.items():
+                self.assertEqual(expected, getattr(when.string, name))
+        finally:
+            for name in formats:
+                del When.parse_formats[name]
+
+        # iso_micro is built from datetime_sec_utc
+        original = When.parse_formats['datetime_sec_utc']
+        try:
+            When.parse_formats['datetime_sec_utc'] = '%d/%m/%Y %H:%M:%S!'
+            self.assertEqual('31/01/1972 13:55:00.0Z', when.string.iso_micro)
+            When.parse_formats['datetime_sec_utc'] = '%a %H:%M:%S!'
+            self.assertEqual('Mon 13:55:00.0Z', when.string.iso_micro)
+            When.parse_formats['datetime_sec_utc'] = '%H:%M:%S'
+            self.assertEqual('13:55:0.0Z', when.string.iso_micro)
+        finally:
+            When.parse_formats['datetime_sec_utc'] = original
+
+        with self.assertRaises(KeyError):
+            when.string.nothing
+
+    def test_compiled_parsers(self):
+        # compiled parsers accept what strptime accepts and raise the same
+        # errors
+        patterns = list(When.parse_formats.values()) + ['%d/%m/%Y',
+            '%Y%m%d %H%M%S', '%H:%M:%S.%f', '%Y %%d', 'at %H:%M']
+        values = ['1972-01-31', '1972-1-3', '1972-01-3 1:5', ' 5:07',
+            '1972-01-31T13:55:07.5z', '1972-01-31t1:5Z', '31/1/1972',
+            '19720131 135507', '1:2:3.1234567', '1972 %d', 'AT 13:55',
+            '1972-02-30', '1972-01-31\t 13:55', '24:00', '13:55:60', '',
+            '1972-01-31 13:55:07.', '13:55:07.1Z', '1972-01-31T13:55:07+05:70',
+            '1972-01-31T13:55:07.5-05:60', '1972-01-31T13:55:07+05:59']
+        for pattern in patterns:
+            parse = _parser(pattern)
+            for value in values:
+                try:
+                    expected = datetime.strptime(value, pattern)
+                except ValueError as e:
+                    with self.assertRaises(ValueError) as cm:
+                        parse(value)
+
+                    self.assertEqual(str(e), str(cm.exception))
+                else:
+                    self.assertEqual(expected, parse(value))
+
+    def test_register_format(self):
+        try:
+            # same layout as 'date', only used when 'date' fails
+            When.register_format('dmy', '%d-%m-%Y')
+            self.assertEqual(self.zero_date, When(detect='31-01-1972').datetime)
+            self.assertEqual(self.zero_date,
+                When(parse_dmy='31-01-1972').datetime)
+            self.assertEqual('31-01-1972',
+                When(datetime=self.zero_date).string.dmy)
+
+            # higher priority goes first
+            When.register_format('mdy', '%m-%d-%Y', priority=1)
+            self.assertEqual(datetime(1972, 3, 4),
+                When(detect='03-04-1972').datetime)
+            When.register_format('mdy', '%m-%d-%Y', priority=-1)
+            self.assertEqual(datetime(1972, 4, 3),
+                When(detect='03-04-1972').datetime)
+
+            # custom parser and formatter with an explicit hint
+            def parse(value):
+                return datetime.fromtimestamp(int(value[1:]))
+
+            When.register_format('stamp', '@%s', hint=(11, [(0, '@')]),
+                parser=parse, formatter=lambda d: '@%d' % d.timestamp())
+            when = When(detect='@0065732100')
+            self.assertEqual(When(epoch=65732100).datetime, when.datetime)
+            self.assertEqual('@65732100', when.string.stamp)
+
+            # the custom functions belong to the name, not the pattern
+            When.register_format('stamp2', '@%s', hint=False)
+            self.assertEqual('@%s', When.parse_formats['stamp2'])
+            When.unregister_format('stamp2')
+            self.assertEqual('@65732100', when.string.stamp)
+
+            When.unregister_format('stamp')
+            When.register_format('dashed', '%Y-%m-%d %H:%M',
+                parser=lambda value: datetime(2000, 1, 1),
+                formatter=lambda d: 'custom')
+            when = When(datetime=self.full_date)
+            self.assertEqual('custom', when.string.dashed)
+            self.assertEqual('1972-01-31 13:55', when.string.datetime)
+            self.assertEqual(self.full_date,
+                When(parse_datetime='1972-01-31 13:55').datetime)
+            When.unregister_format('dashed')
+            When.register_format('dashed', '%Y-%m-%d %H:%M', hint=False)
+            self.assertEqual(self.full_date,
+                When(parse_dashed='1972-01-31 13:55').datetime)
+            self.assertEqual('1972-01-31 13:55', when.string.dashed)
+
+            # no hint, only found by the fallback
+            When.register_format('weekday', '%a %Y-%m-%d', hint=False)
+            self.assertEqual(self.zero_date,
+                When(detect='Mon 1972-01-31').datetime)
+
+            # replacing a format in parse_formats directly skips its layout
+            When.parse_formats['dmy'] = '%d.%m.%Y'
+            self.assertEqual(self.zero_date, When(detect='31.01.1972').datetime)
+        finally:
+            for name in ['dmy', 'mdy', 'stamp', 'stamp2', 'dashed',
+                    'weekday']:
+                When.unregister_format(name)
+
+        self.assertNotIn('dmy', When.parse_formats)
+        with self.assertRaises(ValueError):
+            When(detect='31-01-1972')
+
+        # unregistering an unknown name is fine
+        When.unregister_format('nothing')
+
+    def test_register_time_format(self):
+        # whether a format parses to a time comes from its pattern, not its
+        # name
+        try:
+            When.register_format('timestamp', '%Y%m%d%H%M%S')
+            when = When(parse_timestamp='19720131135500')
+            self.assertEqual(self.full_date, when.datetime)
+            self.assertEqual('19720131135500', when.string.timestamp)
+            self.assertEqual([self.full_date], When.parse_many(
+                ['19720131135500'], 'timestamp')[0])
+
+            When.register_format('time_hm', '%H.%M')
+            self.assertEqual(self.only_time,
+                When(parse_time_hm='13.55').time)
+            with self.assertRaises(ValueError):
+                When(parse_time_hm='13:55')
+
+            When.register_format('hm', '%H:%M', hint=False)
+            self.assertEqual(self.only_time, When(parse_hm='13:55').time)
+            self.assertEqual([self.only_time],
+                When.parse_many(['13:55'], 'hm')[0])
+        finally:
+            for name in ['timestamp', 'time_hm', 'hm']:
+                When.unregister_format(name)
+
+    def test_detect_shapes(self):
+        # detection by shape must give the same result as trying every
+        # format in turn
+        def legacy(value):
+            for f in When.parse_formats.values():
+                try:
+                    return datetime.strptime(value, f)
+                except ValueError:
+                    pass
+
+            raise ValueError()
+
+        values = ['1972-01-31', '13:55', '13:55:07', '1972-01-31 13:55',
+            '1972-01-31 13:55:07', '1972-01-31T13:55Z',
+            '1972-01-31T13:55:07Z', '1972-01-31T13:55:07.1Z',
+            '1972-01-31T13:55:07.123456Z',
+            # non-canonical strings strptime is lenient about
+            '1972-1-31', '1:5', '1972-01-31  13:55', '1972-01-31t13:55z']
+        for value in values:
+            self.assertEqual(legacy(value), When(detect=value).datetime)
+
+        # right shape, bad content
+        for value in ['1972-13-31', '25:00', '1972-01-31T13:55:07.Z',
+                '1972-02-30 13:55']:
+            with self.assertRaises(ValueError):
+                When(detect=value)
+
+        # custom formats are still found
+        When.parse_formats['slashes'] = '%Y/%m/%d'
+        try:
+            self.assertEqual(self.zero_date,
+                When(detect='1972/01/31').datetime)
+        finally:
+            del When.parse_formats['slashes']
+
+    def test_fast_parsers(self):
+        # the fast path must agree with strptime for canonical strings
+        values = {
+            'date': '2016-02-29',
+            'datetime': '1999-12-31 23:59',
+            'datetime_sec': '1999-12-31 23:59:59',
+            'datetime_utc': '1999-12-31T23:59Z',
+            'datetime_sec_utc': '1999-12-31T23:59:59Z',
+            'iso_micro': '1999-12-31T23:59:59.000042Z',
+        }
+        for name, value in values.items():
+            expected = datetime.strptime(value, When.parse_formats[name])
+            kwargs = {'parse_' + name: value}
+            self.assertEqual(expected, When(**kwargs).datetime)
+
+        self.assertEqual(datetime(1999, 12, 31, 23, 59, 59, 100000),
+            When(parse_iso_micro='1999-12-31T23:59:59.1Z').datetime)
+
+        # lenient strings still go through strptime
+        self.assertEqual(datetime(1972, 1, 3),
+            When(parse_date='1972-1-3').datetime)
+        self.assertEqual(self.zero_date,
+            When(parse_date='１９７２-01-31').datetime)
+
+        # errors are the same as strptime's
+        for value in ['1972-13-01', '1972-02-30', '+972-01-31',
+                '1972-01-31 ']:
+            with self.assertRaises(ValueError) as expected:
+                datetime.strptime(value, '%Y-%m-%d')
+
+            with self.assertRaises(ValueError) as actual:
+                When(parse_date=value)
+
+            self.assertEqual(str(expected.exception), str(actual.exception))
+
+        with self.assertRaises(KeyError):
+            When(parse_nothing='1972-01-31')
+
+        # a replaced built-in format is honoured
+        original = When.parse_formats['date']
+        When.parse_formats['date'] = '%d/%m/%Y'
+        try:
+            self.assertEqual(self.zero_date,
+                When(parse_date='31/01/1972').datetime)
+        finally:
+            When.parse_formats['date'] = original
+
+
+class TestZoneTable(TestCase):
+    zones = ['America/Toronto', 'Europe/London', 'Asia/Kolkata',
+        'Australia/Lord_Howe', 'America/St_Johns']
+
+    def test_utc(self):
+        table = ZoneTable.get('UTC')
+        self.assertIs(table, ZoneTable.get('UTC'))
+        rand = random.Random(42)
+        for _ in range(1000):
+            epoch = rand.randint(-5000000000, 5000000000)
+            d = table.from_epoch(epoch)
+            self.assertEqual(calendar.timegm(d.timetuple()), epoch)
+            self.assertEqual(epoch, table.to_epoch(d))
+
+        self.assertEqual(datetime(1970, 1, 1, 0, 0, 1, 500000),
+            table.from_epoch(1.5))
+
+    def test_zones(self):
+        from zoneinfo import ZoneInfo
+
+        rand = random.Random(42)
+        for name in self.zones:
+            table = ZoneTable.get(ZoneInfo(name))
+            self.assertIs(table, ZoneTable.get(name))
+            zone = ZoneInfo(name)
+            for _ in range(2000):
+                # includes instants outside of the table's range
+                epoch = rand.randint(-3000000000, 5000000000)
+                expected = datetime.fromtimestamp(epoch, zone)
+                self.assertEqual(expected.replace(tzinfo=None),
+                    table.from_epoch(epoch))
+
+                # wall clock times, including ones near transitions
+                wall = expected.replace(tzinfo=None) + timedelta(
+                    minutes=rand.choice([0, 15, 30, 45, 60]))
+                self.assertEqual(int(wall.replace(tzinfo=zone).timestamp()),
+                    table.to_epoch(wall), '%s %s' % (name, wall))
+
+            # every transition, both sides of it in wall clock time
+            transitions = [transition for index in range(len(table._spans))
+                for transition in table._span(index)[0]]
+            self.assertTrue(transitions)
+            for transition in transitions:
+                for delta in [-3601, -1800, -1, 0, 1, 1800, 3600]:
+                    wall = datetime.fromtimestamp(transition + delta,
+                        zone).replace(tzinfo=None, fold=0)
+                    self.assertEqual(
+                        int(wall.replace(tzinfo=zone).timestamp()),
+                        table.to_epoch(wall), '%s %s' % (name, wall))
+
+        with self.assertRaises(TypeError):
+            ZoneTable.get(3)
+
+    def test_batch(self):
+        table = ZoneTable.get('America/Toronto')
+        epochs = [0, 65732100, 1699171200]
+        dates = table.from_epochs(epochs)
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), dates[1])
+        self.assertEqual(array('q', epochs), table.to_epochs(dates))
+
+        whens = WhenArray.from_datetimes(dates)
+        self.assertEqual(array('q', epochs), whens.epochs('America/Toronto'))
+        self.assertEqual(array('q', [e * 1000 for e in epochs]),
+            whens.milli_epochs('America/Toronto'))
+
+    def test_lazy(self):
+        # only the span of the converted instant is built
+        table = ZoneTable('America/Toronto')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55),
+            table.from_epoch(65732100))
+        self.assertEqual(1, sum(span is not None for span in table._spans))
+
+        warmup(zones=['America/Toronto'])
+        self.assertNotIn(None, ZoneTable.get('America/Toronto')._spans)
+
+        # transitions within a day of a span's ends whose wall clock times
+        # fall in the neighbouring span
+        first = _TABLE_START + _SPAN
+        second = first + _SPAN
+        changes = [(first - 1800, 7200, 0),
+            (first + 1000 * 86400, 0, -10800),
+            (second + 1800, -10800, -7200)]
+
+        class Shifted(ZoneTable):
+            def _offset(self, epoch):
+                offset = 7200
+                for transition, _, after in changes:
+                    if epoch >= transition:
+                        offset = after
+
+                return offset
+
+        table = Shifted('America/Toronto')
+        for boundary in [first, second]:
+            for delta in range(-3 * 3600, 3 * 3600, 600):
+                epoch = boundary + delta
+                self.assertEqual(table._offset(epoch), table.utc_offset(epoch))
+
+                # ambiguous and skipped times use the earlier offset
+                expected = 7200
+                for transition, before, after in changes:
+                    if epoch >= transition + max(before, after):
+                        expected = after
+
+                self.assertEqual(expected, table.wall_offset(epoch), delta)
+
+    def test_when(self):
+        # independent of the host's time zone
+        when = When(epoch=65732100, tz='America/Toronto')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+        self.assertEqual(65732100, when.epoch)
+        self.assertEqual('America/Toronto', when.tz)
+
+        when = When(datetime=datetime(1972, 1, 31, 18, 55), tz='UTC')
+        self.assertEqual(65732100, when.epoch)
+        self.assertEqual(65732100000, when.milli_epoch)
+
+        when = When(milli_epoch=65732100123, tz='UTC')
+        self.assertEqual(datetime(1972, 1, 31, 18, 55, 0, 123000),
+            when.datetime)
+
+
+class TestSubSecondEpochs(TestCase):
+    units = [('milli_epoch', 'ms', 1000), ('micro_epoch', 'us', 1000000),
+        ('nano_epoch', 'ns', 1000000000)]
+
+    def test_round_trip(self):
+        epoch = datetime(1970, 1, 1)
+        rand = random.Random(42)
+        for _ in range(2000):
+            micros = rand.randint(-5000000000000000, 5000000000000000)
+            for name, _, per_second in self.units:
+                value = micros * per_second // 1000000
+                when = When(tz='UTC', **{name: value})
+                self.assertEqual(value, getattr(when, name))
+
+                step = max(1, 1000000 // per_second)
+                self.assertEqual(epoch + timedelta(
+                    microseconds=micros // step * step), when.datetime)
+
+        # nanoseconds below a microsecond are dropped
+        when = When(nano_epoch=1500000999, tz='UTC')
+        self.assertEqual(datetime(1970, 1, 1, 0, 0, 1, 500000),
+            when.datetime)
+        self.assertEqual(1500000000, when.nano_epoch)
+
+        # negative values floor rather than truncate
+        when = When(milli_epoch=-1, tz='UTC')
+        self.assertEqual(datetime(1969, 12, 31, 23, 59, 59, 999000),
+            when.datetime)
+
+    def test_zone(self):
+        from zoneinfo import ZoneInfo
+        zone = ZoneInfo('America/Toronto')
+
+        rand = random.Random(42)
+        for _ in range(2000):
+            micro_epoch = rand.randint(-2000000000000000, 4000000000000000)
+            expected = datetime.fromtimestamp(micro_epoch // 1000000,
+                zone).replace(tzinfo=None, microsecond=micro_epoch % 1000000)
+            when = When(micro_epoch=micro_epoch, tz='America/Toronto')
+            self.assertEqual(expected, when.datetime)
+            self.assertEqual(micro_epoch // 1000 // 1000 * 1000 +
+                micro_epoch % 1000000 // 1000,
+                When(milli_epoch=micro_epoch // 1000,
+                tz='America/Toronto').milli_epoch)
+
+    def test_compact(self):
+        when = When(micro_epoch=65732100123456, tz='UTC')
+        compact = CompactWhen.from_when(when)
+        self.assertEqual(65732100123, when.milli_epoch)
+        self.assertEqual(65732100123456000, when.nano_epoch)
+
+        # CompactWhen converts to local time, keeping the instant
+        self.assertEqual(when.milli_epoch, compact.milli_epoch)
+        self.assertEqual(when.micro_epoch, compact.micro_epoch)
+        self.assertEqual(when.nano_epoch, compact.nano_epoch)
+
+    def test_array(self):
+        rand = random.Random(42)
+        micros = [rand.randint(-2000000000000000, 4000000000000000)
+            for _ in range(1000)]
+        for tz in ['UTC', 'America/Toronto']:
+            for name, unit, per_second in self.units:
+                values = [m * per_second // 1000000 for m in micros]
+                whens = WhenArray.from_epochs(values, unit, tz)
+                self.assertEqual(array('q', values), whens.epochs(tz, unit))
+
+                expected = [When(tz=tz, **{name: v}).datetime
+                    for v in values[:50]]
+                self.assertEqual(expected, [w.datetime for w in whens[:50]])
+
+        whens = WhenArray.from_epochs([0, 1, 2], tz='UTC')
+        self.assertEqual(array('q', [0, 1000000, 2000000]), whens.micros)
+        self.assertEqual(array('q', [0, 1000, 2000]),
+            whens.milli_epochs('UTC'))
+
+        with self.assertRaises(ValueError):
+            WhenArray.from_epochs([0], 'fortnights')
+
+
+class TestTimeZones(TestCase):
+    def test_parse_offsets(self):
+        when = When(detect='1972-01-31T13:55:00+05:30')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+        self.assertEqual('UTC+05:30', when.tz)
+        self.assertEqual(calendar.timegm((1972, 1, 31, 8, 25, 0)), when.epoch)
+        self.assertEqual(timezone(timedelta(hours=5, minutes=30)),
+            when.tzinfo)
+        self.assertEqual('1972-01-31T13:55:00+05:30', when.string.iso_offset)
+        self.assertEqual('1972-01-31T08:25:00Z',
+            when.string.datetime_sec_utc)
+
+        # strings ending in Z are UTC
+        whens = [When(detect='1972-01-31T13:55Z'),
+            When(detect='1972-01-31T13:55:00Z'),
+            When(detect='1972-01-31T13:55:00.00Z'),
+            When(parse_iso_micro='1972-01-31T13:55:00.00Z'),
+            When(parse_iso_offset='1972-01-31T13:55:00Z')]
+        for when in whens:
+            self.assertEqual('UTC', when.tz)
+            self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+            self.assertEqual(calendar.timegm((1972, 1, 31, 13, 55, 0)),
+                when.epoch)
+
+        when = When(parse_iso_micro_offset='1972-01-31T13:55:00.25-03:30')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55, 0, 250000),
+            when.datetime)
+        self.assertEqual('UTC-03:30', when.tz)
+        self.assertEqual('1972-01-31T13:55:00.250000-03:30',
+            when.string.iso_micro_offset)
+        when = When(parse_iso_micro_offset='1972-01-31T17:25:00.25Z')
+        self.assertEqual('1972-01-31T17:25:00.250000+00:00',
+            when.string.iso_micro_offset)
+
+        # given a tz, the instant is converted to its wall clock time
+        when = When(detect='1972-01-31T18:55:00Z', tz='America/Toronto')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+        self.assertEqual('America/Toronto', when.tz)
+        when = When(parse_iso_offset='1972-01-31T20:55:00+02:00',
+            tz='America/Toronto')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+        self.assertEqual('1972-01-31T13:55:00-05:00', when.string.iso_offset)
+        self.assertEqual('1972-01-31T18:55:00.0Z', when.string.iso_micro)
+
+        # the fast parsers agree with strptime, lenient input still parses
+        rand = random.Random(42)
+        for _ in range(500):
+            d = datetime(rand.randint(1000, 9999), rand.randint(1, 12),
+                rand.randint(1, 28), rand.randint(0, 23), rand.randint(0, 59),
+                rand.randint(0, 59), rand.choice([0, 5, 500000, 123456]))
+            offset = rand.randint(-23 * 60, 23 * 60) * 60
+            zone = timezone(timedelta(seconds=offset))
+            aware = d.replace(tzinfo=zone)
+            for name in ['iso_offset', 'iso_micro_offset']:
+                string = getattr(When(datetime=aware).string, name)
+                pattern = When.parse_formats[name]
+                self.assertEqual(datetime.strptime(string, pattern),
+                    _parser(pattern)(string))
+                self.assertEqual(aware if name == 'iso_micro_offset' else
+                    aware.replace(microsecond=0), _parser(pattern)(string))
+
+        self.assertEqual(datetime(1972, 1, 31, 13, 55, tzinfo=timezone(
+            timedelta(hours=1))), _parser(When.parse_formats['iso_offset'])(
+            '1972-01-31T13:55:00+0100'))
+        with self.assertRaises(ValueError):
+            When(parse_iso_offset='1972-01-31T13:55:00')
+
+    def test_aware(self):
+        from zoneinfo import ZoneInfo
+        zone = ZoneInfo('Europe/London')
+
+        aware = datetime(1972, 6, 30, 13, 55, 0, 5, tzinfo=zone)
+        when = When(datetime=aware)
+        self.assertEqual('Europe/London', when.tz)
+        self.assertIs(zone, when.tzinfo)
+        self.assertEqual(aware, when.aware)
+        self.assertEqual(int(aware.timestamp()), when.epoch)
+
+        other = when.astimezone('Asia/Kolkata')
+        self.assertEqual(aware.astimezone(ZoneInfo('Asia/Kolkata')
+            ).replace(tzinfo=None), other.datetime)
+        self.assertEqual(when.micro_epoch, other.micro_epoch)
+        self.assertEqual(aware, other.aware)
+
+        fixed = When(datetime=datetime(1972, 1, 31), tz=timezone(
+            timedelta(hours=-2)))
+        self.assertEqual('1972-01-31T00:00:00-02:00', fixed.string.iso_offset)
+        self.assertEqual(calendar.timegm((1972, 1, 31, 2, 0, 0)),
+            fixed.epoch)
+
+        # no tz means local time
+        when = When(datetime=datetime(1972, 1, 31, 13, 55))
+        self.assertIsNone(when.tzinfo)
+        self.assertEqual(when.epoch, int(when.aware.timestamp()))
+
+        with self.assertRaises(TimeOnlyError):
+            When(time=time(13, 55)).aware
+
+        with self.assertRaises(TimeOnlyError):
+            When(time=time(13, 55)).astimezone('UTC')
+
+        rand = random.Random(42)
+        names = ['America/Toronto', 'Australia/Lord_Howe', 'UTC',
+            'America/St_Johns']
+        for _ in range(1000):
+            epoch = rand.randint(-2000000000, 4000000000)
+            source, target = rand.choice(names), rand.choice(names)
+            when = When(epoch=epoch, tz=source).astimezone(target)
+            self.assertEqual(datetime.fromtimestamp(epoch, ZoneInfo(target)
+                ).replace(tzinfo=None), when.datetime)
+
+    def test_zone_table(self):
+        table = ZoneTable.get(timezone(timedelta(hours=5, minutes=30)))
+        self.assertIs(table, ZoneTable.get('UTC+05:30'))
+        self.assertEqual(19800, table.utc_offset(0))
+        self.assertEqual(datetime(1970, 1, 1, 5, 30), table.from_epoch(0))
+        self.assertEqual(0, table.to_epoch(datetime(1970, 1, 1, 5, 30)))
+
+        table = ZoneTable.get('UTC-00:00:30')
+        self.assertEqual(-30, table.utc_offset(0))
+        self.assertIs(ZoneTable.get('UTC'), ZoneTable.get(timezone.utc))
+
+    def test_bulk(self):
+        values = ['1972-01-31T13:55:00+05:30', '1972-01-31T13:55:00Z',
+            '1972-01-31T13:55:00.5-01:00', '1972-01-31 13:55', 'bad']
+        expected = [calendar.timegm((1972, 1, 31, 8, 25, 0)),
+            calendar.timegm((1972, 1, 31, 13, 55, 0)),
+            calendar.timegm((1972, 1, 31, 14, 55, 0)),
+            When(datetime=datetime(1972, 1, 31, 13, 55)).epoch, 0]
+
+        epochs, errors = When.detect_many(values, 'epoch')
+        self.assertEqual(array('q', expected), epochs)
+        self.assertEqual([4], [index for index, _ in errors])
+
+        whens, _ = When.detect_many(values, 'when')
+        self.assertEqual(expected[:4], [w.epoch for w in whens[:4]])
+        self.assertEqual(['UTC+05:30', 'UTC', 'UTC-01:00', None],
+            [w.tz for w in whens[:4]])
+
+        # datetime output is aware for offsets only
+        results, _ = When.detect_many(values)
+        self.assertEqual([True, False, True, False],
+            [r.tzinfo is not None for r in results[:4]])
+
+        strings = When.format_many(whens[:3], 'iso_micro')
+        self.assertEqual(['1972-01-31T08:25:00.0Z', '1972-01-31T13:55:00.0Z',
+            '1972-01-31T14:55:00.500000Z'], strings)
+
+        lines = normalize_lines(['1972-01-31T13:55:00+05:30\n'])
+        self.assertEqual(['1972-01-31T08:25:00.0Z\n'], list(lines))
+
+        # a trailing Z is UTC, whatever the host's time zone
+        for name in [None, 'datetime_sec_utc']:
+            lines = normalize_lines(['2020-01-01T00:00:00Z\n'], 'iso_offset',
+                name)
+            self.assertEqual(['2020-01-01T00:00:00+00:00\n'], list(lines))
+
+        from zoneinfo import ZoneInfo
+        rand = random.Random(42)
+        epochs = [rand.randint(-2000000000, 4000000000) for _ in range(1000)]
+        whens = WhenArray.from_epochs(epochs, tz='America/Toronto')
+        converted = whens.convert('America/Toronto', 'Asia/Kolkata')
+        self.assertEqual([datetime.fromtimestamp(e, ZoneInfo('Asia/Kolkata')
+            ).replace(tzinfo=None) for e in epochs],
+            [w.datetime for w in converted])
+        self.assertEqual(array('q', epochs), converted.epochs('Asia/Kolkata'))
+
+
+class TestStartup(TestCase):
+    def test_lazy_imports(self):
+        # importing when and parsing canonical strings doesn't load the
+        # optional modules, lenient ones only need re, never strptime
+        modules = ['argparse', 'csv', 'mmap', 'numpy', 'pickle', 're',
+            'struct', 'threading', 'zoneinfo', '_strptime']
+        code = ('import sys, when; '
+            'when.When(detect="1972-01-31T13:55:07.5Z").epoch; '
+            'when.When(parse_date="1972-01-31").string.iso_micro; '
+            'when.When(parse_iso8601="1972-01-31T13:55:07,5+05"); '
+            'print(" ".join(m for m in %r if m in sys.modules) + "|"); '
+            'when.When(detect="1972-1-31 13:55"); '
+            'when.When(parse_datetime_sec="1972-01-31 1:55:07"); '
+            'print(" ".join(m for m in %r if m in sys.modules))') % (
+            modules, modules)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-S', '-c', code],
+            cwd=root, env=dict(os.environ, PYTHONPATH=root))
+        self.assertEqual([b'|', b're'], output.split())
+
+    def test_warmup(self):
+        class Custom(When):
+            parse_formats = dict(When.parse_formats,
+                slashed='%d/%m/%Y %H:%M')
+
+        ZoneTable._tables.pop('America/Halifax', None)
+        warmup(zones=['America/Halifax'], cls=Custom)
+        self.assertIn('America/Halifax', ZoneTable._tables)
+
+        # the lenient fallback parsers work after being compiled ahead
+        self.assertEqual(datetime(1972, 1, 31, 13, 55),
+            Custom(detect='1972-1-31 13:55').datetime)
+        self.assertEqual(datetime(1972, 1, 31, 13, 55),
+            Custom(parse_slashed='31/01/1972 13:55').datetime)
+        self.assertEqual('31/01/1972 13:55',
+            Custom(parse_slashed='31/01/1972 13:55').string.slashed)
+
+
+class TestISO8601(TestCase):
+    def test_variants(self):
+        utc = '1972-01-31T18:55:07.123456Z'
+        for value in ['1972-01-31T13:55:07.123456-05:00',
+                '1972-01-31t18:55:07.123456z',
+                '1972-01-31 18:55:07.123456+00:00',
+                '1972-01-31T13:55:07,123456-05:00',
+                '1972-01-31T13:55:07.123456789-0500',
+                '1972-01-31T13:55:07.1234567-05',
+                '1972-01-31T18:55:07.1234569Z']:
+            for when in [When(parse_iso8601=value), When(detect=value)]:
+                self.assertEqual(utc, when.string.iso_micro, value)
+
+        when = When(parse_iso8601='1972-01-31T13:55:07.5+05:30')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55, 7, 500000),
+            when.datetime)
+        self.assertEqual('UTC+05:30', when.tz)
+        self.assertEqual('1972-01-31T13:55:07.500000+05:30',
+            when.string.iso_micro_offset)
+
+        # no seconds, no offset
+        when = When(detect='1972-01-31T13:55')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+        self.assertIsNone(when.tz)
+        when = When(parse_iso8601='1972-01-31 13:55+01:00', tz='UTC')
+        self.assertEqual(datetime(1972, 1, 31, 12, 55), when.datetime)
+
+        # the built-in formats still take precedence
+        when = When(detect='1972-01-31 13:55')
+        self.assertEqual(datetime(1972, 1, 31, 13, 55), when.datetime)
+
+    def test_errors(self):
+        for value in ['1972-01-31', '1972-1-31T13:55:07Z',
+                '1972-01-31T13:55:07.Z', '1972-01-31T13:55.5',
+                '1972-01-31T13:55:07+5', '1972-01-31T13:55:07+05x30',
+                '1972-01-31T13:55:60Z', '1972-01-31T13:55:07Q', '',
+                '2020-01-01T00:00+05:99', '2020-01-01T00:00:00+0560',
+                '2020-01-01T00:00:00-24', '2020-01-01T00:00:00+2a:00']:
+            with self.assertRaises(ValueError):
+                When(parse_iso8601=value)
+
+        for value in ['1972-01-31T13:55:07+05x30', '2020-01-01T00:00+05:99']:
+            with self.assertRaises(ValueError):
+                When(detect=value)
+
+    def test_bulk(self):
+        values = ['1972-01-31T13:55:07.123456789-05:00', 'bad',
+            b'1972-01-31T18:55:07Z']
+        results, errors = When.parse_many(values, 'iso8601', output='epoch')
+        expected = When(datetime=datetime(1972, 1, 31, 18, 55, 7),
+            tz='UTC').epoch
+        self.assertEqual(array('q', [expected, 0, expected]), results)
+        self.assertEqual([1], [index for index, e in errors])
+
+        results, errors = When.detect_many(values[:1])
+        self.assertEqual(timedelta(hours=-5), results[0].utcoffset())
+
+        lines = list(normalize_lines(['1972-01-31T13:55:07,5-05:00\n'],
+            name='iso8601'))
+        self.assertEqual(['1972-01-31T18:55:07.500000Z\n'], lines)
+
+
+class TestBinaryEncoding(TestCase):
+    def assert_same(self, expected, when):
+        self.assertEqual(expected.datetime, when.datetime)
+        self.assertEqual(expected.time, when.time)
+        self.assertEqual(expected.tz, when.tz)
+        if expected.datetime is not None:
+            self.assertEqual(expected.micro_epoch, when.micro_epoch)
+
+    def test_when(self):
+        whens = [When(datetime=datetime(1972, 1, 31, 13, 55, 7, 123456)),
+            When(datetime=datetime(1912, 1, 31)),
+            When(datetime=datetime(1972, 1, 31, 13, 55), tz='America/Toronto'),
+            When(parse_iso_offset='1972-01-31T13:55:07+05:30'),
+            When(epoch=65732107, tz='UTC'),
+            # both sides of the repeated hour when daylight saving ends
+            When(epoch=1604208600, tz='America/Toronto'),
+            When(micro_epoch=1604212200000001, tz='America/Toronto'),
+            When(time=time(13, 55, 7))]
+        for when in whens:
+            data = when.to_bytes()
+            self.assertIsInstance(data, bytes)
+            self.assert_same(when, When.from_bytes(data))
+            self.assert_same(when, When.from_bytes(bytearray(data)))
+
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(when, protocol))
+                self.assertIs(When, type(copy))
+                self.assert_same(when, copy)
+
+        self.assertLessEqual(len(whens[0].to_bytes()), 9)
+        self.assertEqual(b'\x01\x00', When(time=time()).to_bytes())
+
+        for data in [b'', b'\x04\x00', b'\x00\x80', b'\x00\x00\x00',
+                b'\x02\x00\x05UTC', b'\x02\x00\x01\xff']:
+            with self.assertRaises(ValueError):
+                When.from_bytes(data)
+
+    def test_array(self):
+        start = 65732107123456
+        values = [start + i * 1000003 for i in range(1000)]
+        for array_ in [WhenArray(values), WhenArray(values[::-1]),
+                WhenArray([start, -start, 0, 1, -1]),
+                WhenArray([0, 3600000000], time_only=True), WhenArray()]:
+            data = array_.to_bytes()
+            result = WhenArray.from_bytes(data)
+            self.assertEqual(list(array_.micros), list(result.micros))
+            self.assertEqual(array_.time_only, result.time_only)
+            self.assertEqual(list(array_.micros),
+                list(WhenArray.from_bytes(memoryview(data)).micros))
+
+        # sorted values a second apart take 4 bytes each
+        self.assertLess(len(WhenArray(values).to_bytes()), 4 * len(values) +
+            16)
+
+        data = WhenArray(values).to_bytes()
+        for bad in [b'', b'\x04\x00', b'\x00\x05\x00', data[:-1],
+                data + b'\x00']:
+            with self.assertRaises(ValueError):
+                WhenArray.from_bytes(bad)
+
+
+class TestThreads(TestCase):
+    def test_concurrent_detect(self):
+        values = ['1972-01-31', '1972-01-31 13:55', '1972-1-31 13:55:07',
+            '1972-01-31T13:55:07.123456Z', '1972-01-31T13:55:07+05:30',
+            '1972-01-31T13:55:07,123456789Z', '13:55', 'bad'] * 50
+        expected = When.detect_many(values)
+        expected = (expected[0], [i for i, _ in expected[1]])
+
+        def detect(_):
+            results, errors = When.detect_many(values)
+            return results, [i for i, _ in errors]
+
+        # registering formats while other threads detect
+        def register(_):
+            for i in range(50):
+                When.register_format('threaded%d' % i, '%Y/%m/%d')
+                When.unregister_format('threaded%d' % i)
+
+        with ThreadPoolExecutor(8) as executor:
+            registering = executor.submit(register, None)
+            results = list(executor.map(detect, range(16)))
+            registering.result()
+
+        for result in results:
+            self.assertEqual(expected, result)
+
+        self.assertNotIn('threaded0', When.parse_formats)
+
+    def test_concurrent_fallback(self):
+        # strings that fall through the shapes to the loop over every format
+        values = ['1972-1-31 13:55:07', '1972-01-31 13:55'] * 100
+        expected = [When(detect=value).epoch for value in values]
+
+        def detect(_):
+            for _ in range(5):
+                with self.assertRaises(ValueError):
+                    When(detect='bad')
+
+            return [When(detect=value).epoch for value in values]
+
+        def register(_):
+            for i in range(200):
+                When.register_format('fallback%d' % i, '%Y/%m/%d')
+                When.unregister_format('fallback%d' % i)
+
+        with ThreadPoolExecutor(8) as executor:
+            registering = executor.submit(register, None)
+            results = list(executor.map(detect, range(16)))
+            registering.result()
+
+        for result in results:
+            self.assertEqual(expected, result)
+
+
+class TestBulk(TestCase):
+    def setUp(self):
+        self.full_date = datetime(1972, 1, 31, 13, 55)
+        self.values = ['1972-01-31 13:55', 'abc', b'1972-01-31 13:55', None]
+
+    def assert_errors(self, errors):
+        self.assertEqual([1, 3], [index for index, e in errors])
+        self.assertIsInstance(errors[0][1], ValueError)
+        self.assertIsInstance(errors[1][1], TypeError)
+
+    def test_parse_many(self):
+        results, errors = When.parse_many(iter(self.values), 'datetime')
+        self.assertEqual([self.full_date, None, self.full_date, None],
+            results)
+        self.assert_errors(errors)
+
+        results, errors = When.detect_many(self.values)
+        self.assertEqual([self.full_date, None, self.full_date, None],
+            results)
+        self.assert_errors(errors)
+
+        results, errors = When.parse_many(['13:55', '13:55:00'], 'time')
+        self.assertEqual([time(13, 55), time(13, 55)], results)
+        self.assertEqual([], errors)
+
+        results, errors = When.parse_many(self.values, output='when')
+        self.assertEqual(self.full_date, results[0].datetime)
+        self.assertEqual(None, results[1])
+
+        results, errors = When.parse_many(['13:55'], 'time', output='when')
+        self.assertEqual(time(13, 55), results[0].time)
+
+        results, errors = When.detect_many(self.values, output='epoch')
+        self.assertIsInstance(results, array)
+        self.assertEqual(When(datetime=self.full_date).epoch, results[0])
+        self.assertEqual(0, results[1])
+        self.assert_errors(errors)
+
+        # errors
+        with self.assertRaises(KeyError):
+            When.parse_many(self.values, 'nothing')
+
+        with self.assertRaises(ValueError):
+            When.parse_many(self.values, output='nothing')
+
+        with self.assertRaises(TimeOnlyError):
+            When.parse_many(self.values, 'time_sec', output='epoch')
+
+    @skipUnless(numpy, 'NumPy not installed')
+    def test_parse_many_numpy(self):
+        values = numpy.array(['1972-01-31 13:55', 'abc'])
+        results, errors = When.parse_many(values, output='datetime64')
+        self.assertEqual(numpy.datetime64('1972-01-31T13:55', 'us'),
+            results[0])
+        self.assertTrue(numpy.isnat(results[1]))
+        self.assertEqual([1], [index for index, e in errors])
+
+        values = numpy.array([b'1972-01-31 13:55'])
+        results, errors = When.parse_many(values, 'datetime')
+        self.assertEqual([self.full_date], results)
+
+
+class TestBytesParsing(TestCase):
+    full_date = datetime(1972, 1, 31, 13, 55, 7)
+    data = (b'1972-01-31 13:55:07\r\n'
+        b'bad\n'
+        b'\xff\n'
+        b'1972-01-31T13:55:07Z\n')
+
+    def test_keywords(self):
+        raw = b'1972-01-31 13:55:07'
+        for value in [raw, bytearray(raw), memoryview(raw)]:
+            self.assertEqual(self.full_date, When(detect=value).datetime)
+            self.assertEqual(self.full_date,
+                When(parse_datetime_sec=value).datetime)
+
+        when = When(detect=b'1972-01-31T13:55:07Z')
+        self.assertEqual('UTC', when.tz)
+        self.assertEqual(time(13, 55), When(parse_time=b'13:55').time)
+
+        with self.assertRaises(ValueError):
+            When(detect=b'\xff')
+
+        results, errors = When.parse_many([bytearray(b'13:55'),
+            memoryview(b'13:55')], 'time')
+        self.assertEqual([time(13, 55), time(13, 55)], results)
+        self.assertEqual([], errors)
+
+    def test_from_buffer(self):
+        record = b'id=7 at 1972-01-31 13:55:07 ok'
+        for buffer in [record, bytearray(record), memoryview(record)]:
+            when = When.from_buffer(buffer, 8, 19)
+            self.assertEqual(self.full_date, when.datetime)
+
+        when = When.from_buffer(record, 8, 10, 'date')
+        self.assertEqual(datetime(1972, 1, 31), when.datetime)
+
+        when = When.from_buffer(record[8:27], tz='America/Toronto')
+        self.assertEqual(self.full_date, when.datetime)
+        self.assertEqual('America/Toronto', when.tz)
+
+        with self.assertRaises(ValueError):
+            When.from_buffer(record, 0, 19)
+
+        with self.assertRaises(ValueError):
+            When.from_buffer(record, 8, 19, 'date')
+
+    def test_scan_buffer(self):
+        results, errors = When.scan_buffer(self.data)
+        self.assertEqual([self.full_date, None, None, self.full_date],
+            results)
+        self.assertEqual([1, 2], [index for index, e in errors])
+
+        # matches parse_many on the decoded lines
+        lines = ['1972-01-31 13:55:07', 'bad', '\ufffd',
+            '1972-01-31T13:55:07Z']
+        for output in ['when', 'epoch']:
+            expected, _ = When.detect_many(lines, output=output)
+            results, _ = When.scan_buffer(bytearray(self.data), output=output)
+            if output == 'when':
+                results = [r and r.datetime for r in results]
+                expected = [e and e.datetime for e in expected]
+
+            self.assertEqual(expected, results)
+
+        # fixed width records, last line without an ending
+        data = memoryview(b'a 1972-01-31 x\nb 19xx-01-31 y\nc 1973-01-31')
+        results, errors = When.scan_buffer(data, 'date', offset=2,
+            length=10)
+        self.assertEqual([datetime(1972, 1, 31), None,
+            datetime(1973, 1, 31)], results)
+        self.assertEqual([1], [index for index, e in errors])
+
+        self.assertEqual(([], []), When.scan_buffer(b''))
+
+    def test_scan_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'times.log')
+            with open(path, 'wb') as f:
+                f.write(self.data)
+
+            self.assertEqual(When.scan_buffer(self.data, output='epoch')[0],
+                When.scan_file(path, output='epoch')[0])
+
+            # the mapping is closed, the file can be replaced
+            with open(path, 'wb') as f:
+                pass
+
+            self.assertEqual(([], []), When.scan_file(path))
+
+
+class TestStreaming(TestCase):
+    def test_lines(self):
+        lines = iter(['1972-01-31 13:55\n', '1972-01-31T13:55:00.5Z\n'])
+        result = normalize_lines(lines, 'datetime_sec_utc')
+        self.assertEqual('1972-01-31T13:55:00Z\n', next(result))
+        self.assertEqual('1972-01-31T13:55:00Z\n', next(result))
+
+        lines = ['1972-01-31', 'abc', '1972-01-31 13:55']
+        result = list(normalize_lines(lines, 'date', name='date',
+            errors='keep'))
+        self.assertEqual(['1972-01-31\n', 'abc\n', '1972-01-31 13:55\n'],
+            result)
+
+        result = list(normalize_lines(lines, 'date', errors='skip'))
+        self.assertEqual(['1972-01-31\n', '1972-01-31\n'], result)
+
+        with self.assertRaises(ValueError) as cm:
+            list(normalize_lines(lines))
+
+        self.assertTrue(str(cm.exception).startswith('line 2:'))
+
+        with self.assertRaises(ValueError):
+            list(normalize_lines(lines, errors='nothing'))
+
+    def test_csv(self):
+        lines = ['id,when\n', '1,1972-01-31 13:55\n', '2,"1972-01-31"\n',
+            '3,bad\n']
+        result = list(normalize_lines(lines, 'datetime_utc', column='when',
+            errors='skip'))
+        self.assertEqual(['id,when\n', '1,1972-01-31T13:55Z\n',
+            '2,1972-01-31T00:00Z\n'], result)
+
+        result = list(normalize_lines(lines[1:], 'date', column=1,
+            errors='keep'))
+        self.assertEqual(['1,1972-01-31\n', '2,1972-01-31\n', '3,bad\n'],
+            result)
+
+        result = list(normalize_lines(['1972-01-31 13:55|x\n'], 'date',
+            delimiter='|'))
+        self.assertEqual(['1972-01-31|x\n'], result)
+
+        with self.assertRaises(ValueError) as cm:
+            list(normalize_lines(lines, column=1, header=True))
+
+        self.assertTrue(str(cm.exception).startswith('line 4:'))
+
+        with self.assertRaises(ValueError):
+            list(normalize_lines(lines, column='nothing'))
+
+    def test_file_and_main(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'data.csv')
+            with open(path, 'w') as f:
+                f.write('when,id\n1972-01-31 13:55,1\n')
+
+            self.assertEqual(['when,id\n', '1972-01-31,1\n'],
+                list(normalize_file(path, 'date', header=True)))
+
+            out = io.StringIO()
+            with redirect_stdout(out):
+                main(['-c', 'when', '-o', 'time', path])
+
+            self.assertEqual('when,id\n13:55,1\n', out.getvalue())
+
+
+class TestParseCache(TestCase):
+    def tearDown(self):
+        When.parse_cache = None
+
+    def test_cache(self):
+        When.parse_cache = cache = ParseCache(capacity=2)
+        full_date = datetime(1972, 1, 31, 13, 55)
+
+        w1 = When(detect='1972-01-31 13:55')
+        w2 = When(detect='1972-01-31 13:55')
+        self.assertEqual(full_date, w2.datetime)
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1,
+            'capacity': 2}, cache.stats())
+
+        # changing one When doesn't affect the others or the cache
+        w1._datetime = datetime(2000, 1, 1)
+        self.assertEqual(full_date, w2.datetime)
+        self.assertEqual(full_date, When(detect='1972-01-31 13:55').datetime)
+
+        # format is part of the key
+        self.assertEqual(full_date,
+            When(parse_datetime='1972-01-31 13:55').datetime)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(time(13, 55), When(parse_time='13:55').time)
+        self.assertEqual(time(13, 55), When(parse_time='13:55').time)
+
+        # least recently used is evicted
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3, cache.hits)
+        When(parse_datetime='1972-01-31 13:55')
+        When(detect='1972-01-31 13:55')
+        self.assertEqual(4, cache.hits)
+        self.assertEqual(2, cache.evictions)
+        When(parse_time='13:55')
+        self.assertEqual(4, cache.hits)
+
+        # errors aren't cached
+        with self.assertRaises(ValueError):
+            When(detect='abc')
+
+        with self.assertRaises(ValueError):
+            When(detect='abc')
+
+        self.assertEqual(2, len(cache))
+
+        # bulk parsing uses the cache too
+        When.parse_many(['13:55'], 'time')
+        self.assertEqual(5, cache.hits)
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.hits)
+
+    def test_fifo(self):
+        cache = ParseCache(capacity=2, policy='fifo')
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(2, cache.get('b'))
+
+        cache = ParseCache(capacity=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+
+        with self.assertRaises(ValueError):
+            ParseCache(capacity=0)
+
+        with self.assertRaises(ValueError):
+            ParseCache(policy='nothing')
+
+
+class TestParseStats(TestCase):
+    def tearDown(self):
+        When.parse_stats = None
+        When.parse_cache = None
+
+    def test_stats(self):
+        calls = []
+        When.parse_stats = stats = ParseStats(hook=lambda *args:
+            calls.append(args))
+
+        When(detect='1972-01-31')
+        When(detect='1972-01-31T13:55:00+05:30')
+        When(detect='1972-1-31 13:55')
+        When(parse_datetime='1972-01-31 13:55')
+        When(parse_time='13:55')
+        with self.assertRaises(ValueError):
+            When(detect='abc')
+        with self.assertRaises(ValueError):
+            When(parse_date='abc')
+
+        # every format and the iso8601 parser
+        tried = len(When.parse_formats) + 1
+        self.assertEqual({
+            'parses': {'date': 1, 'iso_offset': 1, 'datetime': 2, 'time': 1},
+            'errors': {'detect': 1, 'date': 1},
+            'detect_depths': {1: 2, 5: 1, tried: 1},
+            'seconds': {},
+        }, stats.snapshot())
+
+        self.assertEqual(7, len(calls))
+        self.assertEqual(('1972-1-31 13:55', 'datetime', 5, None, None),
+            calls[2])
+        value, name, depth, seconds, error = calls[5]
+        self.assertEqual(('abc', None, tried, None), (value, name, depth,
+            seconds))
+        self.assertIsInstance(error, ValueError)
+
+        # bulk parsing is counted too, cache hits aren't
+        When.parse_cache = ParseCache()
+        stats.clear()
+        When.detect_many(['1972-01-31', '1972-01-31', 'abc'])
+        self.assertEqual({'parses': {'date': 1}, 'errors': {'detect': 1},
+            'detect_depths': {1: 1, tried: 1}, 'seconds': {}},
+            stats.snapshot())
+
+    def test_timing(self):
+        When.parse_stats = stats = ParseStats(timing=True)
+        When(detect='1972-01-31')
+        When(parse_date='1972-01-31')
+        seconds = stats.snapshot()['seconds']
+        self.assertEqual(['date'], list(seconds))
+        self.assertGreater(seconds['date'], 0)
+
+        # turned off nothing is recorded
+        When.parse_stats = None
+        When(detect='1972-01-31')
+        self.assertEqual(2, stats.snapshot()['parses']['date'])
+
+
+class TestLazyWhen(TestCase):
+    def test_lazy_epoch(self):
+        when = When(milli_epoch=65732100123, tz='UTC')
+        self.assertIsNone(when._dt)
+        self.assertEqual(65732100, when.epoch)
+        self.assertEqual(65732100123, when.milli_epoch)
+        self.assertEqual(65732100123000, when.micro_epoch)
+        self.assertEqual('UTC', when.tz)
+        self.assertIsNone(when._dt)
+
+        self.assertEqual(datetime(1972, 1, 31, 18, 55, 0, 123000),
+            when.datetime)
+        self.assertIsNotNone(when._dt)
+        self.assertEqual(65732100123, when.milli_epoch)
+
+        # local time
+        when = When(epoch=65732100)
+        self.assertEqual(65732100, when.epoch)
+        self.assertEqual(datetime.fromtimestamp(65732100), when.datetime)
+
+        # changing the zone keeps the wall clock time
+        when = When(epoch=0, tz='UTC')
+        when.tz = 'America/Toronto'
+        self.assertEqual(datetime(1970, 1, 1), when.datetime)
+        self.assertEqual(5 * 3600, when.epoch)
+
+    def test_memoize(self):
+        when = When(datetime=datetime(1972, 1, 31, 13, 55, 0, 5000),
+            tz='America/Toronto')
+        with patch.object(ZoneTable, 'to_epoch',
+                wraps=ZoneTable.get('America/Toronto').to_epoch) as to_epoch:
+            self.assertEqual(65732100, when.epoch)
+            self.assertEqual(65732100005, when.milli_epoch)
+            self.assertEqual(65732100005000, when.micro_epoch)
+            self.assertEqual(1, to_epoch.call_count)
+
+        self.assertIs(when.date, when.date)
+        self.assertIs(when.time, when.time)
+        self.assertEqual(date(1972, 1, 31), when.date)
+        self.assertEqual(time(13, 55, 0, 5000), when.time)
+
+        # changing the wrapped values resets the memoized ones
+        when._datetime = datetime(2000, 1, 1)
+        self.assertEqual(date(2000, 1, 1), when.date)
+        self.assertEqual(time(0, 0), when.time)
+        self.assertEqual(946702800, when.epoch)
+
+        when.tz = 'UTC'
+        self.assertEqual(946684800, when.epoch)
+        self.assertEqual(datetime(2000, 1, 1), when.datetime)
+
+        self.assertEqual(time(13, 55), When(time=time(13, 55)).time)
+
+
+class TestWhenArithmetic(TestCase):
+    def random_datetimes(self, count):
+        rand = random.Random(42)
+        return [datetime(rand.randint(1900, 2100), rand.randint(1, 12),
+            rand.randint(1, 28), rand.randint(0, 23), rand.randint(0, 59),
+            rand.randint(0, 59), rand.choice([0, 5, 123456]))
+            for _ in range(count)]
+
+    def test_compare(self):
+        dates = self.random_datetimes(500)
+        dates += dates[:50]
+        whens = [When(datetime=d) for d in dates]
+        self.assertEqual(sorted(dates), [w.datetime for w in sorted(whens)])
+        self.assertEqual(len(set(dates)), len(set(whens)))
+
+        rand = random.Random(42)
+        for _ in range(500):
+            a, b = rand.choice(dates), rand.choice(dates)
+            wa, wb = When(datetime=a), When(datetime=b)
+            self.assertEqual((a == b, a != b, a < b, a <= b, a > b, a >= b),
+                (wa == wb, wa != wb, wa < wb, wa <= wb, wa > wb, wa >= wb))
+            self.assertEqual(a - b, wa - wb)
+
+        # lazily built values compare without a datetime
+        when = When(epoch=65732100, tz='UTC')
+        self.assertEqual(When(datetime=datetime(1972, 1, 31, 18, 55),
+            tz='UTC'), when)
+
+        # different zones compare as instants, like aware datetimes
+        toronto = When(epoch=65732100, tz='America/Toronto')
+        self.assertEqual(when, toronto)
+        self.assertEqual(hash(when), hash(toronto))
+        self.assertEqual(timedelta(0), toronto - when)
+        self.assertTrue(When(epoch=65732101, tz='UTC') > toronto)
+
+        # both sides of a repeated hour have the same wall clock value, so
+        # they are equal and hash the same
+        first = When(epoch=1699162200, tz='America/Toronto')
+        second = When(epoch=1699165800, tz='America/Toronto')
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual(1, len({first, second}))
+
+        # with and without a zone, like naive and aware datetimes
+        naive = When(datetime=datetime(1972, 1, 31, 18, 55))
+        self.assertNotEqual(naive, when)
+        with self.assertRaises(TypeError):
+            naive < when
+        with self.assertRaises(TypeError):
+            naive - when
+
+        self.assertNotEqual(naive, datetime(1972, 1, 31, 18, 55))
+        with self.assertRaises(TypeError):
+            naive < datetime(1972, 1, 31, 18, 55)
+
+    def test_time_only(self):
+        times = [time(13, 55), time(0, 0), time(23, 59, 59, 999999),
+            time(13, 55)]
+        whens = [When(time=t) for t in times]
+        self.assertEqual(sorted(times), [w.time for w in sorted(whens)])
+        self.assertEqual(3, len(set(whens)))
+        self.assertEqual(When(time_string='13:55'), whens[0])
+
+        naive = When(datetime=datetime(1972, 1, 31, 13, 55))
+        self.assertNotEqual(naive, whens[0])
+        with self.assertRaises(TypeError):
+            naive < whens[0]
+        with self.assertRaises(TypeError):
+            whens[0] + timedelta(minutes=1)
+        with self.assertRaises(TypeError):
+            whens[0] - whens[1]
+
+        self.assertEqual(time(13, 0), whens[0].floor('hour').time)
+        self.assertEqual(time(0, 0), whens[2].floor('day').time)
+        self.assertEqual(time(23, 45), whens[2].floor(timedelta(minutes=15)
+            ).time)
+
+    def test_arithmetic(self):
+        rand = random.Random(42)
+        for d in self.random_datetimes(500):
+            delta = timedelta(microseconds=rand.randint(-10 ** 15, 10 ** 15))
+            when = When(datetime=d)
+            self.assertEqual(d + delta, (when + delta).datetime)
+            self.assertEqual(d + delta, (delta + when).datetime)
+            self.assertEqual(d - delta, (when - delta).datetime)
+
+        when = When(datetime=datetime(1972, 1, 31, 13, 55), tz='UTC')
+        later = when + timedelta(hours=1)
+        self.assertEqual('UTC', later.tz)
+        self.assertEqual(when.epoch + 3600, later.epoch)
+        self.assertEqual(timedelta(hours=1), later - when)
+
+        with self.assertRaises(TypeError):
+            when + 5
+
+    def test_floor(self):
+        for d in self.random_datetimes(500):
+            when = When(datetime=d)
+            self.assertEqual(d.replace(microsecond=0),
+                when.floor('second').datetime)
+            self.assertEqual(d.replace(second=0, microsecond=0),
+                when.floor('minute').datetime)
+            self.assertEqual(d.replace(minute=0, second=0, microsecond=0),
+                when.floor('hour').datetime)
+            self.assertEqual(datetime(d.year, d.month, d.day),
+                when.floor('day').datetime)
+            self.assertEqual(d.replace(minute=d.minute // 15 * 15, second=0,
+                microsecond=0), when.floor(timedelta(minutes=15)).datetime)
+
+        when = When(datetime=datetime(1969, 12, 31, 23, 59, 59),
+            tz='America/Toronto')
+        self.assertEqual(datetime(1969, 12, 31, 23), when.floor('hour')
+            .datetime)
+        self.assertEqual('America/Toronto', when.floor('hour').tz)
+
+        with self.assertRaises(ValueError):
+            when.floor('fortnight')
+        with self.assertRaises(ValueError):
+            when.floor(timedelta(0))
+
+    def test_batch(self):
+        dates = self.random_datetimes(500)
+        whens = WhenArray.from_datetimes(dates + dates[:10])
+        self.assertEqual(sorted(set(dates)),
+            [w.datetime for w in whens.unique()])
+
+        floored = whens.floor(timedelta(minutes=5))
+        self.assertEqual([w.floor(timedelta(minutes=5)) for w in whens],
+            list(floored))
+
+        delta = timedelta(days=3, microseconds=7)
+        self.assertEqual([w + delta for w in whens], list(whens + delta))
+        self.assertEqual([w - delta for w in whens], list(whens - delta))
+
+        times = WhenArray.from_whens([When(time=time(13, 55, 7))])
+        self.assertEqual([When(time=time(13, 55))], list(times.floor(
+            'minute')))
+        with self.assertRaises(TypeError):
+            times + delta
+
+
+class TestSeries(TestCase):
+    def test_steps(self):
+        start = datetime(1972, 1, 31, 13, 55)
+        series = When.series(start, datetime(1972, 2, 3), 'day')
+        self.assertFalse(isinstance(series, list))
+        self.assertEqual([datetime(1972, 1, 31, 13, 55),
+            datetime(1972, 2, 1, 13, 55), datetime(1972, 2, 2, 13, 55)],
+            [w.datetime for w in series])
+
+        results = list(When.series(When(datetime=start),
+            start + timedelta(minutes=1), 'second', 20, output='datetime'))
+        self.assertEqual([start + timedelta(seconds=s) for s in (0, 20, 40)],
+            results)
+
+        results = list(When.series(start, start + timedelta(hours=1),
+            timedelta(minutes=15), 2, output='datetime'))
+        self.assertEqual([start, start + timedelta(minutes=30)], results)
+
+        # calendar steps keep the day, clamped to shorter months
+        results = list(When.series(start, datetime(1973, 1, 1), 'month', 3,
+            output='datetime'))
+        self.assertEqual([datetime(1972, 1, 31, 13, 55),
+            datetime(1972, 4, 30, 13, 55), datetime(1972, 7, 31, 13, 55),
+            datetime(1972, 10, 31, 13, 55)], results)
+
+        results = list(When.series(datetime(1972, 2, 29),
+            datetime(1976, 3, 1), 'year', output='datetime'))
+        self.assertEqual([datetime(1972, 2, 29), datetime(1973, 2, 28),
+            datetime(1974, 2, 28), datetime(1975, 2, 28),
+            datetime(1976, 2, 29)], results)
+
+        # endless, and integer microseconds
+        series = When.series(0, step='hour', output='datetime')
+        self.assertEqual(datetime(1970, 1, 1, 2), list(islice(series, 3))[-1])
+        series = When.series(start, step='year', output='datetime')
+        self.assertEqual(datetime(1982, 1, 31, 13, 55),
+            list(islice(series, 11))[-1])
+        self.assertEqual([], list(When.series(start, start, 'day')))
+        self.assertEqual(9999, list(When.series(datetime(9990, 1, 1),
+            step='year', output='datetime'))[-1].year)
+
+    def test_outputs(self):
+        start = datetime(1972, 1, 31, 13, 55)
+        end = start + timedelta(hours=2)
+        whens = list(When.series(start, end, 'hour'))
+
+        results = list(When.series(start, end, 'hour', output='string',
+            name='datetime'))
+        self.assertEqual(['1972-01-31 13:55', '1972-01-31 14:55'], results)
+        self.assertEqual([w.string.iso_micro for w in whens],
+            list(When.series(start, end, 'hour', output='string')))
+
+        self.assertEqual([w.epoch for w in whens],
+            list(When.series(start, end, 'hour', output='epoch')))
+        self.assertEqual([w.milli_epoch for w in whens],
+            list(When.series(start, end, 'hour', output='epoch',
+            unit='ms')))
+
+        results = When.series(start, end, 'minute', output='array')
+        self.assertIsInstance(results, WhenArray)
+        self.assertEqual(120, len(results))
+        self.assertEqual(start + timedelta(minutes=119),
+            results[-1].datetime)
+
+        # zoned, across the start of daylight saving time
+        start = When(detect='2024-03-10 00:00', tz='America/Toronto')
+        whens = list(When.series(start, datetime(2024, 3, 11), 'hour', 6))
+        self.assertEqual(['America/Toronto'] * 4, [w.tz for w in whens])
+        self.assertEqual([w.epoch for w in whens], list(When.series(start,
+            datetime(2024, 3, 11), 'hour', 6, output='epoch')))
+        self.assertEqual(5 * 3600, whens[1].epoch - whens[0].epoch)
+        self.assertEqual([w.string.datetime_utc for w in whens],
+            list(When.series(start, datetime(2024, 3, 11), 'hour', 6,
+            output='string', name='datetime_utc')))
+
+        results = list(When.series(datetime(2024, 3, 10), datetime(2024, 3,
+            10, 1), 'hour', output='epoch', tz='UTC', unit='us'))
+        self.assertEqual([When(datetime=datetime(2024, 3, 10),
+            tz='UTC').micro_epoch], results)
+
+        # an end in another zone is converted to the series' zone
+        start = When(datetime=datetime(2024, 1, 1), tz='UTC')
+        end = When(datetime=datetime(2024, 1, 1, 5), tz='America/Toronto')
+        whens = list(When.series(start, end, 'hour'))
+        self.assertEqual(10, len(whens))
+        self.assertEqual(datetime(2024, 1, 1, 9), whens[-1].datetime)
+        self.assertEqual(['UTC'] * 10, [w.tz for w in whens])
+
+    def test_errors(self):
+        start = datetime(1972, 1, 31)
+        for kwargs in [{'step': 'fortnight'}, {'step': timedelta(0)},
+                {'step': 'month', 'every': 0}, {'output': 'nothing'},
+                {'output': 'array', 'end': None}]:
+            with self.assertRaises(ValueError):
+                When.series(start, **dict({'end': start}, **kwargs))
+
+        for bound in [time(13, 55), When(time=time(13, 55)),
+                CompactWhen(0, time_only=True)]:
+            with self.assertRaises(TimeOnlyError):
+                When.series(bound, step='hour')
+
+
+class TestCompactWhen(TestCase):
+    def test_compact(self):
+        d = datetime(1972, 1, 31, 13, 55, 7, 123456)
+        when = When(datetime=d)
+        compact = CompactWhen.from_when(when)
+
+        self.assertEqual(65714107123456, compact.micros)
+        self.assertFalse(compact.time_only)
+        self.assertEqual(d, compact.datetime)
+        self.assertEqual(d.date(), compact.date)
+        self.assertEqual(d.time(), compact.time)
+        self.assertEqual(when.epoch, compact.epoch)
+        self.assertEqual(when.epoch * 1000 + 123, compact.milli_epoch)
+        self.assertEqual(when.string.iso_micro, compact.string.iso_micro)
+        self.assertEqual(d, compact.to_when().datetime)
+        self.assertEqual(compact, CompactWhen.from_datetime(d))
+        self.assertEqual(hash(compact), hash(CompactWhen.from_datetime(d)))
+        self.assertEqual(compact, pickle.loads(pickle.dumps(compact)))
+
+        # a zoned When is converted to local time
+        when = When(detect='2020-01-01T10:00:00.5+02:00')
+        compact = CompactWhen.from_when(when)
+        self.assertEqual(when.micro_epoch, compact.micro_epoch)
+        self.assertEqual(datetime.fromtimestamp(when.epoch).replace(
+            microsecond=500000), compact.datetime)
+
+        # before 1970
+        d = datetime(1910, 6, 1, 23, 59, 59, 999999)
+        compact = CompactWhen.from_datetime(d)
+        self.assertEqual(d, compact.datetime)
+        self.assertEqual(d.date(), compact.date)
+        self.assertEqual(d.time(), compact.time)
+
+        # time only
+        compact = CompactWhen.from_when(When(time_string='13:55:07'))
+        self.assertTrue(compact.time_only)
+        self.assertEqual(time(13, 55, 7), compact.time)
+        self.assertEqual(None, compact.datetime)
+        self.assertEqual(time(13, 55, 7), compact.to_when().time)
+        self.assertNotEqual(compact, CompactWhen(compact.micros))
+        self.assertEqual('CompactWhen(50107000000, time_only=True)',
+            repr(compact))
+
+        with self.assertRaises(TimeOnlyError):
+            compact.date
+
+        with self.assertRaises(TimeOnlyError):
+            compact.epoch
+
+        with self.assertRaises(ValueError):
+            CompactWhen(-1, time_only=True)
+
+        # immutable and slotted
+        with self.assertRaises(AttributeError):
+            compact._micros = 3
+
+        with self.assertRaises(AttributeError):
+            compact.foo = 3
+
+        with self.assertRaises(AttributeError):
+            compact.__dict__
+
+
+class TestWhenArray(TestCase):
+    def setUp(self):
+        self.dates = [datetime(1972, 1, 31, 13, 55, 0, 500000),
+            datetime(1972, 1, 1), datetime(1999, 12, 31, 23, 59),
+            datetime(1972, 1, 31, 13, 55)]
+        self.whens = WhenArray.from_whens(When(datetime=d) for d in
+            self.dates)
+
+    def test_basics(self):
+        self.assertEqual(4, len(self.whens))
+        self.assertEqual(self.dates, [w.datetime for w in self.whens])
+        self.assertEqual(self.dates[2], self.whens[2].datetime)
+        self.assertEqual(self.dates[3], self.whens[-1].datetime)
+        self.assertEqual(self.dates[1:3],
+            [w.datetime for w in self.whens[1:3]])
+        self.assertEqual('<WhenArray of 4 datetimes>', repr(self.whens))
+        self.assertEqual([CompactWhen.from_datetime(d) for d in self.dates],
+            self.whens.compact())
+
+        same = WhenArray.from_datetimes(self.dates)
+        self.assertEqual(list(self.whens.micros), list(same.micros))
+        same = WhenArray.from_whens(CompactWhen.from_datetime(d) for d in
+            self.dates)
+        self.assertEqual(list(self.whens.micros), list(same.micros))
+        self.assertEqual(0, len(WhenArray.from_whens([])))
+
+        # slices share the buffer
+        data = array('q', [1, 2, 3])
+        whens = WhenArray(data)
+        self.assertEqual([2, 3], list(whens[1:].micros))
+        with self.assertRaises(BufferError):
+            data.append(4)
+
+        with self.assertRaises(TypeError):
+            whens.micros[0] = 5
+
+        with self.assertRaises(TypeError):
+            WhenArray(array('d', [1.0]))
+
+        # time only
+        times = WhenArray.from_whens([When(time=time(13, 55)),
+            When(time=time(1, 2, 3))])
+        self.assertTrue(times.time_only)
+        self.assertEqual([time(13, 55), time(1, 2, 3)],
+            [w.time for w in times])
+        with self.assertRaises(TimeOnlyError):
+            times.strings('date')
+
+        with self.assertRaises(TimeOnlyError):
+            times.epochs()
+
+    def test_queries(self):
+        self.assertFalse(self.whens.is_sorted())
+        whens = self.whens.sorted()
+        self.assertTrue(whens.is_sorted())
+        self.assertEqual(sorted(self.dates), [w.datetime for w in whens])
+
+        found = whens.between(When(detect='1972-01-31 13:55'),
+            datetime(1999, 1, 1))
+        self.assertEqual([self.dates[3], self.dates[0]],
+            [w.datetime for w in found])
+        self.assertEqual((0, 1), whens.index_range(None,
+            datetime(1972, 1, 31)))
+        self.assertEqual((3, 4), whens.index_range(datetime(1999, 1, 1),
+            None))
+        self.assertEqual((3, 3), whens.index_range(datetime(1999, 1, 1),
+            datetime(1972, 1, 1)))
+        self.assertEqual((1, 3), whens.index_range(
+            CompactWhen.from_datetime(self.dates[3]), whens.micros[3]))
+
+        with self.assertRaises(TypeError):
+            whens.between('1972', None)
+
+    def test_conversions(self):
+        self.assertEqual(['1972-01-31T13:55:00.500000Z',
+            '1972-01-01T00:00:00.0Z', '1999-12-31T23:59:00.0Z',
+            '1972-01-31T13:55:00.0Z'], self.whens.strings('iso_micro'))
+
+        epochs = [When(datetime=d).epoch for d in self.dates]
+        self.assertEqual(array('q', epochs), self.whens.epochs())
+        self.assertEqual(epochs[0] * 1000 + 500,
+            self.whens.milli_epochs()[0])
+
+    def test_pickle(self):
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            result = pickle.loads(pickle.dumps(self.whens, protocol))
+            self.assertEqual(self.dates, [w.datetime for w in result])
+
+        # out-of-band buffers aren't copied
+        buffers = []
+        data = pickle.dumps(self.whens, 5, buffer_callback=buffers.append)
+        result = pickle.loads(data, buffers=buffers)
+        self.assertEqual(self.dates, [w.datetime for w in result])
+        self.assertEqual(1, len(buffers))
+
+        # strided slices are copied
+        result = pickle.loads(pickle.dumps(self.whens[::2], 5))
+        self.assertEqual(self.dates[::2], [w.datetime for w in result])
+
+    @skipUnless(numpy, 'NumPy not installed')
+    def test_numpy(self):
+        values = self.whens.to_numpy()
+        self.assertEqual(list(self.whens.micros), list(values))
+        self.assertEqual(numpy.datetime64(self.dates[0], 'us'),
+            self.whens.to_datetime64()[0])
+        self.assertEqual(list(self.whens.micros)[::2],
+            list(self.whens[::2].to_numpy()))
+
+        whens = WhenArray(values)
+        self.assertEqual(self.dates, [w.datetime for w in whens])
+        whens = WhenArray.from_datetime64(numpy.array(self.dates,
+            dtype='datetime64[ms]'))
+        self.assertEqual(self.dates, [w.datetime for w in whens])
+
+
+class TestWhenIndex(TestCase):
+    def setUp(self):
+        rand = random.Random(42)
+        self.epochs = [rand.randint(0, 10 ** 8) for _ in range(5000)]
+        self.micros = sorted(e * 1000000 for e in self.epochs)
+
+    def brute_rollup(self, size):
+        result = {}
+        for m in self.micros:
+            key = m - m % size
+            result[key] = result.get(key, 0) + 1
+
+        return sorted(result.items())
+
+    def assert_queries(self, index):
+        micros = self.micros
+        self.assertEqual(len(micros), len(index))
+        self.assertEqual(micros, list(index.array.micros))
+
+        rand = random.Random(42)
+        for _ in range(200):
+            start, end = sorted(rand.randint(-10 ** 12, 10 ** 14 + 10 ** 12)
+                for _ in range(2))
+            expected = [m for m in micros if start <= m < end]
+            self.assertEqual(expected, list(index.range(start, end).micros))
+            self.assertEqual(len(expected), index.count(start, end))
+
+            target = rand.randint(-10 ** 12, 10 ** 14 + 10 ** 12)
+            best = min(micros, key=lambda m: (abs(m - target), m))
+            self.assertEqual(best, index.nearest(target)._wall_micros)
+
+        hour = 3600 * 1000000
+        for size in [hour, 24 * hour, 90 * 60 * 1000000]:
+            self.assertEqual(self.brute_rollup(size), [(w._wall_micros, n)
+                for w, n in index.rollup(timedelta(microseconds=size))])
+
+        self.assertEqual(self.brute_rollup(hour), [(w._wall_micros, n)
+            for w, n in index.counts()])
+
+        # buckets within a range
+        start, end = 10 ** 13, 3 * 10 ** 13
+        self.assertEqual([(k, n) for k, n in self.brute_rollup(hour)
+            if start <= k < end], [(w._wall_micros, n)
+            for w, n in index.counts(start, end)])
+        self.assertEqual(sum(n for _, n in index.rollup('day', start, end)),
+            index.count(start, end))
+
+    def test_index(self):
+        index = WhenIndex.from_epochs(self.epochs, tz='UTC', bucket='hour')
+        self.assert_queries(index)
+
+        # values are merged in by the next query
+        index = WhenIndex(bucket='hour')
+        index.update(When(epoch=e, tz='UTC') for e in self.epochs[:1000])
+        self.assertEqual(1000, index.count(None, None))
+        index.add_epochs(self.epochs[1000:4000], tz='UTC')
+        other = WhenIndex.from_epochs(self.epochs[4000:-1], tz='UTC')
+        index.merge(other)
+        index.add(datetime(1970, 1, 1) + timedelta(seconds=self.epochs[-1]))
+        self.assert_queries(index)
+
+        when = index.nearest(When(datetime=datetime(1970, 1, 1)))
+        self.assertEqual(datetime(1970, 1, 1) + timedelta(seconds=min(
+            self.epochs)), when.datetime)
+
+        # values added after the directory is built are counted
+        index = WhenIndex([0, 10], bucket='hour')
+        self.assertEqual([2], [n for _, n in index.counts()])
+        index.add(3600 * 1000000)
+        self.assertEqual([2, 1], [n for _, n in index.counts()])
+
+        self.assertIsNone(WhenIndex().nearest(0))
+        with self.assertRaises(ValueError):
+            WhenIndex().counts()
+        with self.assertRaises(ValueError):
+            index.merge(WhenArray([0], time_only=True))
+
+    def test_time_only(self):
+        index = WhenIndex([time(13, 55), time(1, 0), time(13, 5)],
+            time_only=True)
+        self.assertEqual([time(1, 0), time(13, 5), time(13, 55)],
+            [w.time for w in index])
+        self.assertEqual([(time(1, 0), 1), (time(13, 0), 2)],
+            [(w.time, n) for w, n in index.rollup('hour')])
+        self.assertEqual(time(13, 55), index.nearest(time(14, 0)).time)
+
+    def test_persist(self):
+        index = WhenIndex.from_epochs(self.epochs, tz='UTC', bucket='hour')
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'index.bin')
+            index.save(path)
+            loaded = WhenIndex.load(path)
+            self.assertIsNotNone(loaded._directory)
+            self.assertEqual(3600 * 1000000, loaded.bucket)
+            self.assert_queries(loaded)
+
+            # saving over the file it is mapped from
+            loaded.save(path)
+            del loaded
+            loaded = WhenIndex.load(path)
+            self.assertEqual(3600 * 1000000, loaded.bucket)
+            self.assert_queries(loaded)
+
+            # adding to a loaded index copies it out of the file
+            self.epochs.append(10 ** 8 + 1)
+            self.micros.append((10 ** 8 + 1) * 1000000)
+            loaded.add_epochs([10 ** 8 + 1], tz='UTC')
+            self.assert_queries(loaded)
+            del loaded
+
+            # not an index, shorter than the header and empty
+            for content in [b'not an index' * 10, b'short', b'']:
+                with open(path, 'wb') as f:
+                    f.write(content)
+
+                with self.assertRaises(ValueError):
+                    WhenIndex.load(path)
+
+
+class TestParseStream(TestCase):
+    lines = ['1972-01-31', '1972-01-31 13:55', 'bad', '13:55',
+        '1972-01-31T13:55:00.5Z'] * 200
+
+    def collect(self, source, **kwargs):
+        async def run():
+            batches = []
+            async for batch in parse_stream(source, **kwargs):
+                batches.append(batch)
+
+            return batches
+
+        return asyncio.run(run())
+
+    def flatten(self, batches):
+        results = [r for batch, _ in batches for r in batch]
+        errors = [i for _, errors in batches for i, _ in errors]
+        return results, errors
+
+    def stream_reader(self, data):
+        # an in-process StreamReader fed with the data, must be built inside
+        # the running loop
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def test_stream(self):
+        expected, expected_errors = When.detect_many(self.lines)
+        expected_errors = [i for i, _ in expected_errors]
+        data = ''.join(line + '\n' for line in self.lines).encode('ascii')
+
+        async def from_reader(**kwargs):
+            results = []
+            errors = []
+            async for batch, batch_errors in parse_stream(
+                    self.stream_reader(data), **kwargs):
+                results.extend(batch)
+                errors.extend(i for i, _ in batch_errors)
+
+            return results, errors
+
+        result = asyncio.run(from_reader(batch_size=64))
+        self.assertEqual((expected, expected_errors), result)
+
+        # arbitrary chunks
+        async def chunked():
+            for start in range(0, len(data), 37):
+                yield data[start:start + 37]
+
+        batches = self.collect(chunked(), chunks=True, batch_size=50)
+        self.assertEqual((expected, expected_errors), self.flatten(batches))
+        self.assertTrue(all(len(batch) <= 50 for batch, _ in batches))
+
+        # offloaded to a pool, in order
+        with ThreadPoolExecutor(2) as executor:
+            result = asyncio.run(from_reader(batch_size=64,
+                executor=executor, offload_size=10))
+            self.assertEqual((expected, expected_errors), result)
+
+        # a named format and output
+        async def source():
+            for e in range(0, 10):
+                yield '1970-01-01 00:0%d:00' % e
+
+        batches = self.collect(source(), name='datetime_sec', output='when')
+        self.assertEqual(list(range(0, 600, 60)),
+            [w.epoch - When(datetime=datetime(1970, 1, 1)).epoch
+            for w in self.flatten(batches)[0]])
+
+        with self.assertRaises(KeyError):
+            self.collect(source(), name='nothing')
+
+    def test_backpressure(self):
+        read = []
+
+        async def source():
+            for line in self.lines:
+                read.append(line)
+                yield line
+
+        async def run():
+            stream = parse_stream(source(), batch_size=10, max_pending=2)
+            first = await stream.__anext__()
+
+            # a slow consumer: the source is only read a bounded amount ahead
+            await asyncio.sleep(0.05)
+            ahead = len(read)
+            await stream.aclose()
+            return first, ahead
+
+        first, ahead = asyncio.run(run())
+        results, _ = first
+        self.assertEqual(When.detect_many(self.lines[:len(results)])[0],
+            results)
+
+        # the first batch, the queue and the line waiting to go in it
+        self.assertLessEqual(ahead, len(results) + 10 * 2 + 1)
+        self.assertLess(ahead, len(self.lines))
+
+    def test_source_error(self):
+        async def source():
+            yield '1972-01-31'
+            raise OSError('connection reset')
+
+        async def run():
+            results = []
+            with self.assertRaises(OSError):
+                async for batch, _ in parse_stream(source()):
+                    results.extend(batch)
+
+            return results
+
+        self.assertEqual([datetime(1972, 1, 31)], asyncio.run(run()))
+
+
+class TestFormatMany(TestCase):
+    def setUp(self):
+        self.dates = [datetime(1972, 1, 31, 13, 55) + timedelta(hours=i)
+            for i in range(25)]
+        self.expected = [d.strftime('%Y-%m-%d %H:%M') for d in self.dates]
+
+    def test_inputs(self):
+        self.assertEqual(self.expected,
+            When.format_many(self.dates, 'datetime'))
+        self.assertEqual(self.expected,
+            When.format_many(iter(self.dates), 'datetime', chunk_size=7))
+        self.assertEqual(self.expected, When.format_many(
+            [When(datetime=d) for d in self.dates], 'datetime'))
+        self.assertEqual(self.expected, When.format_many(
+            [CompactWhen.from_datetime(d) for d in self.dates], 'datetime'))
+        self.assertEqual(self.expected, When.format_many(
+            WhenArray.from_datetimes(self.dates), 'datetime', chunk_size=4))
+
+        epochs = [When(datetime=d).epoch for d in self.dates]
+        self.assertEqual(self.expected,
+            When.format_many(epochs, 'datetime'))
+        self.assertEqual([], When.format_many([], 'datetime'))
+
+        # a leading None is a bad value, not the end of the values
+        with self.assertRaises(TypeError):
+            When.format_many([None, 5], 'date')
+
+        out = io.StringIO()
+        self.assertEqual(25, When.format_many(self.dates, 'datetime', out,
+            chunk_size=10))
+        self.assertEqual('\n'.join(self.expected) + '\n', out.getvalue())
+
+        with self.assertRaises(KeyError):
+            When.format_many(self.dates, 'nothing')
+
+        times = WhenArray([0], time_only=True)
+        with self.assertRaises(TimeOnlyError):
+            When.format_many(times, 'time')
+
+    def test_workers(self):
+        self.assertEqual(self.expected, When.format_many(self.dates,
+            'datetime', workers=2, chunk_size=3))
+
+        out = io.StringIO()
+        self.assertEqual(25, When.format_many(
+            WhenArray.from_datetimes(self.dates), 'datetime', out, workers=2,
+            chunk_size=3))
+        self.assertEqual('\n'.join(self.expected) + '\n', out.getvalue())
+
+        # custom formats are passed to the workers
+        When.parse_formats['slashes'] = '%d/%m/%Y'
+        try:
+            self.assertEqual('31/01/1972', When.format_many(self.dates,
+                'slashes', workers=2, chunk_size=3)[0])
+        finally:
+            del When.parse_formats['slashes']
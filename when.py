@@ -1,9 +1,18 @@
 __version__ = '0.11.2'
 
-import sys
-from datetime import datetime, time
+import io, math, os, sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from datetime import date, datetime, time, timedelta, timezone
+from itertools import chain, count, islice
+from operator import attrgetter
 import time as time_mod
 
+# modules only some features need (argparse, csv, mmap, pickle, re, struct,
+# threading, zoneinfo, numpy) are imported where they are used, keeping
+# the cost of importing when down for short lived processes
+
 # =============================================================================
 
 # compensate for long disappearing in py3
@@ -14,6 +23,699 @@ if sys.version_info > (3,):
 # Date Conversion
 # =============================================================================
 
+# -----------------------------------------------------------------------------
+# Parsers. Every strftime pattern is compiled once into a parser function,
+# cached by pattern so that changes to parse_formats are picked up
+# automatically. The compiled parsers use the same regular expressions as the
+# standard library's _strptime, so they accept exactly what strptime accepts
+# and raise the same errors; patterns with directives other than those below
+# fall back to strptime itself.
+#
+# Parsing takes no locks and changes no shared state once a pattern's parser
+# is compiled, so it scales across threads where the interpreter allows it.
+# strptime serializes every call on the lock guarding _strptime's locale
+# cache, only custom patterns with other directives go through it, as do
+# the opt-in ParseCache and ParseStats.
+
+_PARSE_FIELDS = {
+    'd': r'(?P<d>3[01]|[12]\d|0[1-9]|[1-9]| [1-9])',
+    'f': r'(?P<f>[0-9]{1,6})',
+    'H': r'(?P<H>2[0-3]|[0-1]\d|\d)',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'M': r'(?P<M>[0-5]\d|\d)',
+    'S': r'(?P<S>6[0-1]|[0-5]\d|\d)',
+    'Y': r'(?P<Y>\d\d\d\d)',
+}
+
+
+def _compile_parser(pattern):
+    import re
+    regex = []
+    index = 0
+    while index < len(pattern):
+        c = pattern[index]
+        if c.isspace():
+            # like strptime, any run of whitespace matches any amount
+            while index < len(pattern) and pattern[index].isspace():
+                index += 1
+
+            regex.append(r'\s+')
+        elif c != '%':
+            regex.append(re.escape(c))
+            index += 1
+        else:
+            directive = pattern[index + 1:index + 2]
+            if directive == '%':
+                regex.append('%')
+            elif directive in _PARSE_FIELDS and \
+                    _PARSE_FIELDS[directive] not in regex:
+                regex.append(_PARSE_FIELDS[directive])
+            else:
+                # unsupported or repeated directive
+                return lambda value: datetime.strptime(value, pattern)
+
+            index += 2
+
+    match = re.compile(''.join(regex), re.IGNORECASE).match
+
+    def parse(value):
+        found = match(value)
+        if found is None:
+            raise ValueError('time data %r does not match format %r' % (
+                value, pattern))
+
+        if len(value) != found.end():
+            raise ValueError('unconverted data remains: %s' %
+                value[found.end():])
+
+        fields = found.groupdict()
+        fraction = fields.get('f')
+        return datetime(int(fields.get('Y', 1900)), int(fields.get('m', 1)),
+            int(fields.get('d', 1)), int(fields.get('H', 0)),
+            int(fields.get('M', 0)), int(fields.get('S', 0)),
+            int(fraction.ljust(6, '0')) if fraction else 0)
+
+    return parse
+
+
+def _with_fast_path(fast, pattern):
+    # tries the fast path parser first, anything it rejects is given to the
+    # full parser so lenient input and error messages are unchanged. The
+    # full parser is compiled the first time it is needed, canonical input
+    # never needs it. Threads racing to compile it each store an equivalent
+    # parser, so no lock is needed
+    slow = [None]
+
+    def parse(value):
+        try:
+            result = fast(value)
+            if result is not None:
+                return result
+        except ValueError:
+            pass
+
+        parser = slow[0]
+        if parser is None:
+            parser = slow[0] = _compile_parser(pattern)
+
+        return parser(value)
+
+    return parse
+
+# Fast path parsers for the built-in formats. Each checks the string has the
+# canonical fixed-width layout and hands it to the C implemented
+# datetime.fromisoformat, returning None if the layout doesn't match.
+
+def _from_iso(value):
+    result = datetime.fromisoformat(value)
+    if result.tzinfo is None:
+        # newer pythons accept offsets, those aren't part of the layout
+        return result
+
+
+def _fast_date(value):
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        return _from_iso(value)
+
+
+def _fast_time(value):
+    if len(value) == 5 and value[2] == ':':
+        return _from_iso('1900-01-01T' + value)
+
+
+def _fast_time_sec(value):
+    if len(value) == 8 and value[2] == ':' and value[5] == ':':
+        return _from_iso('1900-01-01T' + value)
+
+
+def _fast_datetime(value):
+    if len(value) == 16 and value[4] == '-' and value[7] == '-' and \
+            value[10] == ' ' and value[13] == ':':
+        return _from_iso(value)
+
+
+def _fast_datetime_sec(value):
+    if len(value) == 19 and value[4] == '-' and value[7] == '-' and \
+            value[10] == ' ' and value[13] == ':' and value[16] == ':':
+        return _from_iso(value)
+
+
+def _fast_datetime_utc(value):
+    if len(value) == 17 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == 'Z':
+        return _from_iso(value[:16])
+
+
+def _fast_datetime_sec_utc(value):
+    if len(value) == 20 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == ':' and \
+            value[19] == 'Z':
+        return _from_iso(value[:19])
+
+
+def _fast_iso_micro(value):
+    # 1 to 6 fractional digits, right padded like strptime's %f
+    if 22 <= len(value) <= 27 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == ':' and \
+            value[19] == '.' and value[-1] == 'Z':
+        fraction = value[20:-1]
+        if fraction.isascii() and fraction.isdigit():
+            return _from_iso(value[:20] + fraction.ljust(6, '0'))
+
+
+def _fast_offset(base, offset):
+    # the canonical 'Z' and +hh:mm UTC offsets of the offset formats
+    if offset == 'Z':
+        result = _from_iso(base)
+        if result is not None:
+            return result.replace(tzinfo=_UTC)
+    elif len(offset) == 6 and offset[0] in '+-' and offset[3] == ':':
+        # fromisoformat carries out of range minutes over into the hours,
+        # strptime rejects them
+        digits = offset[1:3] + offset[4:6]
+        if digits.isascii() and digits.isdigit() and offset[4:6] <= '59':
+            return datetime.fromisoformat(base + offset)
+
+
+def _fast_iso_offset(value):
+    if len(value) >= 20 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == ':':
+        return _fast_offset(value[:19], value[19:])
+
+
+def _fast_iso_micro_offset(value):
+    if len(value) >= 22 and value[4] == '-' and value[7] == '-' and \
+            value[10] == 'T' and value[13] == ':' and value[16] == ':' and \
+            value[19] == '.':
+        end = -1 if value[-1] == 'Z' else -6
+        fraction = value[20:end]
+        if 1 <= len(fraction) <= 6 and fraction.isascii() and \
+                fraction.isdigit():
+            return _fast_offset(value[:20] + fraction.ljust(6, '0'),
+                value[end:])
+
+
+# compiled parsers keyed on pattern, seeded with the built-in formats
+_PARSERS = {pattern:_with_fast_path(fast, pattern)
+    for pattern, fast in [
+        ('%Y-%m-%d', _fast_date),
+        ('%H:%M', _fast_time),
+        ('%H:%M:%S', _fast_time_sec),
+        ('%Y-%m-%d %H:%M', _fast_datetime),
+        ('%Y-%m-%d %H:%M:%S', _fast_datetime_sec),
+        ('%Y-%m-%dT%H:%MZ', _fast_datetime_utc),
+        ('%Y-%m-%dT%H:%M:%SZ', _fast_datetime_sec_utc),
+        ('%Y-%m-%dT%H:%M:%S.%fZ', _fast_iso_micro),
+        ('%Y-%m-%dT%H:%M:%S%z', _fast_iso_offset),
+        ('%Y-%m-%dT%H:%M:%S.%f%z', _fast_iso_micro_offset),
+    ]}
+
+
+# strptime directives that carry part of a date, a pattern without any of
+# them parses to a time of day
+_DATE_DIRECTIVES = frozenset('aAbBcdDFgGhjmsuUVwWxyY')
+
+# whether each pattern seen so far is time only
+_TIME_PATTERNS = {}
+
+# the built-in time formats, which accept a time with or without seconds
+_TIME_FORMATS = {'time': '%H:%M', 'time_sec': '%H:%M:%S'}
+
+
+def _time_only(pattern):
+    # True if the pattern has no date directives
+    time_only = _TIME_PATTERNS.get(pattern)
+    if time_only is None:
+        directives = pattern.replace('%%', '').split('%')[1:]
+        time_only = _TIME_PATTERNS[pattern] = not any(
+            directive.lstrip('-#_0^')[:1] in _DATE_DIRECTIVES
+            for directive in directives)
+
+    return time_only
+
+
+# parser and formatter functions passed to When.register_format(), keyed on
+# the format name as (pattern, function) pairs so they only apply while the
+# name still has that pattern
+_CUSTOM_PARSERS = {}
+_CUSTOM_FORMATTERS = {}
+
+
+def _parser(pattern, name=None):
+    # returns the registered parser for the named format, or the compiled
+    # parser for the pattern
+    if name is not None and _CUSTOM_PARSERS:
+        custom = _CUSTOM_PARSERS.get(name)
+        if custom is not None and custom[0] == pattern:
+            return custom[1]
+
+    parser = _PARSERS.get(pattern)
+    if parser is None:
+        parser = _PARSERS[pattern] = _compile_parser(pattern)
+
+    return parser
+
+# -----------------------------------------------------------------------------
+# ISO 8601. The iso8601 parser accepts the RFC 3339 profile of ISO 8601 and
+# the common variations on it: a 'T', 't' or space separator, optional
+# seconds, a '.' or ',' fraction of any number of digits (truncated to
+# microseconds) and a 'Z', +hh:mm, +hhmm or +hh offset, or none. The layout
+# is checked and rewritten into the subset that fromisoformat accepts on
+# every supported python, which does the rest.
+
+def _parse_iso8601(value):
+    # returns an aware datetime if the string has an offset, otherwise a
+    # naive one
+    length = len(value)
+    if length < 16 or value[4] != '-' or value[7] != '-' or \
+            value[10] not in 'Tt ' or value[13] != ':' or \
+            not value.isascii():
+        raise ValueError('time data %r is not ISO 8601' % (value, ))
+
+    base = value[:10] + 'T' + value[11:16]
+    rest = value[16:]
+    if rest[:1] == ':':
+        base += rest[:3]
+        rest = rest[3:]
+        if rest[:1] in ('.', ','):
+            # the digits up to the offset, right padded like %f
+            offset = rest[1:].lstrip('0123456789')
+            fraction = rest[1:len(rest) - len(offset)]
+            if not fraction:
+                raise ValueError('time data %r is not ISO 8601' % (value, ))
+
+            base += '.' + fraction[:6].ljust(6, '0')
+            rest = offset
+
+    if not rest:
+        offset = ''
+    elif rest in ('Z', 'z'):
+        offset = '+00:00'
+    elif rest[0] in '+-' and (len(rest) in (3, 5) or (len(rest) == 6 and
+            rest[3] == ':')):
+        # fromisoformat carries out of range minutes over into the hours
+        hours = rest[1:3]
+        minutes = rest[-2:] if len(rest) > 3 else '00'
+        if not (hours + minutes).isdigit() or hours > '23' or \
+                minutes > '59':
+            raise ValueError('time data %r is not ISO 8601' % (value, ))
+
+        offset = rest[0] + hours + ':' + minutes
+    else:
+        raise ValueError('time data %r is not ISO 8601' % (value, ))
+
+    return datetime.fromisoformat(base + offset)
+
+# -----------------------------------------------------------------------------
+# Buffers. bytes, bytearray, memoryview and mmap values are decoded straight
+# from the buffer into the str the parsers work on, slices are taken on a
+# memoryview so only the timestamp itself is copied.
+
+def _decode(value, start=0, stop=None):
+    # the ASCII text of a bytes-like value, or of its start:stop slice
+    if not start and stop is None:
+        return str(value, 'ascii')
+
+    with memoryview(value) as view:
+        return str(view[start:stop], 'ascii')
+
+
+def _buffer_lines(buffer, offset=0, length=None):
+    # generator of the text of each line in a bytes-like buffer, or of the
+    # offset:offset + length slice of each line. Lines end in '\n' or
+    # '\r\n', non-ASCII bytes become U+FFFD so the row fails to parse
+    # rather than stopping the scan
+    import re
+    search = re.compile(b'\n').search
+    with memoryview(buffer) as view:
+        end = len(view)
+        start = 0
+        while start < end:
+            found = search(view, start)
+            stop = end if found is None else found.start()
+            line_stop = stop
+            if length is not None:
+                line_stop = min(stop, start + offset + length)
+            elif stop > start and view[stop - 1] == 13:
+                line_stop -= 1
+
+            yield str(view[start + offset:max(line_stop, start + offset)],
+                'ascii', 'replace')
+            start = stop + 1
+
+# -----------------------------------------------------------------------------
+# Detection. Formats registered with a layout hint are indexed by string
+# length, so detection only tries the formats whose length and separator
+# positions match the string, however many formats are registered. Maps a
+# length to a tuple of (sort key, name, pattern, ((index, separator), ...))
+# entries, in the order they should be tried. Registering replaces the
+# tuples rather than changing them, so detection running in other threads
+# always sees a complete one.
+
+_DETECT_SHAPES = {}
+_REGISTRATIONS = count()
+
+# fixed widths of the directives in a format's canonical layout
+_DIRECTIVE_WIDTHS = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+
+
+def _derive_hint(pattern):
+    # returns a (lengths, separators) layout hint for the pattern, or None if
+    # it has directives without a fixed width. A %f can be 1 to 6 digits,
+    # separators after it are indexed from the end of the string
+    separators = []
+    position = 0
+    fraction = False
+    index = 0
+    while index < len(pattern):
+        c = pattern[index]
+        if c == '%':
+            directive = pattern[index + 1:index + 2]
+            if directive == 'f' and not fraction:
+                fraction = True
+                suffix = pattern[index + 2:]
+                if '%' in suffix:
+                    return None
+
+                separators.extend((i - len(suffix), s) for i, s in
+                    enumerate(suffix))
+                return range(position + len(suffix) + 1,
+                    position + len(suffix) + 7), tuple(separators)
+
+            if directive not in _DIRECTIVE_WIDTHS:
+                return None
+
+            position += _DIRECTIVE_WIDTHS[directive]
+            index += 2
+        else:
+            separators.append((position, c))
+            position += 1
+            index += 1
+
+    return (position, ), tuple(separators)
+
+# -----------------------------------------------------------------------------
+# Formatters. The built-in formats render through the C implemented
+# isoformat(), any other strftime pattern is compiled once into a function
+# that renders a datetime with a single %-format of its attributes. Patterns
+# using directives other than those below fall back to strftime. Note that
+# the year is always zero padded to 4 digits, which strftime doesn't do on
+# all platforms. Patterns with a %z render the offset of an aware datetime,
+# naive ones are treated as local time.
+
+_FORMAT_FIELDS = {
+    'Y': ('%04d', 'year'),
+    'm': ('%02d', 'month'),
+    'd': ('%02d', 'day'),
+    'H': ('%02d', 'hour'),
+    'M': ('%02d', 'minute'),
+    'S': ('%02d', 'second'),
+    'f': ('%06d', 'microsecond'),
+}
+
+# compiled formatters, keyed on the pattern (or ('iso_micro', pattern)) so
+# that changes to parse_formats are picked up automatically
+_FORMATTERS = {
+    '%Y-%m-%d': lambda d: d.date().isoformat(),
+    '%H:%M': lambda d: d.time().isoformat('minutes'),
+    '%H:%M:%S': lambda d: d.time().isoformat('seconds'),
+    '%Y-%m-%d %H:%M': lambda d: d.isoformat(' ', 'minutes'),
+    '%Y-%m-%d %H:%M:%S': lambda d: d.isoformat(' ', 'seconds'),
+    '%Y-%m-%dT%H:%MZ': lambda d: d.isoformat('T', 'minutes') + 'Z',
+    '%Y-%m-%dT%H:%M:%SZ': lambda d: d.isoformat('T', 'seconds') + 'Z',
+    ('iso_micro', '%Y-%m-%dT%H:%M:%SZ'): lambda d: \
+        d.isoformat('T', 'seconds') + '.%dZ' % d.microsecond,
+    '%Y-%m-%dT%H:%M:%S%z': lambda d: \
+        _as_aware(d).isoformat('T', 'seconds'),
+    '%Y-%m-%dT%H:%M:%S.%f%z': lambda d: \
+        _as_aware(d).isoformat('T', 'microseconds'),
+}
+
+
+def _as_aware(dt):
+    if dt.tzinfo is None:
+        return dt.astimezone()
+
+    return dt
+
+
+def _compile_template(pattern, suffix='', suffix_attributes=()):
+    # returns a function rendering the pattern with a single %-format, or
+    # None if the pattern uses a directive that isn't in _FORMAT_FIELDS
+    template = []
+    attributes = []
+    index = 0
+    while index < len(pattern):
+        c = pattern[index]
+        if c != '%':
+            template.append(c)
+            index += 1
+            continue
+
+        directive = pattern[index + 1:index + 2]
+        if directive == '%':
+            template.append('%%')
+        elif directive in _FORMAT_FIELDS:
+            template.append(_FORMAT_FIELDS[directive][0])
+            attributes.append(_FORMAT_FIELDS[directive][1])
+        else:
+            return None
+
+        index += 2
+
+    template = ''.join(template) + suffix
+    attributes.extend(suffix_attributes)
+    if not attributes:
+        return lambda dt: template % ()
+
+    getter = attrgetter(*attributes)
+    return lambda dt: template % getter(dt)
+
+
+def _compile_formatter(pattern, iso_micro=False):
+    if iso_micro:
+        # iso_micro needs special handling as python's %f returns a zero
+        # padded number but the standard doesn't pad the value, the last
+        # character of the rendered pattern is replaced by the unpadded
+        # microseconds and a 'Z'
+        if len(pattern) >= 2 and pattern[-2] != '%':
+            formatter = _compile_template(pattern[:-1], '.%dZ',
+                ('microsecond', ))
+            if formatter is not None:
+                return formatter
+
+        base = _compile_formatter(pattern)
+        return lambda dt: base(dt)[:-1] + '.%dZ' % dt.microsecond
+
+    if '%z' in pattern:
+        return lambda dt: _as_aware(dt).strftime(pattern)
+
+    formatter = _compile_template(pattern)
+    if formatter is None:
+        return lambda dt: dt.strftime(pattern)
+
+    return formatter
+
+
+def _formatter(name, formats):
+    # returns the compiled formatter for the named entry in formats
+    if name == 'iso_micro':
+        key = (name, formats['datetime_sec_utc'])
+    else:
+        key = formats[name]
+        if _CUSTOM_FORMATTERS:
+            custom = _CUSTOM_FORMATTERS.get(name)
+            if custom is not None and custom[0] == key:
+                return custom[1]
+
+    formatter = _FORMATTERS.get(key)
+    if formatter is None:
+        if name == 'iso_micro':
+            formatter = _compile_formatter(key[1], True)
+        else:
+            formatter = _compile_formatter(key)
+
+        _FORMATTERS[key] = formatter
+
+    return formatter
+
+
+# =============================================================================
+
+class ParseCache(object):
+    """Size bounded cache of parse results keyed on (format name, string),
+    for streams where the same timestamp strings repeat.  Caching is off by
+    default, turn it on by assigning an instance to
+    :attr:`When.parse_cache`::
+
+        >>> When.parse_cache = ParseCache(capacity=4096)
+        >>> When(detect='1972-01-31 13:55')
+        >>> When.parse_cache.stats()
+        {'hits': 0, 'misses': 1, 'evictions': 0, 'size': 1, 'capacity': 4096}
+
+    The cache isn't aware of changes to :attr:`When.parse_formats`, call
+    :meth:`ParseCache.clear` after modifying them.  Lookups are guarded by
+    a lock shared by every thread.
+
+    :param capacity:
+        Maximum number of results to keep, defaults to 1024
+    :param policy:
+        Which entry to evict when full: ``'lru'`` (the default) evicts the
+        least recently used entry, ``'fifo'`` evicts the oldest entry
+        regardless of use, which makes hits slightly cheaper
+    """
+    def __init__(self, capacity=1024, policy='lru'):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+
+        if policy not in ('lru', 'fifo'):
+            raise ValueError('unknown eviction policy: %r' % (policy, ))
+
+        self.capacity = capacity
+        self.policy = policy
+        import threading
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Returns the cached result for key, or None if it isn't cached."""
+        with self._lock:
+            result = self._data.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self.policy == 'lru':
+                    self._data.move_to_end(key)
+
+            return result
+
+    def put(self, key, value):
+        """Caches value under key, evicting an entry if the cache is full."""
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns a dictionary with the ``hits``, ``misses``,
+        ``evictions``, ``size`` and ``capacity`` of the cache."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'capacity': self.capacity,
+        }
+
+# =============================================================================
+
+class ParseStats(object):
+    """Counters describing the string parsing done by ``When``, for finding
+    out which formats a stream actually uses and what detection costs.
+    Instrumentation is off by default and costs nothing then, turn it on by
+    assigning an instance to :attr:`When.parse_stats`::
+
+        >>> When.parse_stats = ParseStats()
+        >>> When(detect='1972-01-31 13:55')
+        >>> When.parse_stats.snapshot()
+        {'parses': {'datetime': 1}, 'errors': {}, 'detect_depths': {1: 1},
+            'seconds': {}}
+
+    Only strings that are actually parsed are counted, results served by a
+    :class:`ParseCache` are not.
+
+    :param timing:
+        If True the total time spent parsing is kept for each format.
+        Defaults to False.
+    :param hook:
+        Optional function called after every parse with the arguments
+        ``(value, name, depth, seconds, error)``: the string, the name of
+        the format it was parsed with (or None if detection failed), the
+        number of formats tried, the time taken (None without ``timing``)
+        and the ``ValueError`` raised, or None on success.
+    """
+    def __init__(self, timing=False, hook=None):
+        self.timing = timing
+        self.hook = hook
+        import threading
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Resets the counters."""
+        with self._lock:
+            self._parses = {}
+            self._errors = {}
+            self._depths = {}
+            self._seconds = {}
+
+    def record(self, value, name, depth, seconds=None, error=None,
+            detected=False):
+        """Counts one parse, called by ``When`` for every string it parses.
+
+        :param value:
+            The string parsed
+        :param name:
+            Name of the format used, None if detection failed
+        :param depth:
+            Number of formats tried
+        :param seconds:
+            Time taken, or None if not timed
+        :param error:
+            The ``ValueError`` raised, None on success
+        :param detected:
+            True if the format was detected, detection depths are counted
+            separately
+        """
+        key = 'detect' if name is None else name
+        with self._lock:
+            if error is None:
+                self._parses[key] = self._parses.get(key, 0) + 1
+            else:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+            if detected:
+                self._depths[depth] = self._depths.get(depth, 0) + 1
+
+            if seconds is not None:
+                self._seconds[key] = self._seconds.get(key, 0.0) + seconds
+
+        if self.hook is not None:
+            self.hook(value, name, depth, seconds, error)
+
+    def snapshot(self):
+        """Returns a copy of the counters as a dictionary:
+
+        * ``'parses'`` -- successful parses for each format name
+        * ``'errors'`` -- failures for each format name, ``'detect'`` for
+          strings detection couldn't parse
+        * ``'detect_depths'`` -- histogram of how many formats detection
+          tried for each string, including the one that matched
+        * ``'seconds'`` -- total parse time for each format name, empty
+          without ``timing``
+        """
+        with self._lock:
+            return {
+                'parses': dict(self._parses),
+                'errors': dict(self._errors),
+                'detect_depths': dict(self._depths),
+                'seconds': dict(self._seconds),
+            }
+
+# =============================================================================
+
 class TimeOnlyError(Exception):
     """Exception indicating that a date operation was attempted on a
     :class:`When` object that only wraps a python ``time`` instance."""
@@ -41,12 +743,42 @@ class When(object):
         'datetime_utc': '%Y-%m-%dT%H:%MZ'
         'datetime_sec_utc': '%Y-%m-%dT%H:%M:%SZ'
         'iso_micro': '%Y-%m-%dT%H:%M:%S.%fZ'
+        'iso_offset': '%Y-%m-%dT%H:%M:%S%z'
+        'iso_micro_offset': '%Y-%m-%dT%H:%M:%S.%f%z'
+
+    More formats can be added with :meth:`When.register_format`.
+
+    Parsing also accepts ``'iso8601'``, which isn't a display format: the
+    RFC 3339 profile of ISO 8601 with a ``T``, ``t`` or space separator,
+    optional seconds, a ``.`` or ``,`` fraction of any number of digits
+    (anything below a microsecond is dropped) and a ``Z``, ``+hh:mm``,
+    ``+hhmm`` or ``+hh`` offset, or none.  Detection tries it when no format
+    layout matches.  Values with an offset can be displayed with
+    ``string.iso_micro`` or ``string.iso_micro_offset``.
 
     .. warning::
 
-        All python ``datetime`` objects in this class are naive and have no
-        timezone information associated with them, this includes various
-        formats labelled "utc".
+        The python ``datetime`` wrapped by this class is always naive, it
+        holds the wall clock time.  Without a ``tz`` that time is treated as
+        local time, this includes the various formats labelled "utc".
+
+    ``When`` objects can be compared, hashed, truncated with
+    :meth:`When.floor` and shifted by adding or subtracting a ``timedelta``,
+    following the rules of ``datetime`` (``time`` for time only values).
+    These work on an integer of microseconds rather than the wrapped
+    ``datetime``.  Don't change a ``When`` that is used as a dictionary key.
+
+    A ``When`` can carry a time zone in :attr:`tz`, either passed to the
+    constructor or taken from the string or ``datetime`` it was created
+    from: strings ending in ``Z`` are UTC and the ``_offset`` formats
+    parse ``+hh:mm`` offsets.  With a zone the epoch values are exact, the
+    "utc" formats render the UTC time and the ``_offset`` formats render
+    the zone's offset.  Conversions use a :class:`ZoneTable`.
+
+    Parsing and detection take no locks and only use ``strptime`` for
+    custom formats with directives other than ``%Y %m %d %H %M %S %f``, so
+    they can run in many threads at once.  :attr:`When.parse_cache` and
+    :attr:`When.parse_stats` take a lock on every parse when turned on.
     """
     parse_formats = {
         'date': '%Y-%m-%d',
@@ -57,9 +789,21 @@ class When(object):
         'datetime_utc': '%Y-%m-%dT%H:%MZ',
         'datetime_sec_utc': '%Y-%m-%dT%H:%M:%SZ',
         'iso_micro': '%Y-%m-%dT%H:%M:%S.%fZ',
+        'iso_offset': '%Y-%m-%dT%H:%M:%S%z',
+        'iso_micro_offset': '%Y-%m-%dT%H:%M:%S.%f%z',
     }
 
+    #: Optional :class:`ParseCache` used by the ``detect`` and ``parse_*``
+    #: keywords, None (the default) disables caching
+    parse_cache = None
+
+    #: Optional :class:`ParseStats` counting the strings parsed, None (the
+    #: default) disables instrumentation
+    parse_stats = None
+
     class WhenStrformat(object):
+        __slots__ = ('when', )
+
         def __init__(self, when):
             self.when = when
 
@@ -67,19 +811,9 @@ class When(object):
             if name == 'when':
                 return object.__getattribute__(self, name)
 
-            formatter = self.when.parse_formats[name]
-            if name == 'iso_micro':
-                # iso_micro needs special handling as python's %f returns a
-                # zero padded number but the standard doesn't pad the value
-                formatter = self.when.parse_formats['datetime_sec_utc']
-
-            result = self.when.datetime.strftime(formatter)
-
-            if name == 'iso_micro':
-                result = result[:-1] + '.%dZ' % int(
-                    self.when.datetime.strftime('%f'))
-
-            return result
+            when = object.__getattribute__(self, 'when')
+            formatter = _formatter(name, when.parse_formats)
+            return formatter(when._zoned(when.parse_formats[name]))
 
 
     def __init__(self, **kwargs):
@@ -91,7 +825,8 @@ class When(object):
         available.
 
         :param datetime:
-            Create ``When`` using a python ``datetime`` object
+            Create ``When`` using a python ``datetime`` object.  If it is
+            aware its wall clock time is kept and its zone becomes ``tz``.
         :param date:
             Create ``When`` using a python ``date`` object, can be used in
             conjunction with the ``time`` keyword.  If used without the
@@ -110,13 +845,33 @@ class When(object):
         :param milli_epoch:
             Create ``When`` using an integer that is 1000 * an epoch value with
             the last thousands being milli-epoch.
+        :param micro_epoch:
+            Create ``When`` using an integer number of microseconds since
+            the epoch.
+        :param nano_epoch:
+            Create ``When`` using an integer number of nanoseconds since the
+            epoch, anything below a microsecond is dropped.
+        :param tz:
+            Optional time zone name, ``zoneinfo.ZoneInfo`` or fixed offset
+            ``datetime.timezone``, the wrapped date/time is treated as the
+            wall clock time in that zone when converting to and from epoch
+            values instead of the host's local time.  The conversions are
+            done arithmetically through a :class:`ZoneTable`.  The wrapped
+            ``datetime`` is still naive.  Aware ``datetime`` objects and
+            strings with a UTC offset are converted to this zone's wall
+            clock time.
         :param detect:
             Create ``When`` by parsing a string which is compared against the
             list of available string parsers.
         :param parse_*: 
             Create ``When`` by parsing a string using the specific 
             :ref:`Supported formats <when-formats>` given.
-            For example, ``parse_iso_micro`` expects the ISO 8601 format.
+            For example, ``parse_iso_micro`` expects the ISO 8601 format
+            and ``parse_iso8601`` accepts any RFC 3339 date/time.
+
+        ``detect`` and ``parse_*`` also accept ASCII ``bytes``,
+        ``bytearray``, ``memoryview`` and ``mmap`` values, see
+        :meth:`When.from_buffer` for parsing a slice of a larger buffer.
 
         :raises ValueError:
             If a bad string is passed to ``detect`` or ``parse_*`` keywords
@@ -124,11 +879,21 @@ class When(object):
             If the constructor was called without sufficient arguments to
             result in a date or time being wrapped.
         """
-        self._datetime = None
+        # the datetime is built on first use for the integer epoch keywords,
+        # until then _micro holds its microseconds and _epoch its epoch.
+        # _epoch, _date, _timeof and _wall memoize the derived values, they
+        # are reset when the datetime or tz are changed
+        self._dt = None
+        self._micro = None
+        self._epoch = None
+        self._date = None
+        self._timeof = None
+        self._wall = None
         self._time = None
+        self._tz = kwargs.get('tz')
 
         if 'datetime' in kwargs:
-            self._datetime = kwargs['datetime']
+            self._set_datetime(kwargs['datetime'])
         elif 'date' in kwargs:
             d = kwargs['date']
             if 'time' in kwargs:
@@ -145,85 +910,2756 @@ class When(object):
         elif 'time_string' in kwargs:
             self._time = self._parse_time_string(kwargs['time_string'])
         elif 'epoch' in kwargs:
-            self._datetime = datetime.fromtimestamp(kwargs['epoch'])
+            epoch = kwargs['epoch']
+            if not isinstance(epoch, float):
+                self._set_epoch(epoch, 1)
+            elif self.tz is None:
+                self._datetime = datetime.fromtimestamp(epoch)
+            else:
+                self._datetime = ZoneTable.get(self.tz).from_epoch(epoch)
         elif 'milli_epoch' in kwargs:
-            mepoch = kwargs['milli_epoch']
-            epoch = float(mepoch) / 1000.0
-            milli = float(mepoch) - (epoch * 1000.0)
-            self._datetime = datetime.fromtimestamp(long(epoch))
-            self._datetime.replace(microsecond = int(milli / 10.0))
+            self._set_epoch(kwargs['milli_epoch'], 1000)
+        elif 'micro_epoch' in kwargs:
+            self._set_epoch(kwargs['micro_epoch'], 1000000)
+        elif 'nano_epoch' in kwargs:
+            self._set_epoch(kwargs['nano_epoch'], 1000000000)
         elif 'detect' in kwargs:
-            for f in self.parse_formats.values():
-                try:
-                    self._datetime = datetime.strptime(kwargs['detect'], f)
-                    break
-                except ValueError:
-                    # couldn't parse using this format, ignore and try again
-                    pass
+            value = kwargs['detect']
+            if not isinstance(value, str):
+                value = _decode(value)
 
-            if not self._datetime:
-                # nothing parsed
-                raise ValueError(('could not parse the date/time passed to '
-                    'detect'))
+            self._set_datetime(self._parse(None, value), value[-1:] == 'Z')
         else:
             # loop through all the possible kwargs looking for parse_* keys,
             # if found parse based on that and stop
             for key, value in kwargs.items():
                 if key.startswith('parse_'):
-                    f = self.parse_formats[key[6:]]
-                    if key.startswith('parse_time'):
-                        self._time = self._parse_time_string(value)
+                    name = key[6:]
+                    if name not in self.parse_formats and \
+                            name != 'iso8601':
+                        raise KeyError(name)
+
+                    if not isinstance(value, str):
+                        value = _decode(value)
+
+                    if self._is_time_format(name):
+                        self._time = self._parse(name, value)
                     else:
-                        self._datetime = datetime.strptime(value, f)
+                        self._set_datetime(self._parse(name, value),
+                            value[-1:] == 'Z')
 
                     break
 
-        if not self._datetime and not self._time:
+        if self._dt is None and self._micro is None and not self._time:
             raise AttributeError('invalid keyword arguments')
 
-    def _parse_time_string(self, value):
-        parts = value.split(':')
-        parts = [int(p) for p in parts]
-        return time(*parts)
+    def _set_datetime(self, dt, utc=False):
+        # an aware datetime, or a naive one parsed from a string ending in
+        # 'Z' when utc is True, is stored as its wall clock time with its
+        # zone in tz; if a tz was given the instant is converted to that
+        # zone's wall clock time instead
+        # only called from the constructor, so the memos are still unset and
+        # the common cases can assign the fields directly
+        if dt.tzinfo is None:
+            if not utc:
+                self._dt = dt
+                return
 
-    @property
-    def string(self):
-        """Returns a placeholder object that has an attribute for each one of
-        the :ref:`Supported formats <when-formats>`.  
+            if self._tz is None:
+                self._tz = 'UTC'
+                self._dt = dt
+                return
 
-        Example::
+            dt = dt.replace(tzinfo=_UTC)
 
-            >>> When(datetime=d).string.iso_micro
-            1972-01-31T13:45:00.2
+        if self.tz is None:
+            self.tz = _aware_zone_name(dt)
+            self._datetime = dt.replace(tzinfo=None)
+        else:
+            epoch = (dt - _EPOCH_UTC) // _SECOND
+            self._datetime = ZoneTable.get(self.tz).from_epoch(
+                epoch).replace(microsecond=dt.microsecond)
 
-        """
-        return When.WhenStrformat(self)
+    def _zoned(self, pattern):
+        # the datetime to render pattern with: aware for the offset formats
+        # and, when there is a tz, in UTC for the formats ending in 'Z'
+        dt = self._dt
+        if dt is None:
+            dt = self._datetime
+            if dt is None:
+                return None
 
-    @property
-    def date(self):
-        """Returns a python ``date`` object."""
-        return self._datetime.date()
+        if '%z' in pattern:
+            return self.aware
+
+        if self._tz is not None and pattern[-1:] == 'Z' and \
+                pattern[-2:] != '%Z':
+            return _EPOCH + timedelta(0, self.epoch, dt.microsecond)
+
+        return dt
+
+    def _set_epoch(self, value, per_second):
+        # integer only split of an epoch counted in 1/per_second units into
+        # whole seconds and microseconds, the datetime isn't built until it
+        # is needed
+        seconds, fraction = divmod(value, per_second)
+        self._datetime = None
+        self._epoch = int(seconds)
+        self._micro = int(fraction * 1000000 // per_second)
+
+    @classmethod
+    def _from_wall(cls, micros, tz=None, time_only=False):
+        # a When holding the integer wall clock value used by comparisons and
+        # arithmetic, see _wall_micros; the datetime is built when needed
+        when = cls.__new__(cls)
+        when._dt = when._micro = when._epoch = None
+        when._date = when._timeof = None
+        when._wall = micros
+        when._time = _micros_to_time(micros) if time_only else None
+        when._tz = tz
+        return when
 
     @property
-    def datetime(self):
-        """Returns a python ``datetime`` object."""
-        return self._datetime
+    def _datetime(self):
+        # the wrapped datetime, built here for the epoch keywords, where the
+        # whole seconds go through the local time or tz conversion, and for
+        # the results of arithmetic
+        dt = self._dt
+        if dt is None:
+            if self._micro is not None:
+                if self._tz is None:
+                    dt = datetime.fromtimestamp(self._epoch)
+                else:
+                    dt = ZoneTable.get(self._tz).from_epoch(self._epoch)
+
+                if self._micro:
+                    dt = dt.replace(microsecond=self._micro)
+
+                self._dt = dt
+                self._micro = None
+            elif self._wall is not None and self._time is None:
+                dt = self._dt = _micros_to_datetime(self._wall)
+
+        return dt
+
+    @_datetime.setter
+    def _datetime(self, dt):
+        self._dt = dt
+        self._micro = None
+        self._epoch = None
+        self._date = None
+        self._timeof = None
+        self._wall = None
 
     @property
-    def time(self):
-        """Returns a python ``time`` object."""
-        if self._datetime:
-            return self._datetime.time()
+    def _wall_micros(self):
+        # microseconds between 1970-01-01 and the wall clock date and time,
+        # or since midnight for time only values
+        result = self._wall
+        if result is None:
+            if self._time is not None:
+                result = _time_to_micros(self._time)
+            else:
+                result = _datetime_to_micros(self._datetime)
+
+            self._wall = result
+
+        return result
+
+    # -------------------------------------------------------------------------
+    # Comparison and arithmetic work on the integer wall clock value and
+    # follow the rules of datetime and time: values with the same zone, or
+    # none, compare by wall clock time, values with different zones compare
+    # as instants, and a value with a zone can't be ordered against one
+    # without. Time only values only compare with each other and don't do
+    # arithmetic.
+
+    def _pair(self, other, ordered=True):
+        # the integers to compare self and other by; if they can't be
+        # ordered raises a TypeError, or returns None if ordered is False
+        if (self._time is None) == (other._time is None):
+            if self._time is not None or self._tz == other._tz:
+                a = self._wall
+                b = other._wall
+                if a is None:
+                    a = self._wall_micros
+                if b is None:
+                    b = other._wall_micros
+
+                return a, b
+
+            if self._tz is not None and other._tz is not None:
+                return self._instant, other._instant
 
-        return self._time
+        if not ordered:
+            return None
+
+        raise TypeError('can\'t compare %s with %s' % (self._kind(),
+            other._kind()))
 
     @property
-    def epoch(self):
-        """Returns an integer version of epoch, i.e. the number of seconds
-        since Jan 1, 1970."""
-        return long(time_mod.mktime(self._datetime.timetuple()))
+    def _instant(self):
+        # microseconds since the epoch of the wall clock value in tz, which
+        # unlike micro_epoch doesn't depend on the epoch the value was
+        # created from when the wall clock time is ambiguous
+        return ZoneTable.get(self._tz).to_epoch(self._datetime) * \
+            _MICROS_PER_SECOND + self._microsecond
+
+    def _kind(self):
+        if self._time is not None:
+            return 'a time only When'
+
+        if self._tz is None:
+            return 'a When without a time zone'
+
+        return 'a When with a time zone'
+
+    def __eq__(self, other):
+        if not isinstance(other, When):
+            return NotImplemented
+
+        pair = self._pair(other, False)
+        return pair is not None and pair[0] == pair[1]
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    def __lt__(self, other):
+        if not isinstance(other, When):
+            return NotImplemented
+
+        a, b = self._pair(other)
+        return a < b
+
+    def __le__(self, other):
+        if not isinstance(other, When):
+            return NotImplemented
+
+        a, b = self._pair(other)
+        return a <= b
+
+    def __gt__(self, other):
+        if not isinstance(other, When):
+            return NotImplemented
+
+        a, b = self._pair(other)
+        return a > b
+
+    def __ge__(self, other):
+        if not isinstance(other, When):
+            return NotImplemented
+
+        a, b = self._pair(other)
+        return a >= b
+
+    def __hash__(self):
+        # values with a zone are equal to other zones' values at the same
+        # instant, so they hash the instant
+        if self._time is not None or self._tz is None:
+            return hash(self._wall_micros)
+
+        return hash(self._instant)
+
+    def __add__(self, other):
+        if not isinstance(other, timedelta) or self._time is not None:
+            return NotImplemented
+
+        return self._from_wall(self._wall_micros + other // _MICROSECOND,
+            self._tz)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, When):
+            if self._time is not None:
+                return NotImplemented
+
+            a, b = self._pair(other)
+            return timedelta(microseconds=a - b)
+
+        if not isinstance(other, timedelta) or self._time is not None:
+            return NotImplemented
+
+        return self._from_wall(self._wall_micros - other // _MICROSECOND,
+            self._tz)
+
+    def floor(self, unit):
+        """Returns a new ``When`` truncated to a unit of time, for putting
+        values in buckets::
+
+            >>> When(detect='1972-01-31 13:55:07').floor('hour').datetime
+            datetime.datetime(1972, 1, 31, 13, 0)
+            >>> When(detect='1972-01-31 13:55:07').floor(
+            ...     timedelta(minutes=15)).datetime
+            datetime.datetime(1972, 1, 31, 13, 45)
+
+        The wall clock time is truncated, so ``'day'`` gives midnight in the
+        value's zone.
+
+        :param unit:
+            One of ``'second'``, ``'minute'``, ``'hour'`` or ``'day'``, or a
+            ``timedelta`` bucket size.  Buckets start at 1970-01-01 00:00,
+            or at midnight for time only values.
+        """
+        size = _floor_size(unit)
+        micros = self._wall_micros
+        return self._from_wall(micros - micros % size, self._tz,
+            self._time is not None)
+
+    @classmethod
+    def series(cls, start, end=None, step='day', every=1, output='when',
+            name='iso_micro', tz=None, unit='s'):
+        """Returns an iterator of evenly spaced date/times, for building
+        time axes::
+
+            >>> [w.string.date for w in When.series(
+            ...     When(detect='1972-01-31'), When(detect='1972-05-01'),
+            ...     'month')]
+            ['1972-01-31', '1972-02-29', '1972-03-31', '1972-04-30']
+
+        Values are produced as they are iterated, from the integer wall
+        clock microseconds, so the ``'string'`` and ``'epoch'`` outputs
+        don't build a ``When`` for each one and ``'epoch'`` with a ``tz``
+        doesn't build a ``datetime`` either.  Steps are in wall clock
+        time, a ``'day'`` step keeps the time of day across daylight
+        saving changes.
+
+        :param start:
+            First value: a :class:`When`, :class:`CompactWhen`,
+            ``datetime`` or integer microseconds, as for
+            :meth:`WhenArray.index_range`
+        :param end:
+            End of the series, exclusive, same types as ``start``.
+            Defaults to None, an endless series.  A ``When`` bound with a
+            different ``tz`` is converted to the series' zone.
+        :param step:
+            One of ``'second'``, ``'minute'``, ``'hour'`` or ``'day'``, a
+            ``timedelta``, or ``'month'`` or ``'year'`` for calendar steps
+            that keep the start's day of the month, or the last day of
+            shorter months
+        :param every:
+            Number of steps between values, defaults to 1
+        :param output:
+            What to produce for each value:
+
+            * ``'when'`` -- ``When`` objects, the default
+            * ``'datetime'`` -- python ``datetime`` objects
+            * ``'string'`` -- strings in the format given by ``name``
+            * ``'epoch'`` -- integer epochs in ``unit``
+            * ``'array'`` -- a :class:`WhenArray` of the whole series,
+              rather than an iterator; ``end`` is required
+
+        :param name:
+            Name of one of the :ref:`Supported formats <when-formats>` for
+            the ``'string'`` output, defaults to ``'iso_micro'``
+        :param tz:
+            Optional time zone of the values, defaults to the zone of
+            ``start`` if it is a ``When``
+        :param unit:
+            Unit of the ``'epoch'`` output, one of ``'s'`` (the default),
+            ``'ms'``, ``'us'`` or ``'ns'``
+
+        :raises ValueError:
+            If ``step`` or ``output`` aren't one of the choices above
+        :raises TimeOnlyError:
+            If ``start`` or ``end`` is a time only value
+        """
+        if output not in ('when', 'datetime', 'string', 'epoch', 'array'):
+            raise ValueError('unknown output type: %r' % (output, ))
+
+        for bound in (start, end):
+            if isinstance(bound, time) or (isinstance(bound, When) and
+                    bound._time is not None) or (isinstance(bound,
+                    CompactWhen) and bound.time_only):
+                raise TimeOnlyError('a series needs dates and times')
+
+        if tz is None and isinstance(start, When):
+            tz = start.tz
+
+        if output == 'array' and end is None:
+            raise ValueError('an array series needs an end')
+
+        def wall(bound):
+            # bounds are wall clock times in the series' zone
+            if isinstance(bound, When) and bound._tz is not None and \
+                    bound._tz != tz:
+                bound = bound.astimezone(tz)
+
+            return _to_micros(bound)
+
+        micros = _series_micros(wall(start),
+            None if end is None else wall(end), step, every)
+
+        if output == 'when':
+            from_wall = cls._from_wall
+            return (from_wall(m, tz) for m in micros)
+        elif output == 'datetime':
+            return map(_micros_to_datetime, micros)
+        elif output == 'array':
+            return WhenArray(array('q', micros))
+        elif output == 'string':
+            pattern = cls.parse_formats[name]
+            if tz is not None or '%z' in pattern:
+                # zoned rendering, see _zoned
+                from_wall = cls._from_wall
+                return (getattr(from_wall(m, tz).string, name)
+                    for m in micros)
+
+            formatter = _formatter(name, cls.parse_formats)
+            return (formatter(_micros_to_datetime(m)) for m in micros)
+
+        per_second = _epoch_unit(unit)
+        if tz is None:
+            mktime = time_mod.mktime
+            epochs = ((long(mktime(_micros_to_datetime(m).timetuple())), m)
+                for m in micros)
+        else:
+            wall_offset = ZoneTable.get(tz).wall_offset
+            epochs = ((m // _MICROS_PER_SECOND - wall_offset(
+                m // _MICROS_PER_SECOND), m) for m in micros)
+
+        return (e * per_second + m % _MICROS_PER_SECOND * per_second //
+            _MICROS_PER_SECOND for e, m in epochs)
 
     @property
-    def milli_epoch(self):
-        """Returns an int of the epoch * 1000 + milliseconds."""
-        return self.epoch * 1000 + self._datetime.microsecond * 10
+    def tz(self):
+        """Time zone the wrapped date/time is the wall clock time in, as
+        passed to the constructor or taken from a parsed offset.  None for
+        local time.  Changing it keeps the wall clock time."""
+        return self._tz
+
+    @tz.setter
+    def tz(self, tz):
+        # build the datetime from a pending epoch before its zone changes
+        self._datetime
+        self._tz = tz
+        self._epoch = None
+
+    @classmethod
+    def _parse(cls, name, value):
+        # all string parsing goes through here, name is a format name or
+        # None to detect the format; returns a time for the time formats and
+        # a datetime otherwise. Only immutable datetime and time objects are
+        # cached, so sharing them between When objects is safe
+        cache = cls.parse_cache
+        if cache is not None:
+            key = (name, value)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        if cls.parse_stats is not None:
+            result = cls._parse_counted(name, value)
+        elif name is None:
+            result = cls._detect(value)
+        else:
+            result = cls._parse_format(name, value)
+
+        if cache is not None:
+            cache.put(key, result)
+
+        return result
+
+    @classmethod
+    def _parse_counted(cls, name, value):
+        # does the same as _parse, recording it in parse_stats; kept apart
+        # so that instrumentation costs nothing when it is off
+        stats = cls.parse_stats
+        if stats.timing:
+            start = time_mod.perf_counter()
+
+        detected = name is None
+        depth = 1
+        error = None
+        try:
+            if detected:
+                name, depth, result = cls._detect_counted(value)
+                if name is None:
+                    raise ValueError(
+                        'could not parse the date/time passed to detect')
+            else:
+                result = cls._parse_format(name, value)
+        except ValueError as e:
+            error = e
+
+        seconds = None
+        if stats.timing:
+            seconds = time_mod.perf_counter() - start
+
+        stats.record(value, name, depth, seconds, error, detected)
+        if error is not None:
+            raise error
+
+        return result
+
+    @classmethod
+    def _is_time_format(cls, name):
+        # True if the named format parses to a time rather than a datetime
+        return name != 'iso8601' and _time_only(cls.parse_formats[name])
+
+    @classmethod
+    def _parse_format(cls, name, value):
+        # parses value with the compiled parser for the named format, a
+        # format without date directives gives a time
+        if name == 'iso8601':
+            return _parse_iso8601(value)
+
+        pattern = cls.parse_formats[name]
+        if not _time_only(pattern):
+            return _parser(pattern, name)(value)
+
+        if _TIME_FORMATS.get(name) == pattern:
+            return cls._parse_time_string(value)
+
+        return _parser(pattern, name)(value).time()
+
+    @classmethod
+    def _candidates(cls, value):
+        # generator of the (name, parse) pairs detection tries, in order:
+        # only the registered formats whose layout matches the string's
+        # length and separators, in priority order; then the iso8601
+        # parser; then (non-canonical input that strptime is lenient about,
+        # or a format without a layout) every format in turn
+        formats = cls.parse_formats
+        for _, name, pattern, separators in _DETECT_SHAPES.get(len(value),
+                ()):
+            if formats.get(name) != pattern:
+                # replaced directly in parse_formats
+                continue
+
+            for index, separator in separators:
+                if value[index] != separator:
+                    break
+            else:
+                yield name, _parser(pattern, name)
+
+        yield 'iso8601', _parse_iso8601
+
+        # a snapshot, formats may be registered in other threads meanwhile
+        for name, pattern in tuple(formats.items()):
+            yield name, _parser(pattern, name)
+
+    @classmethod
+    def _detect(cls, value):
+        for _, parse in cls._candidates(value):
+            try:
+                return parse(value)
+            except ValueError:
+                # couldn't parse using this format, ignore and try again
+                pass
+
+        # nothing parsed
+        raise ValueError('could not parse the date/time passed to detect')
+
+    @classmethod
+    def _detect_counted(cls, value):
+        # _detect, returning a (name, depth, result) tuple where depth is the
+        # number of formats tried; name and result are None if nothing
+        # parsed
+        depth = 0
+        for name, parse in cls._candidates(value):
+            depth += 1
+            try:
+                return name, depth, parse(value)
+            except ValueError:
+                pass
+
+        return None, depth, None
+
+    @classmethod
+    def register_format(cls, name, pattern, priority=0, hint=None,
+            parser=None, formatter=None):
+        """Adds a named format, making it available to the ``parse_<name>``
+        keyword, as ``string.<name>`` and to detection.  Registering an
+        existing name replaces it.
+
+        Formats can also be added by putting them in :attr:`parse_formats`
+        directly, but those are only tried by detection after every
+        registered layout has failed to match.
+
+        :param name:
+            Name of the format
+        :param pattern:
+            ``strptime``/``strftime`` pattern for the format.  Patterns using
+            only ``%Y %m %d %H %M %S %f`` are compiled into a parser and a
+            formatter that don't use ``strptime``/``strftime``.  A pattern
+            without any date directives parses to a time only ``When``.
+        :param priority:
+            Detection tries formats with the same layout in order of
+            priority, highest first, then in order of registration.  The
+            built-in formats have priority 0.
+        :param hint:
+            Layout used to decide which strings detection should try this
+            format on: a ``(lengths, separators)`` pair where ``lengths`` is
+            the length, or a list of possible lengths, of a matching string
+            and ``separators`` is a list of ``(index, character)`` pairs that
+            must be present.  Negative indices count from the end of the
+            string.  Defaults to a layout derived from the pattern if all of
+            its directives have a fixed width (``%f`` may be 1 to 6 digits).
+            Pass False to only use the format in detection's slow fallback.
+        :param parser:
+            Optional function that takes a string and returns a ``datetime``,
+            raising ``ValueError`` if it can't be parsed.  Replaces the
+            compiled parser for this format.
+        :param formatter:
+            Optional function that takes a ``datetime`` and returns a
+            string.  Replaces the compiled formatter for this format.
+        """
+        cls.unregister_format(name)
+        if hint is None:
+            hint = _derive_hint(pattern)
+
+        cls.parse_formats[name] = pattern
+        if parser is not None:
+            _CUSTOM_PARSERS[name] = (pattern, parser)
+        if formatter is not None:
+            _CUSTOM_FORMATTERS[name] = (pattern, formatter)
+
+        if hint:
+            lengths, separators = hint
+            if isinstance(lengths, int):
+                lengths = (lengths, )
+
+            entry = ((-priority, next(_REGISTRATIONS)), name, pattern,
+                tuple(separators))
+            for length in lengths:
+                _DETECT_SHAPES[length] = tuple(sorted(
+                    _DETECT_SHAPES.get(length, ()) + (entry, )))
+
+    @classmethod
+    def unregister_format(cls, name):
+        """Removes a named format, does nothing if it doesn't exist."""
+        cls.parse_formats.pop(name, None)
+        _CUSTOM_PARSERS.pop(name, None)
+        _CUSTOM_FORMATTERS.pop(name, None)
+        for length, entries in list(_DETECT_SHAPES.items()):
+            _DETECT_SHAPES[length] = tuple(entry for entry in entries
+                if entry[1] != name)
+
+    @staticmethod
+    def _parse_time_string(value):
+        parts = value.split(':')
+        parts = [int(p) for p in parts]
+        return time(*parts)
+
+    @classmethod
+    def _row_parser(cls, name):
+        # returns a (parse, time_only) pair for parsing many strings with the
+        # named format, or with detection if name is None; parse() returns a
+        # datetime, or a time if time_only is True
+        if name is not None and name not in cls.parse_formats and \
+                name != 'iso8601':
+            raise KeyError(name)
+
+        def parse(value):
+            return cls._parse(name, value)
+
+        # same rule as the parse_* keywords in the constructor
+        return parse, name is not None and cls._is_time_format(name)
+
+    @classmethod
+    def parse_many(cls, values, name=None, output='datetime'):
+        """Parses many strings at once, avoiding the cost of building a
+        ``When`` for each one.  Bad rows don't stop the batch, they are
+        reported by index instead.
+
+        :param values:
+            Any iterable of strings: a list, a generator or a NumPy string
+            array.  ``bytes``, ``bytearray`` and ``memoryview`` values (e.g.
+            from a NumPy ``S`` array) are decoded as ASCII.
+        :param name:
+            Name of one of the :ref:`Supported formats <when-formats>` to
+            parse every value with, or ``'iso8601'``, as used by the
+            ``parse_*`` keywords.  Defaults to None which detects the format
+            of each value separately, like the ``detect`` keyword.
+        :param output:
+            What to return for each value:
+
+            * ``'datetime'`` -- a list of python ``datetime`` objects (or
+              ``time`` objects for the ``time`` formats), None for bad rows.
+              Values parsed with a ``%z`` offset are aware.
+            * ``'when'`` -- a list of ``When`` objects, None for bad rows
+            * ``'epoch'`` -- an ``array('q')`` of integer epochs, as
+              returned by :attr:`When.epoch`, 0 for bad rows.  Use
+              ``numpy.frombuffer(result, dtype='int64')`` for a NumPy view
+              of it without copying.
+            * ``'datetime64'`` -- a NumPy ``datetime64[us]`` array, NaT for
+              bad rows.  Values with an offset are converted to UTC.
+              Requires NumPy to be installed.
+
+        :returns:
+            Tuple ``(results, errors)`` where ``errors`` is a list of
+            ``(index, exception)`` pairs for each value that couldn't be
+            parsed.
+
+        :raises KeyError:
+            If ``name`` isn't a known format
+        :raises ValueError:
+            If ``output`` isn't one of the choices above
+        :raises TimeOnlyError:
+            If ``output`` is ``'epoch'`` or ``'datetime64'`` and ``name`` is
+            one of the time only formats
+        :raises ImportError:
+            If ``output`` is ``'datetime64'`` and NumPy isn't installed
+        """
+        if output not in ('datetime', 'when', 'epoch', 'datetime64'):
+            raise ValueError('unknown output type: %r' % (output, ))
+
+        parse, time_only = cls._row_parser(name)
+        if time_only and output in ('epoch', 'datetime64'):
+            raise TimeOnlyError('%s is a time only format' % name)
+
+        if output == 'datetime64':
+            import numpy
+
+        # like the constructor, strings ending in 'Z' are UTC for the
+        # outputs that depend on the zone
+        zoned = not time_only and output != 'datetime'
+
+        results = []
+        errors = []
+        for index, value in enumerate(values):
+            try:
+                if not isinstance(value, str):
+                    value = _decode(value)
+
+                result = parse(value)
+                if zoned and value[-1:] == 'Z' and result.tzinfo is None:
+                    result = result.replace(tzinfo=_UTC)
+
+                results.append(result)
+            except (ValueError, TypeError) as e:
+                results.append(None)
+                errors.append((index, e))
+
+        if output == 'when':
+            key = 'time' if time_only else 'datetime'
+            results = [None if r is None else cls(**{key:r}) for r in results]
+        elif output == 'epoch':
+            mktime = time_mod.mktime
+            results = array('q', [0 if r is None else
+                long(mktime(r.timetuple())) if r.tzinfo is None else
+                (r - _EPOCH_UTC) // _SECOND for r in results])
+        elif output == 'datetime64':
+            results = numpy.array([r if r is None or r.tzinfo is None else
+                (r - r.utcoffset()).replace(tzinfo=None) for r in results],
+                dtype='datetime64[us]')
+
+        return results, errors
+
+    @classmethod
+    def detect_many(cls, values, output='datetime'):
+        """Same as :meth:`When.parse_many` with the format of each value
+        detected separately."""
+        return cls.parse_many(values, None, output)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset=0, length=None, name=None, tz=None):
+        """Creates a ``When`` from a timestamp inside a larger ``bytes``,
+        ``bytearray``, ``memoryview`` or ``mmap`` buffer.  Only the
+        timestamp's bytes are decoded, the rest of the buffer isn't copied.
+
+        :param buffer:
+            Bytes-like object holding ASCII text
+        :param offset:
+            Index of the timestamp's first byte
+        :param length:
+            Number of bytes in the timestamp, defaults to the rest of the
+            buffer
+        :param name:
+            Name of one of the :ref:`Supported formats <when-formats>` to
+            parse with, defaults to None which detects the format
+        :param tz:
+            Optional time zone, as for the constructor
+
+        :raises ValueError:
+            If the bytes can't be parsed or aren't ASCII
+        """
+        stop = None if length is None else offset + length
+        value = _decode(buffer, offset, stop)
+        key = 'detect' if name is None else 'parse_' + name
+        if tz is None:
+            return cls(**{key:value})
+
+        return cls(tz=tz, **{key:value})
+
+    @classmethod
+    def scan_buffer(cls, buffer, name=None, output='datetime', offset=0,
+            length=None):
+        """Parses a timestamp from every line of a bytes-like buffer, as
+        :meth:`When.parse_many` does for a list of strings.  Lines end in
+        ``\\n`` or ``\\r\\n``, an empty last line is ignored.
+
+        :param buffer:
+            ``bytes``, ``bytearray``, ``memoryview`` or ``mmap`` holding
+            ASCII text
+        :param name:
+            Format name, as for :meth:`When.parse_many`
+        :param output:
+            What to return for each line, as for :meth:`When.parse_many`
+        :param offset:
+            Index within each line of the timestamp's first byte, for fixed
+            width records such as log lines
+        :param length:
+            Number of bytes in each line's timestamp, defaults to the rest
+            of the line
+
+        :returns:
+            Tuple ``(results, errors)`` as for :meth:`When.parse_many`, the
+            indices in ``errors`` are line numbers counting from 0
+        """
+        return cls.parse_many(_buffer_lines(buffer, offset, length), name,
+            output)
+
+    @classmethod
+    def scan_file(cls, path, name=None, output='datetime', offset=0,
+            length=None):
+        """Memory maps the file at ``path`` and parses it with
+        :meth:`When.scan_buffer`, see it for the arguments.  The file is
+        read through the page cache rather than into memory."""
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                # an empty file can't be mapped
+                return cls.parse_many((), name, output)
+
+            import mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.scan_buffer(data, name, output, offset, length)
+
+    @classmethod
+    def format_many(cls, values, name, out=None, workers=None,
+            chunk_size=100000):
+        """Renders many values in one of the :ref:`Supported formats
+        <when-formats>` at once, optionally sharing the work across a pool of
+        processes.  Output is always in the same order as the input.
+
+        :param values:
+            A :class:`WhenArray`, or an iterable of integer epochs (treated
+            as local time, like the ``epoch`` keyword), python ``datetime``
+            objects, :class:`When` or :class:`CompactWhen` objects.  The type
+            of the first item decides how the rest are handled.
+        :param name:
+            Name of the format to render
+        :param out:
+            Optional stream to write to, each value is written followed by a
+            newline.  If not given the strings are returned as a list.
+        :param workers:
+            Number of processes to shard the work across using a
+            ``concurrent.futures.ProcessPoolExecutor``.  Defaults to None,
+            which does everything in this process.  Only a few chunks per
+            worker are in flight at once, so a large iterable isn't read
+            into memory all at once.
+        :param chunk_size:
+            Number of values in each piece of work, defaults to 100000
+
+        :returns:
+            The list of strings, or the number of values written if ``out``
+            was given
+        :raises KeyError:
+            If ``name`` isn't a known format
+        :raises TimeOnlyError:
+            If ``values`` is a time only :class:`WhenArray`
+        """
+        # fail early on an unknown format
+        _formatter(name, cls.parse_formats)
+        if isinstance(values, WhenArray):
+            if values.time_only:
+                raise TimeOnlyError('time only values cannot be formatted')
+
+            chunks = (('micros', values[i:i + chunk_size]) for i in
+                range(0, len(values), chunk_size))
+        else:
+            chunks = _typed_chunks(values, chunk_size)
+
+        results = []
+        count = 0
+
+        def emit(strings):
+            if out is None:
+                results.extend(strings)
+            elif strings:
+                out.write('\n'.join(strings))
+                out.write('\n')
+
+        formats = dict(cls.parse_formats)
+        if workers is None:
+            for kind, chunk in chunks:
+                strings = _format_chunk(kind, chunk, name, formats)
+                count += len(strings)
+                emit(strings)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            pending = deque()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for kind, chunk in chunks:
+                    pending.append(executor.submit(_format_chunk, kind, chunk,
+                        name, formats))
+                    if len(pending) >= workers * 2:
+                        strings = pending.popleft().result()
+                        count += len(strings)
+                        emit(strings)
+
+                while pending:
+                    strings = pending.popleft().result()
+                    count += len(strings)
+                    emit(strings)
+
+        if out is None:
+            return results
+
+        return count
+
+    @property
+    def string(self):
+        """Returns a placeholder object that has an attribute for each one of
+        the :ref:`Supported formats <when-formats>`.  
+
+        Example::
+
+            >>> When(datetime=d).string.iso_micro
+            1972-01-31T13:45:00.2
+
+        """
+        return When.WhenStrformat(self)
+
+    @property
+    def date(self):
+        """Returns a python ``date`` object."""
+        result = self._date
+        if result is None:
+            result = self._date = self._datetime.date()
+
+        return result
+
+    @property
+    def tzinfo(self):
+        """Returns the python ``tzinfo`` of :attr:`tz`: a
+        ``zoneinfo.ZoneInfo`` for a named zone, a ``datetime.timezone`` for
+        UTC or a fixed offset and None if there is no ``tz``."""
+        if self.tz is None:
+            return None
+
+        return ZoneTable.get(self.tz).tzinfo
+
+    @property
+    def aware(self):
+        """Returns an aware python ``datetime`` object in :attr:`tz`, or in
+        the host's local time zone if there is no ``tz``."""
+        if self._datetime is None:
+            raise TimeOnlyError('no time zone for time only values')
+
+        if self.tz is None:
+            return self._datetime.astimezone()
+
+        return self._datetime.replace(tzinfo=self.tzinfo)
+
+    def astimezone(self, tz):
+        """Returns a new ``When`` of the same instant as the wall clock time
+        in another zone.
+
+        :param tz:
+            Time zone name, ``zoneinfo.ZoneInfo`` or fixed offset
+            ``datetime.timezone`` to convert to.  None converts to local
+            time.
+        """
+        if self._time is not None:
+            raise TimeOnlyError('no time zone for time only values')
+
+        return When(micro_epoch=self.micro_epoch, tz=tz)
+
+    @property
+    def datetime(self):
+        """Returns a python ``datetime`` object."""
+        return self._datetime
+
+    @property
+    def time(self):
+        """Returns a python ``time`` object."""
+        result = self._timeof
+        if result is None:
+            dt = self._datetime
+            if dt is None:
+                return self._time
+
+            result = self._timeof = dt.time()
+
+        return result
+
+    @property
+    def epoch(self):
+        """Returns an integer version of epoch, i.e. the number of seconds
+        since Jan 1, 1970.  The wrapped date/time is treated as local time,
+        or as the wall clock time in ``tz`` if one was given.  A ``When``
+        created from an integer epoch returns the seconds it was created
+        with.  The value is computed once and kept."""
+        result = self._epoch
+        if result is None:
+            if self._tz is not None:
+                result = ZoneTable.get(self._tz).to_epoch(self._datetime)
+            else:
+                result = long(time_mod.mktime(self._datetime.timetuple()))
+
+            self._epoch = result
+
+        return result
+
+    @property
+    def _microsecond(self):
+        # microseconds of the datetime, without building it
+        if self._dt is None and self._micro is not None:
+            return self._micro
+
+        return self._datetime.microsecond
+
+    @property
+    def milli_epoch(self):
+        """Returns an int of the epoch * 1000 + milliseconds."""
+        return self.epoch * 1000 + self._microsecond // 1000
+
+    @property
+    def micro_epoch(self):
+        """Returns an int of the epoch * 1000000 + microseconds."""
+        return self.epoch * 1000000 + self._microsecond
+
+    @property
+    def nano_epoch(self):
+        """Returns an int of the number of nanoseconds since the epoch."""
+        return self.micro_epoch * 1000
+
+    # -------------------------------------------------------------------------
+    # Binary encoding
+
+    def to_bytes(self):
+        """Returns the value encoded in a compact binary form that
+        :meth:`When.from_bytes` reads back: a flags byte, the wall clock
+        microseconds as a varint and the zone's name if there is one.  With
+        a zone the microseconds since the epoch are stored instead, as the
+        wall clock time is ambiguous in a repeated hour.  Usually 9 bytes
+        without a zone, where ``string.iso_micro`` is 27.  Pickling a
+        ``When`` stores the same integer rather than its ``datetime`` and
+        memoized values."""
+        flags = 0
+        if self._time is not None:
+            flags |= _TIME_ONLY
+
+        tz = self._tz
+        if tz is not None:
+            flags |= _ZONED
+
+        out = bytearray((flags, ))
+        _write_varint(out, self._instant_micros)
+        if tz is not None:
+            name = _zone_name(tz).encode('ascii')
+            _write_varint(out, len(name))
+            out += name
+
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Creates a ``When`` from the output of :meth:`When.to_bytes`.  A
+        zone is restored as its name.
+
+        :param data:
+            ``bytes`` or another bytes-like object
+
+        :raises ValueError:
+            If the data isn't an encoded ``When``
+        """
+        try:
+            flags = data[0]
+            micros, index = _read_varint(data, 1)
+            tz = None
+            if flags & _ZONED:
+                length, index = _read_varint(data, index)
+                tz = _decode(data, index, index + length)
+                index += length
+
+            if flags & ~(_TIME_ONLY | _ZONED) or index != len(data) or \
+                    (tz is not None and len(tz) != length):
+                raise ValueError()
+        except (IndexError, ValueError):
+            raise ValueError('data is not an encoded When')
+
+        if tz is not None and not flags & _TIME_ONLY:
+            return cls(micro_epoch=micros, tz=tz)
+
+        return cls._from_wall(micros, tz, bool(flags & _TIME_ONLY))
+
+    @property
+    def _instant_micros(self):
+        # the integer to_bytes and pickling store: the micro_epoch of a
+        # zoned date/time, which keeps which side of a repeated hour it is
+        # on, otherwise the wall clock microseconds
+        if self._tz is not None and self._time is None:
+            return self.micro_epoch
+
+        return self._wall_micros
+
+    def __reduce__(self):
+        # the same integer form as to_bytes, pickle encodes the integer
+        # itself more cheaply than a varint can be built in python
+        if self._tz is not None and self._time is None:
+            return (type(self)._from_instant, (self.micro_epoch, self._tz))
+
+        return (type(self)._from_wall, (self._wall_micros, self._tz,
+            self._time is not None))
+
+    @classmethod
+    def _from_instant(cls, micros, tz):
+        return cls(micro_epoch=micros, tz=tz)
+
+
+# index the built-in formats for detection, the offset formats are given
+# the layout of a +hh:mm offset, 'Z' strings match the "utc" formats
+_OFFSET_SEPARATORS = ((4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':'))
+_BUILTIN_HINTS = {
+    'iso_offset': (25, _OFFSET_SEPARATORS + ((22, ':'), )),
+    'iso_micro_offset': (range(27, 33), _OFFSET_SEPARATORS +
+        ((19, '.'), (-3, ':'))),
+}
+
+for _name, _pattern in list(When.parse_formats.items()):
+    When.register_format(_name, _pattern, hint=_BUILTIN_HINTS.get(_name))
+
+
+def warmup(zones=(), cls=When):
+    """Does the one-off work that is otherwise left to the first parse,
+    format or time zone conversion that needs it, for long running services
+    that would rather pay it at startup than on their first request.
+    Importing ``when`` only compiles the fast parsers of the built-in
+    formats.
+
+    :param zones:
+        Time zones, as for the ``tz`` keyword, to build the whole
+        :class:`ZoneTable` of rather than ten years at a time
+    :param cls:
+        ``When`` subclass whose :attr:`When.parse_formats` are compiled,
+        defaults to ``When``
+    """
+    when = cls(datetime=datetime(2000, 1, 1), tz='UTC')
+    when.epoch
+    for name, pattern in cls.parse_formats.items():
+        if name not in _CUSTOM_PARSERS:
+            try:
+                # nothing parses the empty string, so this compiles the full
+                # parser behind any fast path (or imports strptime)
+                _parser(pattern)('')
+            except ValueError:
+                pass
+
+        getattr(when.string, name)
+
+    for tz in zones:
+        table = ZoneTable.get(tz)
+        for index in range(len(table._spans)):
+            table._span(index)
+
+# =============================================================================
+# Compact Representation
+# =============================================================================
+
+_EPOCH = datetime(1970, 1, 1)
+_UTC = timezone.utc
+_EPOCH_UTC = _EPOCH.replace(tzinfo=_UTC)
+_MICROSECOND = timedelta(microseconds=1)
+_MICROS_PER_SECOND = 1000000
+_MICROS_PER_DAY = 86400 * _MICROS_PER_SECOND
+
+
+def _datetime_to_micros(dt):
+    # microseconds between the naive datetime and 1970-01-01, the wall clock
+    # value is used as is, no timezone conversion is done
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def _micros_to_datetime(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _time_to_micros(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * _MICROS_PER_SECOND \
+        + t.microsecond
+
+
+def _micros_to_time(micros):
+    seconds, microsecond = divmod(micros, _MICROS_PER_SECOND)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return time(hour, minute, second, microsecond)
+
+
+_FLOOR_UNITS = {
+    'second': _MICROS_PER_SECOND,
+    'minute': 60 * _MICROS_PER_SECOND,
+    'hour': 3600 * _MICROS_PER_SECOND,
+    'day': _MICROS_PER_DAY,
+}
+
+
+def _floor_size(unit):
+    # size of a floor() unit in microseconds
+    if isinstance(unit, timedelta):
+        size = unit // _MICROSECOND
+        if size <= 0:
+            raise ValueError('floor size must be positive')
+
+        return size
+
+    try:
+        return _FLOOR_UNITS[unit]
+    except KeyError:
+        raise ValueError('unknown floor unit: %r' % (unit, ))
+
+# Series. Fixed steps are counted off in integer microseconds by range(),
+# calendar steps move the year and month and keep the start's day, clamped
+# to the length of shorter months, and its time of day.
+
+_CALENDAR_STEPS = {'month': 1, 'year': 12}
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _days_in_month(year, month):
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or
+            year % 400 == 0):
+        return 29
+
+    return _DAYS_IN_MONTH[month - 1]
+
+
+def _series_micros(start, end, step, every):
+    # iterator of the wall clock microseconds from start up to, but not
+    # including, end (None for no end) every step
+    if step in _CALENDAR_STEPS:
+        months = _CALENDAR_STEPS[step] * every
+        if months <= 0:
+            raise ValueError('series step must be positive')
+
+        return _calendar_micros(start, end, months)
+
+    if isinstance(step, timedelta):
+        size = step // _MICROSECOND * every
+    elif step in _FLOOR_UNITS:
+        size = _FLOOR_UNITS[step] * every
+    else:
+        raise ValueError('unknown series step: %r' % (step, ))
+
+    if size <= 0:
+        raise ValueError('series step must be positive')
+
+    if end is None:
+        return count(start, size)
+
+    return iter(range(start, end, size))
+
+
+def _calendar_micros(start, end, months):
+    days, time_of_day = divmod(start, _MICROS_PER_DAY)
+    first = date.fromordinal(days + _EPOCH_ORDINAL)
+    month_index = first.year * 12 + first.month - 1
+    while month_index < 120000:
+        # month_index counts months from year 0, up to year 9999
+        year, month = divmod(month_index, 12)
+        day = min(first.day, _days_in_month(year, month + 1))
+        micros = (date(year, month + 1, day).toordinal() - _EPOCH_ORDINAL) * \
+            _MICROS_PER_DAY + time_of_day
+        if end is not None and micros >= end:
+            return
+
+        yield micros
+        month_index += months
+
+
+class CompactWhen(object):
+    """Memory efficient, immutable alternative to :class:`When` for when
+    millions of values need to be held at once.  Instead of wrapping a
+    ``datetime`` or ``time`` object it stores a single integer: the number of
+    microseconds since 1970-01-01 00:00 of the (naive) date and time, or the
+    number of microseconds since midnight for a time only value.  The python
+    objects are only built when one of the properties is accessed.
+
+    Create one from a :class:`When`, a ``datetime`` or a ``time``::
+
+        >>> c = CompactWhen.from_when(When(detect='1972-01-31 13:55'))
+        >>> c.string.iso_micro
+        '1972-01-31T13:55:00.0Z'
+
+    :param micros:
+        Integer microseconds since 1970-01-01, or since midnight if
+        ``time_only`` is True
+    :param time_only:
+        True if the value is only a time of day, in which case the date
+        based properties raise a :class:`TimeOnlyError`
+    """
+    __slots__ = ('_micros', '_time_only')
+
+    parse_formats = When.parse_formats
+
+    def __init__(self, micros, time_only=False):
+        if time_only and not 0 <= micros < _MICROS_PER_DAY:
+            raise ValueError('time only value must be within a day')
+
+        object.__setattr__(self, '_micros', micros)
+        object.__setattr__(self, '_time_only', time_only)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CompactWhen is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('CompactWhen is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactWhen):
+            return NotImplemented
+
+        return self._micros == other._micros and \
+            self._time_only == other._time_only
+
+    def __hash__(self):
+        return hash((self._micros, self._time_only))
+
+    def __repr__(self):
+        if self._time_only:
+            return 'CompactWhen(%r, time_only=True)' % self._micros
+
+        return 'CompactWhen(%r)' % self._micros
+
+    def __reduce__(self):
+        return (CompactWhen, (self._micros, self._time_only))
+
+    @classmethod
+    def from_datetime(cls, dt):
+        """Creates a ``CompactWhen`` from a naive python ``datetime``."""
+        return cls(_datetime_to_micros(dt))
+
+    @classmethod
+    def from_time(cls, t):
+        """Creates a time only ``CompactWhen`` from a python ``time``."""
+        return cls(_time_to_micros(t), True)
+
+    @classmethod
+    def from_when(cls, when):
+        """Creates a ``CompactWhen`` with the same value as a
+        :class:`When`.  As a ``CompactWhen`` is always in local time, a
+        ``When`` with a :attr:`When.tz` is converted to local time first."""
+        if when.datetime is None:
+            return cls.from_time(when.time)
+
+        if when.tz is not None:
+            when = when.astimezone(None)
+
+        return cls.from_datetime(when.datetime)
+
+    def to_when(self):
+        """Returns a :class:`When` with the same value."""
+        if self._time_only:
+            return When(time=self.time)
+
+        return When(datetime=self.datetime)
+
+    def _zoned(self, pattern):
+        # always local time, see When._zoned
+        return self.datetime
+
+    @property
+    def micros(self):
+        """The integer backing this object: microseconds since 1970-01-01,
+        or since midnight for a time only value."""
+        return self._micros
+
+    @property
+    def time_only(self):
+        """True if this only holds a time of day."""
+        return self._time_only
+
+    @property
+    def string(self):
+        """Same as :attr:`When.string`."""
+        return When.WhenStrformat(self)
+
+    @property
+    def datetime(self):
+        """Returns a python ``datetime`` object, or None for a time only
+        value."""
+        if self._time_only:
+            return None
+
+        return _micros_to_datetime(self._micros)
+
+    @property
+    def date(self):
+        """Returns a python ``date`` object."""
+        if self._time_only:
+            raise TimeOnlyError('no date in a time only CompactWhen')
+
+        return _EPOCH.date() + timedelta(days=self._micros //
+            _MICROS_PER_DAY)
+
+    @property
+    def time(self):
+        """Returns a python ``time`` object."""
+        return _micros_to_time(self._micros % _MICROS_PER_DAY)
+
+    @property
+    def epoch(self):
+        """Same as :attr:`When.epoch`, the datetime is treated as local
+        time."""
+        if self._time_only:
+            raise TimeOnlyError('no epoch for a time only CompactWhen')
+
+        return long(time_mod.mktime(self.datetime.timetuple()))
+
+    @property
+    def milli_epoch(self):
+        """Returns an int of the epoch * 1000 + milliseconds."""
+        return self.epoch * 1000 + self._micros % _MICROS_PER_SECOND // 1000
+
+    @property
+    def micro_epoch(self):
+        """Returns an int of the epoch * 1000000 + microseconds."""
+        return self.epoch * _MICROS_PER_SECOND + \
+            self._micros % _MICROS_PER_SECOND
+
+    @property
+    def nano_epoch(self):
+        """Returns an int of the number of nanoseconds since the epoch."""
+        return self.micro_epoch * 1000
+
+# =============================================================================
+# Time Zones
+# =============================================================================
+
+_SECOND = timedelta(seconds=1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+# range of instants covered by a ZoneTable's offset table, 1900 to 2100,
+# outside of it conversions go through zoneinfo
+_TABLE_START = -2208988800
+_TABLE_END = 4102444800
+
+# the table is built in spans of about ten years, each on the first
+# conversion of an instant in it
+_SPAN = 3653 * 86400
+_SPANS = -(-(_TABLE_END - _TABLE_START) // _SPAN)
+
+
+def _wall_seconds(dt):
+    # seconds between 1970-01-01 and the naive datetime's wall clock value
+    return (dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + \
+        dt.minute * 60 + dt.second
+
+
+# names of fixed offset zones, the same as str() of a datetime.timezone
+_OFFSET_NAME = r'UTC([+-])(\d\d):(\d\d)(?::(\d\d))?$'
+
+
+def _offset_name(offset):
+    # name of the fixed zone with a UTC offset of the given seconds
+    if offset == 0:
+        return 'UTC'
+
+    sign = '-' if offset < 0 else '+'
+    minutes, seconds = divmod(abs(offset), 60)
+    name = 'UTC%s%02d:%02d' % (sign, minutes // 60, minutes % 60)
+    if seconds:
+        name += ':%02d' % seconds
+
+    return name
+
+
+def _zone_name(tz):
+    if isinstance(tz, str):
+        return tz
+
+    if isinstance(tz, timezone):
+        return _offset_name(tz.utcoffset(None) // _SECOND)
+
+    # zoneinfo.ZoneInfo objects know their name
+    key = getattr(tz, 'key', None)
+    if key is None:
+        raise TypeError('expected a zone name, ZoneInfo or timezone, not %r'
+            % (tz, ))
+
+    return key
+
+
+def _aware_zone_name(dt):
+    # zone name for an aware datetime, other tzinfo implementations are
+    # treated as a fixed offset
+    try:
+        return _zone_name(dt.tzinfo)
+    except TypeError:
+        return _offset_name(dt.utcoffset() // _SECOND)
+
+
+class ZoneTable(object):
+    """Converts between epoch values and naive wall clock date/times in a
+    given time zone without going through the C library's local time
+    functions, so results don't depend on the host's ``TZ`` setting.
+
+    For ``'UTC'`` and fixed offsets (``'UTC+05:30'``) the conversion is
+    plain arithmetic.  For any other zone the UTC offset transitions
+    between 1900 and 2100 are found using the system's tz database through
+    ``zoneinfo`` and kept in sorted tables so each conversion is a binary
+    search.  They are found about ten years at a time, the first time an
+    instant in those years is converted; :func:`warmup` can build the whole
+    range up front.  Instants outside of that range are converted using
+    ``zoneinfo`` directly.  Named zones need Python 3.9 or later.
+
+    Wall clock times that are ambiguous or skipped by a transition are
+    resolved the same way ``zoneinfo`` does with ``fold=0``: the offset from
+    before the transition is used.
+
+    Use :meth:`ZoneTable.get` rather than the constructor to share tables.
+
+    :param name:
+        ``'UTC'``, a fixed offset such as ``'UTC-03:30'`` or a zone name
+        from the tz database such as ``'America/Toronto'``
+    """
+    _tables = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.zone = None
+        self.tzinfo = _UTC
+        # the offset of UTC and fixed offset zones, and the lazily built
+        # (transitions, wall transitions, offsets) tables of the spans of
+        # other zones
+        self._fixed = 0
+        self._spans = ()
+        if name == 'UTC':
+            return
+
+        import re
+        match = re.match(_OFFSET_NAME, name)
+        if match:
+            sign, hours, minutes, seconds = match.groups()
+            offset = int(hours) * 3600 + int(minutes) * 60 + int(seconds or 0)
+            if sign == '-':
+                offset = -offset
+
+            self._fixed = offset
+            self.tzinfo = timezone(timedelta(seconds=offset))
+        else:
+            from zoneinfo import ZoneInfo
+            self.zone = self.tzinfo = ZoneInfo(name)
+            self._fixed = None
+            self._spans = [None] * _SPANS
+
+    @classmethod
+    def get(cls, tz):
+        """Returns the shared table for a zone.
+
+        :param tz:
+            A zone name, ``zoneinfo.ZoneInfo`` or ``datetime.timezone``
+        """
+        name = _zone_name(tz)
+        table = cls._tables.get(name)
+        if table is None:
+            table = cls._tables.setdefault(name, cls(name))
+
+        return table
+
+    def _offset(self, epoch):
+        # the zone's UTC offset at the instant, from zoneinfo
+        utc = _EPOCH_UTC + timedelta(seconds=epoch)
+        return utc.astimezone(self.zone).utcoffset() // _SECOND
+
+    def _span(self, index):
+        # the (transitions, wall transitions, offsets) tables of a span,
+        # built on first use; offsets[0] is the offset at the span's start
+        span = self._spans[index]
+        if span is None:
+            span = self._spans[index] = self._build(index)
+
+        return span
+
+    def _build(self, index):
+        # steps through the span a day at a time, when the offset changes a
+        # binary search finds the second it changed at
+        offset = self._offset
+        start = _TABLE_START + index * _SPAN
+        previous = offset(start)
+        transitions = []
+        walls = []
+        offsets = [previous]
+        for day in range(start, start + _SPAN, 86400):
+            current = offset(day + 86400)
+            if current == previous:
+                continue
+
+            low, high = day, day + 86400
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset(middle) == previous:
+                    low = middle
+                else:
+                    high = middle
+
+            transitions.append(high)
+            # with fold=0 ambiguous and skipped wall clock times use the
+            # earlier offset, so the later one starts at the larger of the
+            # two wall clock values of the transition
+            walls.append(high + max(previous, current))
+            offsets.append(current)
+            previous = current
+
+        return transitions, walls, offsets
+
+    def utc_offset(self, epoch):
+        """Returns the UTC offset in seconds at the given epoch."""
+        if self.zone is None:
+            return self._fixed
+
+        if not _TABLE_START <= epoch < _TABLE_END:
+            return self._offset(epoch)
+
+        transitions, _, offsets = self._span((epoch - _TABLE_START) //
+            _SPAN)
+        return offsets[bisect_right(transitions, epoch)]
+
+    def wall_offset(self, wall):
+        """Returns the UTC offset in seconds of a wall clock time, given as
+        the number of seconds since 1970-01-01 00:00 of the naive date and
+        time."""
+        if self.zone is None:
+            return self._fixed
+
+        if not _TABLE_START <= wall < _TABLE_END:
+            naive = _EPOCH + timedelta(seconds=wall)
+            return naive.replace(tzinfo=self.zone).utcoffset() // _SECOND
+
+        # spans are ranges of instants, a transition within a day of either
+        # end of one can fall in the neighbouring span's wall clock times
+        index = (wall - _TABLE_START) // _SPAN
+        start = _TABLE_START + index * _SPAN
+        _, walls, offsets = self._span(index)
+        position = bisect_right(walls, wall)
+        if position == 0 and index > 0 and wall < start + 86400:
+            _, walls, offsets = self._span(index - 1)
+            position = bisect_right(walls, wall)
+        elif index + 1 < _SPANS and wall >= start + _SPAN - 86400:
+            _, after, after_offsets = self._span(index + 1)
+            after_position = bisect_right(after, wall)
+            if after_position:
+                return after_offsets[after_position]
+
+        return offsets[position]
+
+    def to_epoch(self, dt):
+        """Returns the integer epoch of a naive ``datetime`` whose value is
+        the wall clock time in this zone."""
+        wall = _wall_seconds(dt)
+        return wall - self.wall_offset(wall)
+
+    def from_epoch(self, epoch):
+        """Returns the naive ``datetime`` holding the wall clock time in
+        this zone at the given integer or float epoch."""
+        if isinstance(epoch, float):
+            offset = self.utc_offset(math.floor(epoch))
+        else:
+            offset = self.utc_offset(epoch)
+
+        return _EPOCH + timedelta(0, epoch + offset)
+
+    def to_epochs(self, datetimes):
+        """Batch version of :meth:`ZoneTable.to_epoch`, returns an
+        ``array('q')``."""
+        wall_offset = self.wall_offset
+        walls = (_wall_seconds(dt) for dt in datetimes)
+        return array('q', (wall - wall_offset(wall) for wall in walls))
+
+    def from_epochs(self, epochs):
+        """Batch version of :meth:`ZoneTable.from_epoch`, returns a list of
+        naive ``datetime`` objects."""
+        return [self.from_epoch(epoch) for epoch in epochs]
+
+# =============================================================================
+# Binary Encoding
+# =============================================================================
+
+# signed integers are written as zigzag varints: 0, -1, 1, -2 become 0, 1, 2,
+# 3 and are stored 7 bits per byte, low bits first, with the high bit set on
+# every byte but the last. Values within a few seconds of each other take 3
+# or 4 bytes, a full microsecond timestamp 8
+
+# flags in the first byte of an encoded When or WhenArray
+_TIME_ONLY = 1
+_ZONED = 2
+
+
+def _write_varint(out, value):
+    # appends the zigzag varint encoding of value to a bytearray
+    value = value << 1 if value >= 0 else (~value << 1) | 1
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def _read_varint(data, index):
+    # returns a (value, index) pair of the varint at data[index] and the
+    # index of the byte after it, raises IndexError if data ends first
+    result = shift = 0
+    while True:
+        byte = data[index]
+        index += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (result >> 1) ^ -(result & 1), index
+
+        shift += 7
+
+# =============================================================================
+# Columnar Storage
+# =============================================================================
+
+def _to_micros(value):
+    # converts a range bound to the integer representation used by
+    # CompactWhen and WhenArray
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, CompactWhen):
+        return value.micros
+    if isinstance(value, When):
+        return value._wall_micros
+    if isinstance(value, datetime):
+        return _datetime_to_micros(value)
+    if isinstance(value, time):
+        return _time_to_micros(value)
+
+    raise TypeError('cannot compare %s to a WhenArray' %
+        type(value).__name__)
+
+
+def _int64_view(data):
+    # returns a 1-dimensional int64 memoryview of data without copying if
+    # it exports a suitable buffer, otherwise None
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return None
+
+    if view.format.lstrip('@=<') in ('q', 'l') and view.itemsize == 8 \
+            and view.ndim == 1 and view.c_contiguous:
+        return view.cast('B').cast('q')
+
+    if view.format in ('B', 'b', 'c') and view.c_contiguous:
+        return view.cast('B').cast('q')
+
+    raise TypeError('buffer must contain 64-bit integers, not %r' %
+        view.format)
+
+
+_EPOCH_UNITS = {'s': 1, 'ms': 1000, 'us': 1000000, 'ns': 1000000000}
+
+
+def _epoch_unit(unit):
+    # returns the number of the given epoch units in a second
+    try:
+        return _EPOCH_UNITS[unit]
+    except KeyError:
+        raise ValueError('unknown epoch unit: %r' % (unit, ))
+
+
+class WhenArray(object):
+    """Sequence of date/times stored in a single contiguous buffer of 64-bit
+    integers, using the same representation as :class:`CompactWhen`:
+    microseconds since 1970-01-01 of the naive date and time, or
+    microseconds since midnight if ``time_only`` is set.
+
+    A ``WhenArray`` is read only.  Slicing and range queries return views
+    on the same buffer rather than copies.  Indexing and iterating give
+    :class:`When` objects.  Adding or subtracting a ``timedelta`` and
+    :meth:`WhenArray.floor` return new arrays.
+
+    The buffer is exposed through :attr:`WhenArray.micros` and
+    :meth:`WhenArray.to_numpy` without copying, and with pickle protocol 5
+    it is sent out-of-band, so handing a ``WhenArray`` to a worker process
+    doesn't need extra copies.
+
+    :param micros:
+        Either any iterable of integers, or an object exporting a buffer of
+        64-bit integers (``array('q')``, an ``int64`` NumPy array, ``bytes``)
+        which is used without copying
+    :param time_only:
+        True if the values are times of day
+    """
+    def __init__(self, micros=(), time_only=False):
+        data = _int64_view(micros)
+        if data is None:
+            data = memoryview(array('q', micros))
+
+        self._data = data
+        self.time_only = time_only
+
+    @classmethod
+    def from_whens(cls, whens):
+        """Creates a ``WhenArray`` from an iterable of :class:`When` or
+        :class:`CompactWhen` objects.  The first one decides whether the
+        result is time only."""
+        whens = iter(whens)
+        first = next(whens, None)
+        if first is None:
+            return cls()
+
+        if isinstance(first, CompactWhen):
+            time_only = first.time_only
+        else:
+            time_only = first.datetime is None
+
+        data = array('q', [_to_micros(first)])
+        data.extend(_to_micros(w) for w in whens)
+        return cls(data, time_only)
+
+    @classmethod
+    def from_datetimes(cls, datetimes):
+        """Creates a ``WhenArray`` from an iterable of naive python
+        ``datetime`` objects."""
+        return cls(array('q', (_datetime_to_micros(d) for d in datetimes)))
+
+    @classmethod
+    def from_epochs(cls, epochs, unit='s', tz=None):
+        """Creates a ``WhenArray`` from an iterable of integer epochs.
+
+        :param unit:
+            What the epochs count: ``'s'`` (the default), ``'ms'``, ``'us'``
+            or ``'ns'``.  Anything below a microsecond is dropped.
+        :param tz:
+            Optional time zone name to convert to wall clock times in,
+            arithmetically through a :class:`ZoneTable`.  Defaults to None,
+            which converts to local time.
+        """
+        per_second = _epoch_unit(unit)
+        data = array('q')
+        if tz is None:
+            fromtimestamp = datetime.fromtimestamp
+            for value in epochs:
+                seconds, fraction = divmod(value, per_second)
+                data.append(_datetime_to_micros(fromtimestamp(seconds)) +
+                    fraction * _MICROS_PER_SECOND // per_second)
+        else:
+            utc_offset = ZoneTable.get(tz).utc_offset
+            for value in epochs:
+                seconds, fraction = divmod(value, per_second)
+                data.append((seconds + utc_offset(seconds)) *
+                    _MICROS_PER_SECOND + fraction * _MICROS_PER_SECOND //
+                    per_second)
+
+        return cls(data)
+
+    @classmethod
+    def from_datetime64(cls, values):
+        """Creates a ``WhenArray`` from a NumPy ``datetime64`` array.  No
+        copy is made if it is already in microsecond units."""
+        import numpy
+        values = numpy.ascontiguousarray(values, dtype='datetime64[us]')
+        return cls(values.view('int64'))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            result = WhenArray.__new__(WhenArray)
+            result._data = self._data[index]
+            result.time_only = self.time_only
+            return result
+
+        return self._when(self._data[index])
+
+    def __iter__(self):
+        for micros in self._data:
+            yield self._when(micros)
+
+    def __repr__(self):
+        return '<WhenArray of %d %s>' % (len(self._data),
+            'times' if self.time_only else 'datetimes')
+
+    def __buffer__(self, flags):
+        return memoryview(self._data)
+
+    def __reduce_ex__(self, protocol):
+        data = self._data
+        if protocol >= 5 and data.c_contiguous:
+            import pickle
+            data = pickle.PickleBuffer(data)
+        else:
+            data = data.tobytes()
+
+        return (WhenArray, (data, self.time_only))
+
+    def to_bytes(self):
+        """Returns the values encoded in a compact binary form that
+        :meth:`WhenArray.from_bytes` reads back: a flags byte, the count
+        and then each value as the varint difference from the one before
+        it.  Sorted values close together take a few bytes each, rather
+        than the 8 of :attr:`WhenArray.micros`; unsorted values still work
+        but take more."""
+        out = bytearray((_TIME_ONLY if self.time_only else 0, ))
+        _write_varint(out, len(self._data))
+        append = out.append
+        previous = 0
+        for micros in self._data:
+            # _write_varint inlined, this runs once per value
+            delta = micros - previous
+            previous = micros
+            delta = delta << 1 if delta >= 0 else (~delta << 1) | 1
+            while delta > 0x7f:
+                append(delta & 0x7f | 0x80)
+                delta >>= 7
+
+            append(delta)
+
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Creates a ``WhenArray`` from the output of
+        :meth:`WhenArray.to_bytes`, decoding the values straight into its
+        int64 buffer.
+
+        :param data:
+            ``bytes`` or another bytes-like object
+
+        :raises ValueError:
+            If the data isn't an encoded ``WhenArray``
+        """
+        try:
+            flags = data[0]
+            count, index = _read_varint(data, 1)
+            if flags & ~_TIME_ONLY or not 0 <= count <= len(data) - index:
+                # every value takes at least a byte
+                raise ValueError()
+
+            result = array('q', bytes(8 * count))
+            source = iter(memoryview(data)[index:].cast('B'))
+            value = 0
+            for position in range(count):
+                delta = shift = 0
+                for byte in source:
+                    delta |= (byte & 0x7f) << shift
+                    if byte < 0x80:
+                        break
+
+                    shift += 7
+                else:
+                    raise ValueError()
+
+                value += (delta >> 1) ^ -(delta & 1)
+                result[position] = value
+
+            if next(source, None) is not None:
+                raise ValueError()
+        except (IndexError, OverflowError, ValueError):
+            raise ValueError('data is not an encoded WhenArray')
+
+        return cls(result, bool(flags & _TIME_ONLY))
+
+    def _when(self, micros):
+        return When._from_wall(micros, None, self.time_only)
+
+    @property
+    def micros(self):
+        """Read only ``memoryview`` of the underlying 64-bit integers."""
+        return self._data.toreadonly()
+
+    def to_numpy(self):
+        """Returns the values as a NumPy ``int64`` array sharing this
+        object's buffer."""
+        import numpy
+        data = self._data
+        if not data.c_contiguous:
+            # strided slice, numpy needs a contiguous buffer
+            data = data.tobytes()
+
+        return numpy.frombuffer(data, dtype='int64')
+
+    def to_datetime64(self):
+        """Returns the values as a NumPy ``datetime64[us]`` array sharing
+        this object's buffer."""
+        return self.to_numpy().view('datetime64[us]')
+
+    def compact(self):
+        """Returns a list of :class:`CompactWhen` objects."""
+        time_only = self.time_only
+        return [CompactWhen(m, time_only) for m in self._data]
+
+    def sorted(self):
+        """Returns a new ``WhenArray`` with the values in order."""
+        return WhenArray(array('q', sorted(self._data)), self.time_only)
+
+    def unique(self):
+        """Returns a new ``WhenArray`` of the distinct values, in order."""
+        return WhenArray(array('q', sorted(set(self._data))), self.time_only)
+
+    def floor(self, unit):
+        """Batch version of :meth:`When.floor`, returns a new ``WhenArray``
+        with every value truncated."""
+        size = _floor_size(unit)
+        return WhenArray(array('q', (m - m % size for m in self._data)),
+            self.time_only)
+
+    def __add__(self, other):
+        # shifts every value by a timedelta, like When
+        if not isinstance(other, timedelta) or self.time_only:
+            return NotImplemented
+
+        delta = other // _MICROSECOND
+        return WhenArray(array('q', (m + delta for m in self._data)))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, timedelta):
+            return NotImplemented
+
+        return self + -other
+
+    def is_sorted(self):
+        """Returns True if the values are in ascending order."""
+        data = self._data
+        return all(data[i] <= data[i + 1] for i in range(len(data) - 1))
+
+    def index_range(self, start, end):
+        """Returns the ``(low, high)`` indices of the values that are at or
+        after ``start`` and before ``end``, using a binary search.  The
+        values must be sorted.
+
+        :param start:
+            Start of the range, inclusive.  A :class:`When`,
+            :class:`CompactWhen`, ``datetime`` (or ``time`` for a time only
+            array) or integer microseconds.  None means no lower bound.
+        :param end:
+            End of the range, exclusive, same types as ``start``.  None means
+            no upper bound.
+        """
+        low = 0
+        high = len(self._data)
+        if start is not None:
+            low = bisect_left(self._data, _to_micros(start))
+        if end is not None:
+            high = max(low, bisect_left(self._data, _to_micros(end)))
+
+        return low, high
+
+    def between(self, start, end):
+        """Returns a ``WhenArray`` view of the values that are at or after
+        ``start`` and before ``end``, see :meth:`WhenArray.index_range`."""
+        low, high = self.index_range(start, end)
+        return self[low:high]
+
+    def strings(self, name):
+        """Returns a list of the values rendered in one of the
+        :ref:`Supported formats <when-formats>`."""
+        if self.time_only:
+            raise TimeOnlyError('time only values cannot be formatted')
+
+        formatter = _formatter(name, When.parse_formats)
+        return [formatter(_micros_to_datetime(m)) for m in self._data]
+
+    def epochs(self, tz=None, unit='s'):
+        """Returns an ``array('q')`` of epoch values.
+
+        :param tz:
+            Optional time zone name, the values are treated as wall clock
+            times in that zone and converted arithmetically through a
+            :class:`ZoneTable`.  Defaults to None, which treats them as local
+            time.
+        :param unit:
+            One of ``'s'`` (the default), ``'ms'``, ``'us'`` or ``'ns'``
+        """
+        per_second = _epoch_unit(unit)
+        if self.time_only:
+            raise TimeOnlyError('no epoch for time only values')
+
+        if tz is not None:
+            wall_offset = ZoneTable.get(tz).wall_offset
+            walls = (m // _MICROS_PER_SECOND for m in self._data)
+            epochs = array('q', (wall - wall_offset(wall) for wall in walls))
+        else:
+            mktime = time_mod.mktime
+            epochs = array('q', (long(mktime(
+                _micros_to_datetime(m).timetuple())) for m in self._data))
+
+        if per_second == 1:
+            return epochs
+
+        return array('q', (e * per_second + m % _MICROS_PER_SECOND *
+            per_second // _MICROS_PER_SECOND for e, m in zip(epochs,
+            self._data)))
+
+    def milli_epochs(self, tz=None):
+        """Returns an ``array('q')`` of epoch * 1000 + milliseconds
+        values, see :meth:`WhenArray.epochs` for ``tz``."""
+        return self.epochs(tz, 'ms')
+
+    def convert(self, from_tz, to_tz):
+        """Returns a new ``WhenArray`` with the wall clock times in one zone
+        converted to the wall clock times of the same instants in another,
+        through the :class:`ZoneTable` of each.
+
+        :param from_tz:
+            Zone the values are in, None for local time
+        :param to_tz:
+            Zone to convert to, None for local time
+        """
+        return WhenArray.from_epochs(self.epochs(from_tz, 'us'), 'us', to_tz)
+
+# -----------------------------------------------------------------------------
+# Index. A WhenIndex keeps its values sorted in one int64 buffer, values added
+# since the last query wait in a pending buffer and are merged in by the
+# next query. The optional bucket directory holds the start of each
+# non-empty bucket and the position of its first value.
+
+_INDEX_MAGIC = b'WHENIDX' + (b'l' if sys.byteorder == 'little' else b'b')
+_INDEX_HEADER = '<8sqqqq'
+
+
+class WhenIndex(object):
+    """Sorted collection of date/times for answering range queries over
+    large numbers of values, using the same integer representation as
+    :class:`WhenArray`.  Queries are binary searches, so they take
+    logarithmic time however many values there are.
+
+    Values can be added at any time, they are merged into the sorted
+    buffer by the next query.  An index can be saved to a file and loaded
+    back with the file memory-mapped, without rebuilding it.
+
+        >>> index = WhenIndex.from_epochs(epochs, bucket='hour')
+        >>> index.count(When(detect='2023-11-05 00:00'),
+        ...     When(detect='2023-11-06 00:00'))
+        >>> index.rollup('day')
+
+    Range bounds and the values added can be :class:`When`,
+    :class:`CompactWhen`, ``datetime`` (``time`` for a time only index) or
+    integer microseconds, see :meth:`WhenArray.index_range`.
+
+    :param values:
+        Initial values, in any order
+    :param bucket:
+        Optional bucket size for the bucket directory used by
+        :meth:`WhenIndex.counts` and :meth:`WhenIndex.rollup`: one of
+        ``'second'``, ``'minute'``, ``'hour'`` or ``'day'``, or a
+        ``timedelta``.  Defaults to None, no directory.
+    :param time_only:
+        True if the values are times of day
+    """
+    def __init__(self, values=(), bucket=None, time_only=False):
+        self.time_only = time_only
+        self.bucket = None if bucket is None else _floor_size(bucket)
+        self._data = array('q')
+        self._pending = array('q', (_to_micros(v) for v in values))
+        self._directory = None
+        self._mmap = None
+
+    @classmethod
+    def from_epochs(cls, epochs, unit='s', tz=None, bucket=None):
+        """Creates a ``WhenIndex`` from integer epochs, see
+        :meth:`WhenArray.from_epochs` for ``unit`` and ``tz``."""
+        index = cls(bucket=bucket)
+        index.add_epochs(epochs, unit, tz)
+        return index
+
+    def __len__(self):
+        return len(self._data) + len(self._pending)
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __repr__(self):
+        return '<WhenIndex of %d %s>' % (len(self),
+            'times' if self.time_only else 'datetimes')
+
+    # -------------------------------------------------------------------------
+    # Inserts
+
+    def add(self, value):
+        """Adds a single value."""
+        self._pending.append(_to_micros(value))
+
+    def update(self, values):
+        """Adds many values."""
+        self._pending.extend(_to_micros(v) for v in values)
+
+    def add_epochs(self, epochs, unit='s', tz=None):
+        """Adds integer epochs, see :meth:`WhenArray.from_epochs` for
+        ``unit`` and ``tz``."""
+        self._pending.extend(WhenArray.from_epochs(epochs, unit, tz).micros)
+
+    def merge(self, other):
+        """Adds all the values of another ``WhenIndex`` or a
+        :class:`WhenArray`."""
+        if isinstance(other, WhenIndex):
+            other = other.array
+
+        if other.time_only != self.time_only:
+            raise ValueError('can\'t merge time only and date/time values')
+
+        self._pending.extend(other.micros)
+
+    def _sorted(self):
+        # the sorted values, merging in any pending ones; sorted() finds the
+        # two sorted runs so merging costs little more than a copy
+        if self._pending:
+            data = sorted(self._pending)
+            if self._data:
+                data = sorted(chain(self._data, data))
+
+            self._data = array('q', data)
+            self._pending = array('q')
+            self._directory = None
+            self._mmap = None
+
+        return self._data
+
+    # -------------------------------------------------------------------------
+    # Queries
+
+    @property
+    def array(self):
+        """The sorted values as a :class:`WhenArray`, without copying."""
+        return WhenArray(self._sorted(), self.time_only)
+
+    def _bounds(self, start, end):
+        data = self._sorted()
+        low = 0
+        high = len(data)
+        if start is not None:
+            low = bisect_left(data, _to_micros(start))
+        if end is not None:
+            high = max(low, bisect_left(data, _to_micros(end)))
+
+        return low, high
+
+    def range(self, start, end):
+        """Returns a :class:`WhenArray` view of the values at or after
+        ``start`` and before ``end``.  Either bound can be None."""
+        low, high = self._bounds(start, end)
+        return self.array[low:high]
+
+    def count(self, start, end):
+        """Returns the number of values at or after ``start`` and before
+        ``end``.  Either bound can be None."""
+        low, high = self._bounds(start, end)
+        return high - low
+
+    def nearest(self, value):
+        """Returns the value closest to ``value`` as a :class:`When`, the
+        earlier one if two are as close.  None if the index is empty."""
+        data = self._sorted()
+        if not data:
+            return None
+
+        micros = _to_micros(value)
+        position = bisect_left(data, micros)
+        if position == len(data) or position > 0 and \
+                micros - data[position - 1] <= data[position] - micros:
+            position -= 1
+
+        return When._from_wall(data[position], None, self.time_only)
+
+    def _buckets(self):
+        # the bucket directory as (starts, positions) arrays, found with a
+        # binary search for the end of each non-empty bucket; merging in
+        # pending values drops the directory
+        data = self._sorted()
+        if self._directory is None:
+            if self.bucket is None:
+                raise ValueError('the index has no bucket directory')
+
+            size = self.bucket
+            starts = array('q')
+            positions = array('q')
+            position = 0
+            while position < len(data):
+                start = data[position] - data[position] % size
+                starts.append(start)
+                positions.append(position)
+                position = bisect_left(data, start + size, position)
+
+            self._directory = (starts, positions)
+
+        return self._directory
+
+    def counts(self, start=None, end=None):
+        """Returns a list of ``(When, count)`` pairs giving the start and
+        number of values of each non-empty bucket of the directory, for the
+        buckets that start at or after ``start`` and before ``end``.
+
+        :raises ValueError:
+            If the index has no ``bucket`` size
+        """
+        starts, positions = self._buckets()
+        total = len(self._data)
+        low = 0 if start is None else bisect_left(starts, _to_micros(start))
+        high = len(starts) if end is None else \
+            bisect_left(starts, _to_micros(end))
+
+        return [(When._from_wall(starts[i], None, self.time_only),
+            (positions[i + 1] if i + 1 < len(starts) else total) -
+            positions[i]) for i in range(low, high)]
+
+    def rollup(self, unit, start=None, end=None):
+        """Returns a list of ``(When, count)`` pairs giving the start and
+        number of values of each non-empty period of ``unit``, for the
+        values at or after ``start`` and before ``end``.  If ``unit`` is a
+        multiple of the bucket directory's size the directory's counts are
+        added up, otherwise each period is found with a binary search.
+
+        :param unit:
+            One of ``'second'``, ``'minute'``, ``'hour'`` or ``'day'``, or a
+            ``timedelta``
+        """
+        size = _floor_size(unit)
+        low, high = self._bounds(start, end)
+        data = self._data
+        periods = []
+        if self.bucket and size % self.bucket == 0 and start is None and \
+                end is None:
+            starts, positions = self._buckets()
+            ends = chain(islice(positions, 1, None), [len(data)])
+            for bucket_start, first, following in zip(starts, positions,
+                    ends):
+                period = bucket_start - bucket_start % size
+                if periods and periods[-1][0] == period:
+                    periods[-1][1] += following - first
+                else:
+                    periods.append([period, following - first])
+        else:
+            position = low
+            while position < high:
+                period = data[position] - data[position] % size
+                following = bisect_left(data, period + size, position, high)
+                periods.append([period, following - position])
+                position = following
+
+        return [(When._from_wall(period, None, self.time_only), number)
+            for period, number in periods]
+
+    # -------------------------------------------------------------------------
+    # Persistence
+
+    def save(self, path):
+        """Writes the index, with its bucket directory, to a file that
+        :meth:`WhenIndex.load` can memory-map."""
+        data = self._sorted()
+        starts, positions = (array('q'), array('q'))
+        if self.bucket is not None:
+            starts, positions = self._buckets()
+
+        parts = [memoryview(values).cast('B')
+            for values in (data, starts, positions)]
+        if self._mmap is not None:
+            # still mapped from the file it was loaded from, which may be the
+            # one about to be truncated
+            parts = [bytes(part) for part in parts]
+
+        import struct
+        with open(path, 'wb') as f:
+            f.write(struct.pack(_INDEX_HEADER, _INDEX_MAGIC, len(data),
+                self.bucket or 0, len(starts), int(self.time_only)))
+            for part in parts:
+                f.write(part)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index written by :meth:`WhenIndex.save`.  The file is
+        memory-mapped and used without copying or re-sorting it until values
+        are added.
+
+        :raises ValueError:
+            If the file isn't a saved index from a machine with the same
+            byte order
+        """
+        import mmap, struct
+        header = struct.calcsize(_INDEX_HEADER)
+        with open(path, 'rb') as f:
+            # too short for the header, which includes empty files that
+            # can't be mapped
+            if os.fstat(f.fileno()).st_size < header:
+                raise ValueError('%s is not a saved WhenIndex' % (path, ))
+
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        magic, length, bucket, buckets, time_only = struct.unpack(
+            _INDEX_HEADER, view[:header])
+        if magic != _INDEX_MAGIC or len(view) != header + 8 * (length +
+                2 * buckets):
+            view.release()
+            mapped.close()
+            raise ValueError('%s is not a saved WhenIndex' % (path, ))
+
+        ints = view[header:].cast('q')
+        index = cls(time_only=bool(time_only))
+        index.bucket = bucket or None
+        index._data = ints[:length]
+        if bucket:
+            index._directory = (ints[length:length + buckets],
+                ints[length + buckets:])
+
+        index._mmap = mapped
+        return index
+
+# =============================================================================
+# Bulk Formatting
+# =============================================================================
+
+def _typed_chunks(values, chunk_size):
+    # splits an iterable into (kind, list) chunks for _format_chunk, the
+    # kind is decided by the type of the first value
+    values = iter(values)
+    empty = object()
+    first = next(values, empty)
+    if first is empty:
+        return
+
+    if isinstance(first, datetime):
+        kind = 'datetime'
+    elif isinstance(first, (When, CompactWhen)):
+        kind = 'when'
+    else:
+        kind = 'epoch'
+
+    values = chain([first], values)
+    while True:
+        chunk = list(islice(values, chunk_size))
+        if not chunk:
+            return
+
+        yield kind, chunk
+
+
+def _format_chunk(kind, chunk, name, formats):
+    # converts a chunk of values to datetimes and renders them, runs in the
+    # worker processes of When.format_many
+    if kind == 'micros':
+        chunk = [_micros_to_datetime(m) for m in chunk.micros]
+    elif kind == 'epoch':
+        fromtimestamp = datetime.fromtimestamp
+        chunk = [fromtimestamp(e) for e in chunk]
+    elif kind == 'when':
+        pattern = formats[name]
+        chunk = [w._zoned(pattern) if isinstance(w, When) else w.datetime
+            for w in chunk]
+
+    formatter = _formatter(name, formats)
+    return [formatter(d) for d in chunk]
+
+# =============================================================================
+# Streaming
+# =============================================================================
+
+def normalize_lines(lines, output='iso_micro', name=None, column=None,
+        delimiter=None, header=False, errors='raise'):
+    """Generator that re-formats the timestamps in a stream of text lines.
+    Lines are consumed lazily, one at a time, so memory use doesn't depend on
+    how many lines there are.  Each output line ends in a newline.
+
+    Without ``column``, ``delimiter`` or ``header`` each whole line is a
+    timestamp, otherwise lines are treated as CSV and only the given column
+    (the first by default) is re-formatted.
+
+    :param lines:
+        Iterable of text lines, for example an open file.  CSV files should
+        be opened with ``newline=''``.
+    :param output:
+        Name of one of the :ref:`Supported formats <when-formats>` to write
+        the timestamps in.  Defaults to ``'iso_micro'``.
+    :param name:
+        Name of the format to parse with, as used by the ``parse_*``
+        keywords.  Defaults to None which detects the format of each value.
+    :param column:
+        Index of the CSV column holding the timestamp, or its name if the
+        first row is a header.
+    :param delimiter:
+        CSV delimiter, defaults to ``','``.
+    :param header:
+        True if the first row is a header, it is passed through unchanged.
+        Implied if ``column`` is a name.
+    :param errors:
+        What to do with a line that can't be parsed: ``'raise'`` (the
+        default) raises a ``ValueError`` giving the line number, ``'skip'``
+        drops the line and ``'keep'`` passes it through unchanged.
+
+    :raises KeyError:
+        If ``name`` isn't a known format
+    :raises ValueError:
+        For a bad line when ``errors`` is ``'raise'``, an unknown ``errors``
+        choice or a ``column`` name that isn't in the header
+    """
+    if errors not in ('raise', 'skip', 'keep'):
+        raise ValueError('unknown errors choice: %r' % (errors, ))
+
+    When._row_parser(name)
+    keyword = 'detect' if name is None else 'parse_' + name
+
+    def convert(value):
+        # through the constructor so a trailing 'Z' means UTC, as it does
+        # for the detect and parse_* keywords
+        return getattr(When(**{keyword:value}).string, output)
+
+    if column is None and delimiter is None and not header:
+        for lineno, line in enumerate(lines, 1):
+            try:
+                yield convert(line.strip()) + '\n'
+            except (ValueError, TypeError) as e:
+                if errors == 'raise':
+                    raise ValueError('line %d: %s' % (lineno, e))
+                elif errors == 'keep':
+                    yield line if line.endswith('\n') else line + '\n'
+
+        return
+
+    # CSV: rows are written back out one at a time through a reused buffer
+    if column is None:
+        column = 0
+
+    import csv
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter or ',',
+        lineterminator='\n')
+
+    def render(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    rows = csv.reader(lines, delimiter=delimiter or ',')
+    if header or isinstance(column, str):
+        row = next(rows, None)
+        if row is None:
+            return
+
+        if isinstance(column, str):
+            try:
+                column = row.index(column)
+            except ValueError:
+                raise ValueError('column %r is not in the header' % column)
+
+        yield render(row)
+
+    for row in rows:
+        try:
+            row[column] = convert(row[column].strip())
+        except (ValueError, TypeError, IndexError) as e:
+            if errors == 'raise':
+                raise ValueError('line %d: %s' % (rows.line_num, e))
+            elif errors == 'skip':
+                continue
+
+        yield render(row)
+
+
+def normalize_file(path, output='iso_micro', **kwargs):
+    """Generator that opens the file at ``path`` and passes it through
+    :func:`normalize_lines`, see it for the remaining keyword arguments.
+    The file is closed once the generator is exhausted or closed."""
+    with open(path, newline='') as f:
+        for line in normalize_lines(f, output, **kwargs):
+            yield line
+
+
+async def parse_stream(source, name=None, output='datetime', chunks=False,
+        batch_size=1000, executor=None, offload_size=100, max_pending=2):
+    """Async generator that parses the timestamps from an async source of
+    lines, such as an ``asyncio.StreamReader``, in micro-batches.  Each
+    batch holds the lines that had arrived by the time the previous one was
+    parsed, up to ``batch_size``, so batches grow when parsing falls
+    behind and stay small when it doesn't.  Batches are parsed with
+    :meth:`When.parse_many` and yielded in order::
+
+        >>> async for results, errors in parse_stream(reader):
+        ...     for result in results:
+        ...         ...
+
+    Lines are read ahead into a bounded queue by a separate task.  Once
+    ``batch_size * max_pending`` lines are waiting it stops reading from the
+    source until they are consumed, which for a socket pushes the
+    backpressure back to the sender.
+
+    :param source:
+        Async iterable of ``str`` or ``bytes`` lines, surrounding whitespace
+        is ignored
+    :param name:
+        Name of the format to parse with, as used by the ``parse_*``
+        keywords.  Defaults to None which detects the format of each line.
+    :param output:
+        What to return for each line, see :meth:`When.parse_many`
+    :param chunks:
+        If True ``source`` gives arbitrary chunks of ``bytes`` (or ``str``)
+        rather than lines, they are split into lines on ``\\n``
+    :param batch_size:
+        Most lines in a batch, defaults to 1000
+    :param executor:
+        Optional ``concurrent.futures`` thread or process pool to parse
+        large batches in, so the event loop isn't blocked.  A process pool
+        only sees the formats defined when it was created.
+    :param offload_size:
+        Batches with at least this many lines are given to ``executor``,
+        smaller ones are parsed in the event loop.  Defaults to 100.
+    :param max_pending:
+        Number of batches that can be in the executor at once, and the
+        number of batches of lines read ahead.  Defaults to 2.
+
+    :returns:
+        Yields a ``(results, errors)`` tuple for each batch, as returned by
+        :meth:`When.parse_many` except the indices in ``errors`` count lines
+        from the start of the stream.
+
+    :raises KeyError:
+        If ``name`` isn't a known format
+    """
+    import asyncio
+
+    When._row_parser(name)
+    loop = asyncio.get_running_loop()
+    done = object()
+    queue = asyncio.Queue(batch_size * max_pending)
+
+    async def read():
+        # reads lines into the queue, ending with done or the exception the
+        # source raised
+        try:
+            remainder = None
+            async for line in source:
+                if not chunks:
+                    await queue.put(line.strip())
+                    continue
+
+                lines = line.split(b'\n' if isinstance(line, bytes) else
+                    '\n')
+                if remainder is not None:
+                    lines[0] = remainder + lines[0]
+
+                remainder = lines.pop()
+                for line in lines:
+                    await queue.put(line.strip())
+
+            if remainder is not None and remainder.strip():
+                await queue.put(remainder.strip())
+
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    reader = loop.create_task(read())
+    getter = None
+    pending = deque()
+    index = 0
+    finished = False
+    failure = None
+    try:
+        while True:
+            # finished batches are yielded in order
+            while pending and pending[0][1].done():
+                offset, future = pending.popleft()
+                results, errors = future.result()
+                yield results, [(offset + i, e) for i, e in errors]
+
+            if finished or len(pending) >= max_pending:
+                if not pending:
+                    break
+
+                await asyncio.wait([pending[0][1]])
+                continue
+
+            # wait for more lines, or for the oldest batch in the executor
+            if getter is None:
+                getter = loop.create_task(queue.get())
+
+            if pending:
+                await asyncio.wait([getter, pending[0][1]],
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    continue
+
+            batch = [await getter]
+            getter = None
+            while len(batch) < batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            if batch[-1] is done or isinstance(batch[-1], Exception):
+                finished = True
+                if batch[-1] is not done:
+                    failure = batch[-1]
+
+                batch.pop()
+
+            if not batch:
+                continue
+
+            if executor is not None and len(batch) >= offload_size:
+                future = loop.run_in_executor(executor, When.parse_many,
+                    batch, name, output)
+            else:
+                future = loop.create_future()
+                future.set_result(When.parse_many(batch, name, output))
+
+            pending.append((index, future))
+            index += len(batch)
+    finally:
+        reader.cancel()
+        if getter is not None:
+            getter.cancel()
+
+        for _, future in pending:
+            future.cancel()
+
+    if failure is not None:
+        raise failure
+
+
+def main(argv=None):
+    """Command line entry point for :func:`normalize_lines`, installed as
+    ``when-normalize``.  Reads the named file, or stdin, and writes the
+    re-formatted lines to stdout."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='when-normalize',
+        description='Re-formats the timestamps in a text or CSV file')
+    parser.add_argument('filename', nargs='?',
+        help='file to read, defaults to stdin')
+    parser.add_argument('-o', '--output', default='iso_micro',
+        choices=sorted(When.parse_formats),
+        help='format to write timestamps in (default: iso_micro)')
+    parser.add_argument('-f', '--format', dest='name',
+        choices=sorted(list(When.parse_formats) + ['iso8601']),
+        help='format to parse timestamps with (default: detect)')
+    parser.add_argument('-c', '--column',
+        help='CSV column index or, with a header, name of the timestamp')
+    parser.add_argument('-d', '--delimiter', help='CSV delimiter')
+    parser.add_argument('--header', action='store_true',
+        help='first row is a header')
+    parser.add_argument('-e', '--errors', default='raise',
+        choices=['raise', 'skip', 'keep'],
+        help='what to do with lines that can\'t be parsed (default: raise)')
+    args = parser.parse_args(argv)
+
+    column = args.column
+    if column is not None and column.isdigit():
+        column = int(column)
+
+    kwargs = dict(name=args.name, column=column, delimiter=args.delimiter,
+        header=args.header, errors=args.errors)
+
+    try:
+        if args.filename:
+            lines = normalize_file(args.filename, args.output, **kwargs)
+        else:
+            lines = normalize_lines(sys.stdin, args.output, **kwargs)
+
+        sys.stdout.writelines(lines)
+    except ValueError as e:
+        parser.exit(1, '%s: error: %s\n' % (parser.prog, e))
+
+
+if __name__ == '__main__':
+    main()